@@ -1,14 +1,19 @@
 select 
-	a.allergen_id
+	ad.allergen_id
 	,ar.allergen_name
-	,count(distinct a.product_id) num_products
-	,count(distinct a.product_id)*1.0/(select count(distinct product_id) from worldfood.products) pct_products
+	,a.num_products
+	,a.num_products*1.0/(select count(distinct product_id) from worldfood.products) pct_products
 from 
-	worldfood.product_allergens a
+	(select 
+		allergen_key
+		,count(distinct product_id) num_products
+	from 
+		worldfood.product_allergens
+	group by 
+		allergen_key) a
+join
+	worldfood.allergens_dim ad on a.allergen_key=ad.allergen_key
 left join
-	worldfood.allergens_reference ar on a.allergen_id=ar.allergen_id
-group by 
-	a.allergen_id
-	,ar.allergen_name
+	worldfood.allergens_reference ar on ad.allergen_id=ar.allergen_id
 order by 
-	count(*) desc
\ No newline at end of file
+	a.num_products desc
\ No newline at end of file
@@ -0,0 +1,13 @@
+select 
+	ad.allergen_id
+	,ar.allergen_name
+	,c.num_products
+	,c.num_products*1.0/(select count(distinct product_id) from worldfood.products) pct_products
+from 
+	worldfood.allergens_agg_counts c
+join
+	worldfood.allergens_dim ad on c.allergen_key=ad.allergen_key
+left join
+	worldfood.allergens_reference ar on ad.allergen_id=ar.allergen_id
+order by 
+	c.num_products desc
\ No newline at end of file
@@ -1,12 +1,19 @@
 select 
-	ingredient_id
-	,ingredient_name
-	,count(distinct product_id) num_products
-	,count(distinct product_id)*1.0/(select count(distinct product_id) from worldfood.products) pct_products
+	id.ingredient_id
+	,i.ingredient_name
+	,i.num_products
+	,i.num_products*1.0/(select count(distinct product_id) from worldfood.products) pct_products
 from 
-	worldfood.product_ingredients
-group by 
-	ingredient_id
-	,ingredient_name
+	(select 
+		ingredient_key
+		,ingredient_name
+		,count(distinct product_id) num_products
+	from 
+		worldfood.product_ingredients
+	group by 
+		ingredient_key
+		,ingredient_name) i
+left join
+	worldfood.ingredients_dim id on i.ingredient_key=id.ingredient_key
 order by 
-	count(*) desc
\ No newline at end of file
+	i.num_products desc
\ No newline at end of file
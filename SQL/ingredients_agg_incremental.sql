@@ -0,0 +1,11 @@
+select 
+	id.ingredient_id
+	,c.ingredient_name
+	,c.num_products
+	,c.num_products*1.0/(select count(distinct product_id) from worldfood.products) pct_products
+from 
+	worldfood.ingredients_agg_counts c
+left join
+	worldfood.ingredients_dim id on c.ingredient_key=id.ingredient_key
+order by 
+	c.num_products desc
\ No newline at end of file
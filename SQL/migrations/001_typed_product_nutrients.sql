@@ -0,0 +1,47 @@
+--Migrate worldfood.product_nutrients from (nutrient_name VARCHAR, nutrient_value VARCHAR, product_id)
+--to (product_id, nutrient_key SMALLINT, nutrient_value FLOAT, nutrient_text VARCHAR),
+--with nutrient names dictionary-encoded in worldfood.nutrients_dim.
+--The old table is kept as worldfood.product_nutrients_varchar until the new one is checked.
+--PostgreSQL; run once with psql -1 -f (single transaction)
+
+create table if not exists worldfood.nutrients_dim (
+	nutrient_key SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY
+	,nutrient_name VARCHAR(255) NOT NULL UNIQUE
+	,nutrient_id VARCHAR(255)
+);
+
+--nutrient_id is the nutrients_reference id, i.e. the name without its _100g/_serving/... suffix
+insert into worldfood.nutrients_dim (nutrient_name, nutrient_id)
+select distinct 
+	nutrient_name
+	,regexp_replace(nutrient_name, '(_prepared)?(_100g|_serving|_value|_unit|_label|_modifier)?$', '')
+from 
+	worldfood.product_nutrients
+where 
+	nutrient_name is not null
+on conflict (nutrient_name) do nothing;
+
+alter table worldfood.product_nutrients rename to product_nutrients_varchar;
+alter index if exists worldfood.product_nutrients_product_id_idx rename to product_nutrients_varchar_product_id_idx;
+
+create table worldfood.product_nutrients as
+select
+	pn.product_id
+	,nd.nutrient_key
+	,case when pn.nutrient_value ~ '^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$' 
+		then cast(pn.nutrient_value as double precision) else null end nutrient_value
+	,case when pn.nutrient_value ~ '^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$' 
+		then null else cast(pn.nutrient_value as VARCHAR(255)) end nutrient_text
+from 
+	worldfood.product_nutrients_varchar pn
+join 
+	worldfood.nutrients_dim nd on pn.nutrient_name=nd.nutrient_name;
+
+alter table worldfood.product_nutrients alter column nutrient_key type SMALLINT;
+
+create index product_nutrients_product_id_idx on worldfood.product_nutrients (product_id);
+create index product_nutrients_nutrient_key_idx on worldfood.product_nutrients (nutrient_key);
+analyze worldfood.product_nutrients;
+
+--Once checked:
+--drop table worldfood.product_nutrients_varchar;
@@ -0,0 +1,8 @@
+--Add the ingestion time of each product, used by incremental aggregate refreshes
+--(data_processing.py --mode incremental). Rows loaded before this migration stay NULL
+--and are covered by the first, full, incremental refresh.
+--PostgreSQL; run once with psql -1 -f
+
+alter table worldfood.products add column if not exists ingested_at TIMESTAMP;
+
+create index if not exists products_ingested_at_idx on worldfood.products (ingested_at);
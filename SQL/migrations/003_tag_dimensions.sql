@@ -0,0 +1,123 @@
+--Migrate worldfood.product_ingredients/product_allergens/product_brands/product_categories
+--from VARCHAR tag columns (ingredient_id, allergen_id, brand_id, category_id) to INTEGER
+--keys into new dimension tables (ingredients_dim, allergens_dim, brands_dim, categories_dim).
+--Dimensions are seeded from the *_reference tables first, then from tags only seen on products.
+--The old tables are kept as worldfood.<table>_varchar until the new ones are checked.
+--Needs the *_reference tables (api_reference_processing.py).
+--PostgreSQL; run once with psql -1 -f (single transaction)
+
+create table if not exists worldfood.ingredients_dim (
+	ingredient_key INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY
+	,ingredient_id VARCHAR(255) NOT NULL UNIQUE
+);
+create table if not exists worldfood.allergens_dim (
+	allergen_key INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY
+	,allergen_id VARCHAR(255) NOT NULL UNIQUE
+);
+create table if not exists worldfood.brands_dim (
+	brand_key INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY
+	,brand_id VARCHAR(255) NOT NULL UNIQUE
+);
+create table if not exists worldfood.categories_dim (
+	category_key INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY
+	,category_id VARCHAR(255) NOT NULL UNIQUE
+);
+
+insert into worldfood.ingredients_dim (ingredient_id)
+select ingredient_id from worldfood.ingredients_reference where ingredient_id is not null
+union
+select ingredient_id from worldfood.product_ingredients where ingredient_id is not null
+on conflict (ingredient_id) do nothing;
+
+insert into worldfood.allergens_dim (allergen_id)
+select allergen_id from worldfood.allergens_reference where allergen_id is not null
+union
+select allergen_id from worldfood.product_allergens where allergen_id is not null
+on conflict (allergen_id) do nothing;
+
+insert into worldfood.brands_dim (brand_id)
+select brand_id from worldfood.brands_reference where brand_id is not null
+union
+select brand_id from worldfood.product_brands where brand_id is not null
+on conflict (brand_id) do nothing;
+
+insert into worldfood.categories_dim (category_id)
+select category_id from worldfood.categories_reference where category_id is not null
+union
+select category_id from worldfood.product_categories where category_id is not null
+on conflict (category_id) do nothing;
+
+--Ingredients (ids can be missing, so keys are left joined)
+alter table worldfood.product_ingredients rename to product_ingredients_varchar;
+alter index if exists worldfood.product_ingredients_product_id_idx rename to product_ingredients_varchar_product_id_idx;
+
+create table worldfood.product_ingredients as
+select
+	pi.product_id
+	,d.ingredient_key
+	,pi.ingredient_name
+from
+	worldfood.product_ingredients_varchar pi
+left join
+	worldfood.ingredients_dim d on pi.ingredient_id=d.ingredient_id;
+
+--Allergens
+alter table worldfood.product_allergens rename to product_allergens_varchar;
+alter index if exists worldfood.product_allergens_product_id_idx rename to product_allergens_varchar_product_id_idx;
+
+create table worldfood.product_allergens as
+select
+	pa.product_id
+	,d.allergen_key
+from
+	worldfood.product_allergens_varchar pa
+join
+	worldfood.allergens_dim d on pa.allergen_id=d.allergen_id;
+
+--Brands
+alter table worldfood.product_brands rename to product_brands_varchar;
+alter index if exists worldfood.product_brands_product_id_idx rename to product_brands_varchar_product_id_idx;
+
+create table worldfood.product_brands as
+select
+	pb.product_id
+	,d.brand_key
+from
+	worldfood.product_brands_varchar pb
+join
+	worldfood.brands_dim d on pb.brand_id=d.brand_id;
+
+--Categories
+alter table worldfood.product_categories rename to product_categories_varchar;
+alter index if exists worldfood.product_categories_product_id_idx rename to product_categories_varchar_product_id_idx;
+
+create table worldfood.product_categories as
+select
+	pc.product_id
+	,d.category_key
+from
+	worldfood.product_categories_varchar pc
+join
+	worldfood.categories_dim d on pc.category_id=d.category_id;
+
+create index product_ingredients_product_id_idx on worldfood.product_ingredients (product_id);
+create index product_allergens_product_id_idx on worldfood.product_allergens (product_id);
+create index product_brands_product_id_idx on worldfood.product_brands (product_id);
+create index product_categories_product_id_idx on worldfood.product_categories (product_id);
+analyze worldfood.product_ingredients;
+analyze worldfood.product_allergens;
+analyze worldfood.product_brands;
+analyze worldfood.product_categories;
+
+--Incremental aggregate state was counted on the string tags: drop it, so the
+--next incremental refresh rebuilds it from scratch
+drop table if exists worldfood.allergens_agg_products;
+drop table if exists worldfood.allergens_agg_counts;
+drop table if exists worldfood.ingredients_agg_products;
+drop table if exists worldfood.ingredients_agg_counts;
+
+--Once checked:
+--drop table worldfood.product_ingredients_varchar;
+--drop table worldfood.product_allergens_varchar;
+--drop table worldfood.product_brands_varchar;
+--drop table worldfood.product_categories_varchar;
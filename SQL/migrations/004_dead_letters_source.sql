@@ -0,0 +1,6 @@
+--Add the source of dead letters: the path of the dump whose line failed to decode
+--(dump_processing.py), so reloading a dump replaces its decode errors.
+--Rows recorded before this migration stay NULL.
+--PostgreSQL; run once with psql -1 -f
+
+alter table worldfood.dead_letters add column if not exists source VARCHAR(255);
@@ -1,39 +1,70 @@
-with cte as (
-	select 
-		p.product_id
-		,product_name
-		,pn.nutrient_name
+with nutrient_keys as (
+	select
+		nutrient_key
+		,nutrient_name
+	from
+		worldfood.nutrients_dim
+	where
+		nutrient_name in ('carbohydrates_serving','proteins_serving','energy-kcal_serving')
+),
+
+ranked as (
+	select
+		pn.product_id
+		,nk.nutrient_name
 		,pn.nutrient_value
-		,PERCENT_RANK() over (partition by nutrient_name order by cast(nutrient_value as float)) nutrient_value_percentile
-		,case
-			when PERCENT_RANK() over (partition by nutrient_name order by cast(nutrient_value as float)) >= .9 then 'high'
-			when PERCENT_RANK() over (partition by nutrient_name order by cast(nutrient_value as float)) <= .1 then 'low'
-			else null end nutrient_indicator
-	from 
-		worldfood.product_nutrients pn 
-	join 
-		worldfood.products p on pn.product_id=p.product_id
-	where 
-		pn.nutrient_name in ('carbohydrates_serving','proteins_serving','energy-kcal_serving')
+		,PERCENT_RANK() over (partition by pn.nutrient_key order by pn.nutrient_value) nutrient_value_percentile
+	from
+		worldfood.product_nutrients pn
+	join
+		nutrient_keys nk on pn.nutrient_key=nk.nutrient_key
+	where
+		pn.nutrient_value is not null
+),
+
+pivoted as (
+	select
+		product_id
+		--Carbs
+		,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value else null end) carbs_per_serving
+		,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value_percentile else null end) carbs_per_serving_percentile
+		--Protein
+		,max(case when nutrient_name = 'proteins_serving' then nutrient_value else null end) protein_per_serving
+		,max(case when nutrient_name = 'proteins_serving' then nutrient_value_percentile else null end) protein_per_serving_percentile
+		--Calories
+		,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value else null end) calories_per_serving
+		,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value_percentile else null end) calories_per_serving_percentile
+	from
+		ranked
+	group by
+		product_id
 )
 
 select
-	product_id
-	,product_name
+	p.product_id
+	,p.product_name
 	--Carbs
-	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value else null end) carbs_per_serving
-	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value_percentile else null end) carbs_per_serving_percentile
-	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_indicator else null end) carbs_per_serving_indicator
+	,n.carbs_per_serving
+	,n.carbs_per_serving_percentile
+	,case
+		when n.carbs_per_serving_percentile >= :high_threshold then 'high'
+		when n.carbs_per_serving_percentile <= :low_threshold then 'low'
+		else null end carbs_per_serving_indicator
 	--Protein
-	,max(case when nutrient_name = 'proteins_serving' then nutrient_value else null end) protein_per_serving
-	,max(case when nutrient_name = 'proteins_serving' then nutrient_value_percentile else null end) protein_per_serving_percentile
-	,max(case when nutrient_name = 'proteins_serving' then nutrient_indicator else null end) protein_per_serving_indicator
+	,n.protein_per_serving
+	,n.protein_per_serving_percentile
+	,case
+		when n.protein_per_serving_percentile >= :high_threshold then 'high'
+		when n.protein_per_serving_percentile <= :low_threshold then 'low'
+		else null end protein_per_serving_indicator
 	--Calories
-	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value else null end) calories_per_serving
-	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value_percentile else null end) calories_per_serving_percentile
-	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_indicator else null end) calories_per_serving_indicator
+	,n.calories_per_serving
+	,n.calories_per_serving_percentile
+	,case
+		when n.calories_per_serving_percentile >= :high_threshold then 'high'
+		when n.calories_per_serving_percentile <= :low_threshold then 'low'
+		else null end calories_per_serving_indicator
 from
-	cte
-group by
-	product_id
-	,product_name
\ No newline at end of file
+	pivoted n
+join
+	worldfood.products p on n.product_id=p.product_id
@@ -8,248 +8,565 @@ Created on Mon Dec  6 12:10:21 2021
 
 
 #Import packages
-import requests
+import argparse
+import io
+import itertools
 import pandas as pd
-import yaml
+import requests
 import sqlalchemy as sa
-import os
 import numpy as np
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from bulk_load import WriteBuffer, write_tables
+from db import get_engine
+from dimensions import TagDictionary
+from http_client import (BASE_URL, FETCH_RETRIES, AdaptiveLimit, RateLimiter, add_cache_arguments,
+                         configure_response_cache, error_status, fetch_json, fetch_stream, fetch_with_retry,
+                         get_session)
+from json_stream import iter_items
+from metrics import METRICS, add_metrics_arguments, finish_run, start_run
+
+
+PAGE_URL = '{}/.json?page={}'
+
+#Products sorted by modification time, most recent first (100 per page)
+DELTA_URL = '{}/api/v2/search?sort_by=last_modified_t&page_size=100&page={}'
 
 
-#Get credentials stored in secrets.yaml file (saved in same directory)
-#(Note: Nuvalence credentials have read access only)
-def get_engine():
-
-	if os.path.isfile('secrets.yaml'):
-		with open('secrets.yaml', 'r') as stream:
-			data_loaded = yaml.load(stream)
-			
-			user=data_loaded['EDW']['user']
-			password=data_loaded['EDW']['password']
-			endpoint=data_loaded['EDW']['endpoint']
-			port=data_loaded['EDW']['port']
-			database=data_loaded['EDW']['database']
-			
-	db_string = "postgres://{0}:{1}@{2}:{3}/{4}".format(user,password,endpoint,port,database)
-	engine=sa.create_engine(db_string)
-	
-	return engine  
-        
-    
 
-#Function to process a single page of products and store results into 7 tables:
-#1. Products - table of all products
+
+#Tables populated for each page of products, with column order and database types
+#1. Products - table of all products (with the time they were last written)
 #2. Ingredients - maps products to ingredients
 #3. Allergens - maps products to allergens
-#4. Nutrients - maps products to nutrients
+#4. Nutrients - maps products to nutrients (numeric values typed, anything else
+#   kept as text)
 #5. Brands - maps products to brands
 #6. Categories - maps products to categories
+#Tags (ingredient, allergen, brand and category ids, nutrient names) are stored
+#as integer keys into the *_dim dimension tables (see TAG_DICTIONARIES)
+PRODUCT_TABLES = {'products': {'product_id': sa.types.BIGINT(),
+                               'product_name': sa.types.VARCHAR(length=255),
+                               'ingested_at': sa.types.TIMESTAMP()},
+                  'product_ingredients': {'product_id': sa.types.BIGINT(),
+                                          'ingredient_key': sa.types.INTEGER(),
+                                          'ingredient_name': sa.types.VARCHAR(length=255)},
+                  'product_allergens': {'product_id': sa.types.BIGINT(),
+                                        'allergen_key': sa.types.INTEGER()},
+                  'product_nutrients': {'product_id': sa.types.BIGINT(),
+                                        'nutrient_key': sa.types.SMALLINT(),
+                                        'nutrient_value': sa.types.FLOAT(),
+                                        'nutrient_text': sa.types.VARCHAR(length=255)},
+                  'product_brands': {'product_id': sa.types.BIGINT(),
+                                     'brand_key': sa.types.INTEGER()},
+                  'product_categories': {'product_id': sa.types.BIGINT(),
+                                         'category_key': sa.types.INTEGER()}}
+
+#Columns of the product tables as flattened from the API, before their tags are
+#encoded (see prepare_tables)
+FLATTENED_COLUMNS = {'products': ['product_id', 'product_name'],
+                     'product_ingredients': ['product_id', 'ingredient_id', 'ingredient_name'],
+                     'product_allergens': ['product_id', 'allergen_id'],
+                     'product_nutrients': ['product_id', 'nutrient_name', 'nutrient_value'],
+                     'product_brands': ['product_id', 'brand_id'],
+                     'product_categories': ['product_id', 'category_id']}
+
 #7. Logging - logs pages processed, plus if any had errors
-def process_page(all_food_products,engine):
+LOGGING_DTYPE = {'page': sa.types.INTEGER(),
+                 'products': sa.types.INTEGER(),
+                 'allergens': sa.types.INTEGER(),
+                 'ingredients': sa.types.INTEGER(),
+                 'nutrients': sa.types.INTEGER(),
+                 'error_processing': sa.types.BOOLEAN()}
+
+#8. Dead letters - pages that could not be fetched (after retries), parsed or
+#written, with the error, for a later replay pass (see process_error_pages).
+#Products of a dump that could not be loaded are keyed by product_id instead,
+#and its lines that could not be decoded by the dump's path (source)
+DEAD_LETTERS_DTYPE = {'page': sa.types.INTEGER(),
+                      'product_id': sa.types.BIGINT(),
+                      'source': sa.types.VARCHAR(length=255),
+                      'stage': sa.types.VARCHAR(length=32),
+                      'status': sa.types.INTEGER(),
+                      'attempts': sa.types.INTEGER(),
+                      'error': sa.types.VARCHAR(length=255),
+                      'failed_at': sa.types.TIMESTAMP()}
+
+#All tables written for a page, in write order
+WRITE_TABLES = dict(PRODUCT_TABLES, logging=LOGGING_DTYPE, dead_letters=DEAD_LETTERS_DTYPE)
+
+#Key used to replace existing rows on re-processing: product tables by the 
+#product_id of the products written, logging by page. A page's dead letter is
+#replaced with its logging row, so it is cleared once the page goes through
+REPLACE_KEYS = dict({table: ('products', 'product_id') for table in PRODUCT_TABLES},
+                    logging=('logging', 'page'), dead_letters=('logging', 'page'))
+
+#Nutrient names (e.g. proteins_serving) interned as small integer keys, with the 
+#nutrients_reference id they belong to (e.g. proteins)
+NUTRIENT_SUFFIX = re.compile('(_prepared)?(_100g|_serving|_value|_unit|_label|_modifier)?$')
+
+def get_nutrient_id(nutrient_name):
+    return NUTRIENT_SUFFIX.sub('', nutrient_name)
+
+NUTRIENT_DICTIONARY = TagDictionary('nutrients_dim', 'nutrient_name', 'nutrient_key', key_type='SMALLINT',
+                                    attributes={'nutrient_id': get_nutrient_id})
+
+#Taxonomy tags (e.g. en:milk) interned as integer keys. The tag columns match
+#the ids of the *_reference tables, which the dimensions are seeded from
+INGREDIENT_DICTIONARY = TagDictionary('ingredients_dim', 'ingredient_id', 'ingredient_key')
+ALLERGEN_DICTIONARY = TagDictionary('allergens_dim', 'allergen_id', 'allergen_key')
+BRAND_DICTIONARY = TagDictionary('brands_dim', 'brand_id', 'brand_key')
+CATEGORY_DICTIONARY = TagDictionary('categories_dim', 'category_id', 'category_key')
+
+#Dictionary-encoded product table columns: table -> (tag column, dictionary)
+TAG_DICTIONARIES = {'product_ingredients': ('ingredient_id', INGREDIENT_DICTIONARY),
+                    'product_allergens': ('allergen_id', ALLERGEN_DICTIONARY),
+                    'product_nutrients': ('nutrient_name', NUTRIENT_DICTIONARY),
+                    'product_brands': ('brand_id', BRAND_DICTIONARY),
+                    'product_categories': ('category_id', CATEGORY_DICTIONARY)}
+
+#Product tag lists stored as (product_id, tag) rows
+TAG_TABLES = {'allergens_tags': ('product_allergens', 'allergen_id'),
+              'brands_tags': ('product_brands', 'brand_id'),
+              'categories_tags': ('product_categories', 'category_id')}
+
+
+#Function to flatten any iterable of products into the product tables.
+#Walks the products once, collecting plain column lists, and builds each
+#DataFrame a single time at the end (instead of appending per product)
+def flatten_products(products):
     
-    products = all_food_products['products']
+    columns = {table: {column: [] for column in table_columns} 
+               for table, table_columns in FLATTENED_COLUMNS.items()}
     
-    products_df = pd.DataFrame()
-    ingredients_df = pd.DataFrame()
-    allergens_df = pd.DataFrame()
-    nutrients_df = pd.DataFrame()
-    brands_df = pd.DataFrame()
-    categories_df = pd.DataFrame()
+    products_cols = columns['products']
+    ingredients_cols = columns['product_ingredients']
+    nutrients_cols = columns['product_nutrients']
     
     for product in products:
         
-        if product['lang'] == 'en' and 'product_name' in product:
+        if product.get('lang') == 'en' and 'product_name' in product:
             
             ###Products
-            product_df = pd.DataFrame({'product_id': [product['id']], 
-                                        'product_name': [product['product_name']]})
-            products_df = products_df.append(product_df)
-            
-            ### Ingredients
-            if 'ingredients' in product:
-                product_ingredients_df = pd.DataFrame(product['ingredients'])
-                product_ingredients_df['product_id'] = product['_id']
-                ingredients_df = ingredients_df.append(product_ingredients_df)
+            products_cols['product_id'].append(product['id'])
+            products_cols['product_name'].append(product['product_name'])
             
+            product_id = product['_id']
             
-            ### Allergens
-            if 'allergens_tags' in product:
-                product_ids=[]
-                allergens=[]
-                for allergen in product['allergens_tags']:
-                    product_ids.append(product['_id'])
-                    allergens.append(allergen)
-                    
-                product_allergens_df = pd.DataFrame({'product_id':product_ids,
-                                                      'allergen_id':allergens})
-                allergens_df = allergens_df.append(product_allergens_df)
+            ### Ingredients
+            for ingredient in product.get('ingredients', ()):
+                ingredients_cols['product_id'].append(product_id)
+                ingredients_cols['ingredient_id'].append(ingredient.get('id'))
+                ingredients_cols['ingredient_name'].append(ingredient.get('text'))
             
             ###Nutrients
-            if 'nutriments' in product:
-                product_nutrient_df = pd.DataFrame([product['nutriments']])\
-                    .transpose()\
-                    .reset_index()\
-                    .rename(columns = {'index': 'nutrient_name', 0: 'nutrient_value'})
-                product_nutrient_df['product_id'] = product['_id']
-
-                nutrients_df = nutrients_df.append(product_nutrient_df)
-                
-                
-            ### Brands
-            if 'brands_tags' in product:
-                product_ids=[]
-                brands=[]
-                for brand in product['brands_tags']:
-                    product_ids.append(product['_id'])
-                    brands.append(brand)
-                    
-                product_brands_df = pd.DataFrame({'product_id':product_ids,
-                                                  'brand_id':brands})
-                
-                brands_df = brands_df.append(product_brands_df)
-                
-            
-            ### Categories
-            if 'categories_tags' in product:
-                product_ids=[]
-                categories=[]
-                for category in product['categories_tags']:
-                    product_ids.append(product['_id'])
-                    categories.append(category)
-                    
-                product_categories_df = pd.DataFrame({'product_id':product_ids,
-                                                      'category_id':categories})
-                
-                categories_df = categories_df.append(product_categories_df)
+            nutriments = product.get('nutriments', {})
+            nutrients_cols['nutrient_name'].extend(nutriments.keys())
+            nutrients_cols['nutrient_value'].extend(nutriments.values())
+            nutrients_cols['product_id'].extend([product_id]*len(nutriments))
             
+            ### Allergens, Brands, Categories
+            for tags_key, (table, tag_column) in TAG_TABLES.items():
+                tags = product.get(tags_key, ())
+                columns[table]['product_id'].extend([product_id]*len(tags))
+                columns[table][tag_column].extend(tags)
+    
+    tables = {table: pd.DataFrame(cols, columns=list(cols)) 
+              for table, cols in columns.items()}
+    tables['product_nutrients'] = split_nutrient_values(tables['product_nutrients'])
+    return tables
+
+
+#Text nutrient values stored as numbers: the same rule as the migration of
+#existing rows (SQL/migrations/001_typed_product_nutrients.sql), so a value is
+#split the same way whichever path loaded it
+NUMERIC_TEXT = r'\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*'
+NUMERIC_PATTERN = re.compile(NUMERIC_TEXT)
+
+
+#Function to get the number of a raw nutrient value, or NaN if it is text.
+#Booleans are text, as str(True) is in the migration
+def _numeric_value(value):
+    kind = type(value)
+    if kind is float:
+        return value
+    if kind is str:
+        return float(value) if NUMERIC_PATTERN.fullmatch(value) else np.nan
+    if kind is bool or kind is np.bool_ or value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        return np.nan
+
+
+#Function to split raw nutrient values into a numeric column and a text column 
+#for anything non-numeric (units, labels, ...). Numbers, and text matching 
+#NUMERIC_TEXT (surrounding whitespace included), are numeric
+def split_nutrient_values(nutrients_df):
+    values = nutrients_df['nutrient_value']
+    numeric = pd.Series(np.fromiter(map(_numeric_value, values.array), float, len(values)), index=values.index)
+    text = values[numeric.isnull() & values.notnull()].astype(str)
+    return pd.DataFrame({'product_id': nutrients_df['product_id'],
+                         'nutrient_name': nutrients_df['nutrient_name'],
+                         'nutrient_value': numeric,
+                         'nutrient_text': text.reindex(values.index).astype(object)})
+
+
+#Function to prepare flattened tables for writing: stamps products with their 
+#ingestion time (used by incremental aggregate refreshes) and replaces 
+#dictionary-encoded tag columns with their keys, interning new tags
+def prepare_tables(engine, tables):
     
+    tables = dict(tables)
     
-    if len(products_df) > 0:
-        products_df.to_sql('products',
-                            con=engine,
-                            schema='worldfood',
-                            index=False,
-                            if_exists='append',
-                            dtype={'product_id': sa.types.BIGINT(),
-                                  'product_name': sa.types.VARCHAR(length=255)})
-     
-    if len(ingredients_df) > 0:
-        ingredients_df = ingredients_df[['product_id','id','text']]\
-            .rename(columns={'id':'ingredient_id', 'text': 'ingredient_name'})
-        ingredients_df.to_sql('product_ingredients',
-                              con=engine,
-                              schema='worldfood',
-                              index=False,
-                              if_exists='append',
-                              dtype={'product_id': sa.types.BIGINT(),
-                                      'ingredient_id': sa.types.VARCHAR(length=255),
-                                      'ingredient_name': sa.types.VARCHAR(length=255)})
+    products_df = tables.get('products')
+    if products_df is not None and len(products_df) > 0:
+        tables['products'] = products_df.assign(ingested_at=pd.Timestamp.now(tz='UTC').tz_localize(None))
     
-    if len(allergens_df) > 0:
-        allergens_df.to_sql('product_allergens',
-                            con=engine,
-                            schema='worldfood',
-                            index=False,
-                            if_exists='append',
-                            dtype={'product_id': sa.types.BIGINT(),
-                                  'allergen_id': sa.types.VARCHAR(length=255)})
+    for table, (tag_column, dictionary) in TAG_DICTIONARIES.items():
+        df = tables.get(table)
+        if df is not None and len(df) > 0:
+            df = df.assign(**{dictionary.key_column: dictionary.encode(engine, df[tag_column])})
+            tables[table] = df[list(PRODUCT_TABLES[table])]
     
-    if len(nutrients_df) > 0:
-        nutrients_df.to_sql('product_nutrients',
-                            con=engine,
-                            schema='worldfood',
-                            index=False,
-                            if_exists='append',
-                            dtype={'nutrient_name': sa.types.VARCHAR(length=255),
-                                    'nutrient_value': sa.types.VARCHAR(length=255),
-                                    'product_id': sa.types.BIGINT()})
-        
-        
-    if len(brands_df) > 0:
-        brands_df.to_sql('product_brands',
-                         con=engine,
-                         schema='worldfood',
-                         index=False,
-                         if_exists='append',
-                         dtype={'product_id': sa.types.BIGINT(),
-                              'brand_id': sa.types.VARCHAR(length=255)})
+    return tables
+
+
+#Function to flatten a single page of products (see flatten_products)
+def flatten_page(all_food_products):
+    return flatten_products(all_food_products['products'])
+
+
+#Function to build the logging table for a flattened page
+def get_logging_df(page, tables, error_processing=False):
+    return pd.DataFrame({'page': [page],
+                         'products': [len(tables.get('products', ()))],
+                         'allergens': [len(tables.get('product_allergens', ()))],
+                         'ingredients': [len(tables.get('product_ingredients', ()))],
+                         'nutrients': [len(tables.get('product_nutrients', ()))],
+                         'error_processing': [error_processing]})
+
+
+#Function to flatten a page into all the tables written for it, including logging
+def get_page_tables(all_food_products):
+    with METRICS.timer('flatten'):
+        tables = flatten_page(all_food_products)
+    tables['logging'] = get_logging_df(all_food_products['page'], tables)
+    return tables
+
+
+#Function to flatten the products of a page body read from a binary stream.
+#The products are parsed one at a time straight into the flattener, without
+#decoding the whole page first
+def parse_products(stream):
+    with METRICS.timer('parse'):
+        return flatten_products(iter_items(stream, 'products'))
+
+
+#Function to fetch a page and flatten its products as the body comes off the
+#connection (see fetch_stream). Same arguments as fetch_content
+def fetch_products(url, session=None, rate_limiter=None, timeout=60):
+    return fetch_stream(url, session, rate_limiter, timeout, parse=parse_products)
+
+
+#Function to flatten a raw page body into all the tables written for it,
+#including logging (see parse_products)
+def parse_page_tables(page, content):
+    tables = parse_products(io.BytesIO(content))
+    tables['logging'] = get_logging_df(page, tables)
+    return tables
+
+
+#Function to build the dead letter of a page (or a product, or a line of the
+#dump at `source`) that failed at `stage` with `error`
+def get_dead_letter_df(error, stage, page=None, product_id=None, source=None):
+    return pd.DataFrame({'page': [page],
+                         'product_id': [product_id],
+                         'source': [source],
+                         'stage': [stage],
+                         'status': [error_status(error)],
+                         'attempts': [getattr(error, 'attempts', 1)],
+                         'error': ['{}: {}'.format(type(error).__name__, error)[:255]],
+                         'failed_at': [pd.Timestamp.now(tz='UTC').tz_localize(None)]})
+
+
+#Tables written for a page that could not be processed: logging, and the
+#page's dead letter if given the error (from the `stage` it failed at)
+def get_error_tables(page, error=None, stage='parse'):
+    tables = {'logging': get_logging_df(page, {}, error_processing=True)}
+    if error is not None:
+        tables['dead_letters'] = get_dead_letter_df(error, stage, page=page)
+    return tables
+
+
+#Tables written instead of a page's tables that failed to write (see WriteBuffer)
+def get_write_error_tables(tables, error):
+    page = int(tables['logging']['page'].iloc[0])
+    print('page {} failed to write: {}'.format(page, type(error).__name__))
+    return get_error_tables(page, error, stage='write')
+
+
+#Function to get a write buffer for product tables (encoded, and replacing 
+#existing rows for the same products and pages). Pages that fail to write are
+#logged as errors and dead-lettered (see get_write_error_tables), or with 
+#on_error=None raise
+def get_write_buffer(engine, batch_pages=10, batch_rows=None, dtypes=WRITE_TABLES, replace_keys=REPLACE_KEYS,
+                     on_error=get_write_error_tables):
+    return WriteBuffer(engine, dtypes, max_pages=batch_pages, max_rows=batch_rows,
+                       replace_keys=replace_keys, prepare=prepare_tables, on_error=on_error)
+
+
+#Function to process a single page of products and store results into the 
+#product tables above, plus logging, in one transaction
+def process_page(all_food_products,engine):
+    write_tables(get_page_tables(all_food_products), engine, WRITE_TABLES, REPLACE_KEYS, prepare=prepare_tables)
+
+
+#Function to fetch product pages, keeping up to `concurrency` requests in flight 
+#on a pooled keep-alive session. At most `prefetch` fetched pages are held ahead
+#of the consumer, so memory stays bounded when processing is slower than fetching.
+#Each fetch is retried `retries` times (see fetch_with_retry), and the requests
+#in flight are cut back while the API throttles (see AdaptiveLimit).
+#Yields (page, all_food_products) in page order (or (page, raw body) with fetch=fetch_content).
+#A page that still fails raises its error, or with return_exceptions=True is
+#yielded as (page, error) and the crawl goes on
+def fetch_pages(pages, concurrency=1, prefetch=None, rate_limit=None, base_url=BASE_URL, session=None,
+                page_url=PAGE_URL, fetch=fetch_json, retries=FETCH_RETRIES, return_exceptions=False):
+    
+    session = session or get_session(pool_size=concurrency, retries=0)
+    rate_limiter = RateLimiter(rate_limit)
+    limit = AdaptiveLimit(concurrency)
+    max_pending = concurrency + (concurrency if prefetch is None else prefetch)
+    
+    pages = iter(pages)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
         
+        def fetch_page(page):
+            with METRICS.context(page=page):
+                return fetch_with_retry(page_url.format(base_url, page), session, rate_limiter, limit, fetch, retries)
         
-    if len(categories_df) > 0:
-        categories_df.to_sql('product_categories',
-                             con=engine,
-                             schema='worldfood',
-                             index=False,
-                             if_exists='append',
-                             dtype={'product_id': sa.types.BIGINT(),
-                                   'category_id': sa.types.VARCHAR(length=255)})
+        def submit_next():
+            page = next(pages, None)
+            if page is not None:
+                pending.append((page, executor.submit(fetch_page, page)))
         
+        for _ in range(max_pending):
+            submit_next()
         
-    #Add logging
-    logging_df=pd.DataFrame({'page': [all_food_products['page']],
-                              'products': [len(products_df)],
-                              'allergens': [len(allergens_df)],
-                              'ingredients': [len(ingredients_df)],
-                              'nutrients': [len(nutrients_df)],
-                              'error_processing': [False]})
+        try:
+            while pending:
+                page, future = pending.popleft()
+                try:
+                    all_food_products = future.result()
+                except Exception as error:
+                    if not return_exceptions:
+                        raise
+                    all_food_products = error
+                submit_next()
+                yield page, all_food_products
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+#Function to fetch and process the given product pages. Rows from `batch_pages` 
+#pages (or `batch_rows` rows) are written per transaction, together with their
+#logging rows. Writes replace existing rows for the same products and pages, 
+#so re-processing a page is idempotent. With stream=True, page bodies are 
+#parsed incrementally as they are received (see fetch_products). Pages that fail to be fetched
+#(after retries), parsed or written are logged as errors and dead-lettered,
+#and the crawl goes on
+def process_pages(engine,pages,concurrency=1,prefetch=None,rate_limit=None,base_url=BASE_URL,
+                  batch_pages=10,batch_rows=None,session=None,stream=False):
+    cnt=1
+    errors=0
+    fetch = fetch_products if stream else fetch_json
+    with get_write_buffer(engine, batch_pages, batch_rows) as buffer:
+        for page, response in fetch_pages(pages, concurrency, prefetch, rate_limit, base_url, session, 
+                                           fetch=fetch, return_exceptions=True):
+            
+            with METRICS.context(page=page):
+                if isinstance(response, Exception):
+                    #Streamed pages are parsed while fetched
+                    stage = 'fetch' if isinstance(response, requests.exceptions.RequestException) else 'parse'
+                    tables = get_error_tables(page, response, stage=stage)
+                elif stream:
+                    tables = dict(response, logging=get_logging_df(page, response))
+                else:
+                    try:
+                        tables = get_page_tables(response)
+                    except Exception as error:
+                        tables = get_error_tables(page, error)
+            errors += 'dead_letters' in tables
+            buffer.add(tables)
+            
+            #Logging
+            if np.mod(cnt,10) == 0:
+                print(cnt)
+                
+            cnt=cnt+1
     
-    logging_df.to_sql('logging',
-                        con=engine,
-                        schema='worldfood',
-                        index=False,
-                        if_exists='append',
-                        dtype={'page': sa.types.INTEGER(),
-                                'products': sa.types.INTEGER(),
-                                'allergens': sa.types.INTEGER(),
-                                'ingredients': sa.types.INTEGER(),
-                                'nutrient_levels': sa.types.INTEGER(),
-                                'error_processing': sa.types.BOOLEAN()})
-
-
-#Function to process all product pages (24 products per page)
-def process_all_pages(engine,page_num):
-    all_food_products = requests.get('https://us.openfoodfacts.org/.json?page=1').json()
+    buffer.report()
+    errors += buffer.failed_pages
+    if errors:
+        print('{} pages failed, see worldfood.dead_letters'.format(errors))
+
+
+#Function to process all product pages (24 products per page), from page_num on
+def process_all_pages(engine,page_num,concurrency=1,prefetch=None,rate_limit=None,base_url=BASE_URL,
+                      batch_pages=10,batch_rows=None,stream=False):
+    session = get_session(pool_size=concurrency, retries=0)
+    all_food_products = fetch_with_retry(PAGE_URL.format(base_url, 1), session, fetch=fetch_json)
     num_pages = int(np.ceil(all_food_products['count']/24.))
     #num_pages=
-    cnt=1
-    for page in range(page_num,num_pages+1):
-        all_food_products = requests.get('https://us.openfoodfacts.org/.json?page={}'.format(str(page))).json()
+    process_pages(engine, range(page_num,num_pages+1), concurrency, prefetch, rate_limit, base_url,
+                  batch_pages, batch_rows, session, stream)
+
+
+#Function to get the page to resume a crawl at: the page after the last one 
+#successfully logged in worldfood.logging (or 1 if nothing is logged yet)
+def get_resume_page(engine):
+    if not sa.inspect(engine).has_table('logging', schema='worldfood'):
+        return 1
+    with engine.connect() as conn:
+        last_page = conn.execute(sa.text('select max(page) from worldfood.logging where not error_processing')).scalar()
+    return 1 if last_page is None else last_page + 1
+
+
+#Function to get the pages logged with error_processing=True
+def get_error_pages(engine):
+    if not sa.inspect(engine).has_table('logging', schema='worldfood'):
+        return []
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(sa.text('select distinct page from worldfood.logging where error_processing order by page'))]
+
+
+#Function to re-fetch and process pages that previously failed (the replay pass
+#of dead-lettered pages). Their logging rows and dead letters are replaced, so 
+#pages that succeed this time are no longer marked as errors
+def process_error_pages(engine,concurrency=1,prefetch=None,rate_limit=None,base_url=BASE_URL,
+                        batch_pages=10,batch_rows=None,stream=False):
+    error_pages = get_error_pages(engine)
+    print('{} error pages to re-process'.format(len(error_pages)))
+    process_pages(engine, error_pages, concurrency, prefetch, rate_limit, base_url, batch_pages, batch_rows,
+                  stream=stream)
 
-        
-        try:
-            process_page(all_food_products,engine)
-        except:
-            logging_df=pd.DataFrame({'page': [page],
-                                      'products': [0],
-                                      'allergens': [0],
-                                      'ingredients': [0],
-                                      'nutrients': [0],
-                                      'error_processing': [True]})
     
-            logging_df.to_sql('logging',
-                                con=engine,
-                                schema='worldfood',
-                                index=False,
-                                if_exists='append',
-                                dtype={'page': sa.types.INTEGER(),
-                                        'products': sa.types.INTEGER(),
-                                        'allergens': sa.types.INTEGER(),
-                                        'ingredients': sa.types.INTEGER(),
-                                        'nutrient_levels': sa.types.INTEGER(),
-                                        'error_processing': sa.types.BOOLEAN()})
-        
-        #Logging
-        if np.mod(cnt,10) == 0:
-            print(cnt)
+
+#Function to get the modification time (last_modified_t) high-water mark of 
+#products already ingested, or 0 if none is recorded
+def get_high_water_mark(engine):
+    if not sa.inspect(engine).has_table('ingest_state', schema='worldfood'):
+        return 0
+    with engine.connect() as conn:
+        high_water_mark = conn.execute(sa.text("select state_value from worldfood.ingest_state where state_key = 'last_modified_t'")).scalar()
+    return high_water_mark or 0
+
+
+#Function to record the modification time high-water mark
+def set_high_water_mark(engine, high_water_mark):
+    with engine.begin() as conn:
+        conn.execute(sa.text('create table if not exists worldfood.ingest_state (state_key VARCHAR(255), state_value BIGINT)'))
+        conn.execute(sa.text("delete from worldfood.ingest_state where state_key = 'last_modified_t'"))
+        conn.execute(sa.text("insert into worldfood.ingest_state (state_key, state_value) values ('last_modified_t', :value)"),
+                     {'value': int(high_water_mark)})
+
+
+#Function to ingest only products modified since the last run. Walks the product
+#listing sorted by last_modified_t (most recent first) until it reaches products 
+#older than the high-water mark; changed products have their rows in all product
+#tables replaced. Products modified at exactly the high-water mark are re-ingested,
+#which is harmless since writes are idempotent
+def process_delta(engine,concurrency=1,rate_limit=None,base_url=BASE_URL,batch_pages=10,batch_rows=None):
+    
+    high_water_mark = get_high_water_mark(engine)
+    new_high_water_mark = high_water_mark
+    count = 0
+    pages = 0
+    scanned = 0
+    changed = 0
+    rows = 0
+    
+    with get_write_buffer(engine, batch_pages, batch_rows, dtypes=PRODUCT_TABLES, on_error=None) as buffer:
+        for page, all_food_products in fetch_pages(itertools.count(1), concurrency, 0, rate_limit, base_url,
+                                                    page_url=DELTA_URL):
+            
+            products = all_food_products['products']
+            count = all_food_products['count']
+            pages += 1
+            scanned += len(products)
+            
+            modified = [product for product in products 
+                        if product.get('last_modified_t', 0) >= high_water_mark]
+            if modified:
+                new_high_water_mark = max(new_high_water_mark, 
+                                          max(product.get('last_modified_t', 0) for product in modified))
             
-        cnt=cnt+1
+            with METRICS.timer('flatten', page=page):
+                tables = flatten_products(modified)
+            changed += len(modified)
+            rows += sum(len(df) for df in tables.values())
+            buffer.add(tables)
+            
+            #Stop at the first page reaching older products, or the end of the listing
+            if len(modified) < len(products) or page*all_food_products['page_size'] >= count:
+                break
+    
+    #Only advance the high-water mark once all changed products are written
+    set_high_water_mark(engine, new_high_water_mark)
+    
+    #Compare with a full crawl (24 products per page) of the products scanned
+    #(the last page of the listing can be partial)
+    full_crawl_pages = int(np.ceil(count/24.))
+    delta_pages = int(np.ceil(min(scanned, count)/24.))
+    pages_skipped = max(0, full_crawl_pages - delta_pages)
+    rows_per_product = rows/changed if changed else 0
+    rows_skipped = max(0, count - changed)*rows_per_product
+    print('{:,} products changed since last_modified_t={}, {:,} rows written'.format(changed, high_water_mark, rows))
+    print('skipped ~{:,} of {:,} pages and ~{:,.0f} rows compared with a full crawl'.format(
+          pages_skipped, full_crawl_pages, rows_skipped))
+    
+    return {'changed_products': changed, 'rows': rows, 'pages_fetched': pages,
+            'pages_skipped': pages_skipped, 'rows_skipped': rows_skipped}
+
     
 
 def main():
+    parser = argparse.ArgumentParser(description='Load Open Food Facts product pages into worldfood tables')
+    parser.add_argument('--page', type=int, default=1, help='page to start processing at')
+    parser.add_argument('--resume', action='store_true', help='start after the last page in worldfood.logging')
+    parser.add_argument('--retry-errors', action='store_true', help='only re-process pages logged with errors (replay dead letters)')
+    parser.add_argument('--delta', action='store_true', help='only ingest products modified since the last run')
+    parser.add_argument('--concurrency', type=int, default=1, help='page requests in flight')
+    parser.add_argument('--prefetch', type=int, default=None, help='fetched pages buffered ahead of processing')
+    parser.add_argument('--rate-limit', type=float, default=None, help='max requests/sec to the API host')
+    parser.add_argument('--batch-pages', type=int, default=10, help='pages written per transaction')
+    parser.add_argument('--batch-rows', type=int, default=None, help='rows buffered before a write, if reached first')
+    parser.add_argument('--stream', action='store_true', help='parse page bodies incrementally, one product at a time')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    
+    configure_response_cache(args)
     engine=get_engine()
-    page_num=1 #Page to start processing at
-    process_all_pages(engine,page_num)
+    start_run('api_product_processing', engine, args)
+    try:
+        if args.delta:
+            process_delta(engine,args.concurrency,args.rate_limit,
+                          batch_pages=args.batch_pages,batch_rows=args.batch_rows)
+        elif args.retry_errors:
+            process_error_pages(engine,args.concurrency,args.prefetch,args.rate_limit,
+                                batch_pages=args.batch_pages,batch_rows=args.batch_rows,stream=args.stream)
+        else:
+            page_num=get_resume_page(engine) if args.resume else args.page #Page to start processing at
+            process_all_pages(engine,page_num,args.concurrency,args.prefetch,args.rate_limit,
+                              batch_pages=args.batch_pages,batch_rows=args.batch_rows,stream=args.stream)
+    finally:
+        finish_run(args)
         
     
     
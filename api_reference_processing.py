@@ -8,200 +8,214 @@ Created on Wed Dec  8 09:50:50 2021
 
 
 #Import packages
-import requests
+import argparse
+import functools
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import pandas as pd
-import yaml
 import sqlalchemy as sa
-import os
-
-
-
-#Get credentials stored in secrets.yaml file (saved in same directory)
-#(Note: Nuvalence credentials have read access only)
-def get_engine():
-
-	if os.path.isfile('secrets.yaml'):
-		with open('secrets.yaml', 'r') as stream:
-			data_loaded = yaml.load(stream)
-			
-			user=data_loaded['EDW']['user']
-			password=data_loaded['EDW']['password']
-			endpoint=data_loaded['EDW']['endpoint']
-			port=data_loaded['EDW']['port']
-			database=data_loaded['EDW']['database']
-			
-	db_string = "postgres://{0}:{1}@{2}:{3}/{4}".format(user,password,endpoint,port,database)
-	engine=sa.create_engine(db_string)
-	
-	return engine  
-
-def process_allergens_reference(engine):
-    
-    #Pull allergens metadata
-    allergens_reference = requests.get("https://us.openfoodfacts.org/allergens.json").json()
-    
-    #Convert to dataframe
-    allergens_reference_df = pd.DataFrame(allergens_reference['tags'])
-    
-    #Keep column order consistent in case json data changes
-    allergens_reference_df = allergens_reference_df[['id', 'known', 'name', 'products', 'url', 'sameAs']]
-    
-    #Rename to less generic column names
-    allergens_reference_df = allergens_reference_df.rename(columns={'id':'allergen_id', 
-                                                            'name':'allergen_name', 
-                                                            'sameAs':'same_as'})
-    
-    #Save to database
-    allergens_reference_df.to_sql('allergens_reference',
-                                  con=engine,
-                                  schema='worldfood',
-                                  index=False,
-                                  if_exists='replace',
-                                  dtype={'allergen_id': sa.types.VARCHAR(length=255),
-                                         'known': sa.types.INTEGER(),
-                                         'allergen_name': sa.types.VARCHAR(length=255),
-                                         'products': sa.types.INTEGER(),
-                                         'url': sa.types.VARCHAR(None),
-                                         'same_as': sa.types.VARCHAR(None)})
-    
 
-def process_ingredients_reference(engine):
-    
-    #Pull ingredients metadata
-    ingredients_reference = requests.get("https://us.openfoodfacts.org/ingredients.json").json()
-    
-    #Convert to dataframe
-    ingredients_reference_df = pd.DataFrame(ingredients_reference['tags'])
-    
-    #Keep column order consistent in case json data changes
-    ingredients_reference_df = ingredients_reference_df[['id', 'known', 'name', 'products', 'url', 'sameAs']]
-    
-    #Rename to less generic column names
-    ingredients_reference_df = ingredients_reference_df.rename(columns={'id':'ingredient_id', 
-                                                                'name':'ingredient_name', 
-                                                                'sameAs':'same_as'})
-    
-    #Save to database
-    ingredients_reference_df.to_sql('ingredients_reference',
-                                  con=engine,
-                                  schema='worldfood',
-                                  index=False,
-                                  if_exists='replace',
-                                  dtype={'ingredient_id': sa.types.VARCHAR(length=255),
-                                         'known': sa.types.INTEGER(),
-                                         'ingredient_name': sa.types.VARCHAR(length=255),
-                                         'products': sa.types.INTEGER(),
-                                         'url': sa.types.VARCHAR(None),
-                                         'same_as': sa.types.VARCHAR(None)})
-    
-    
-def process_nutrients_reference(engine):
-    
-    #Pull nutrients metadata
-    nutrients_reference = requests.get("https://us.openfoodfacts.org/cgi/nutrients.pl").json()
-    
-    #Convert to dataframe
-    #For simplicity, ignore sub-nutrients
-    nutrients_reference_df = pd.DataFrame(nutrients_reference['nutrients']).drop('nutrients',axis=1)
-    
-    #Keep column order consistent in case json data changes
-    nutrients_reference_df = nutrients_reference_df[['id', 'important', 'display_in_edit_form', 'name']]
-    
-    #Rename to less generic column names
-    nutrients_reference_df = nutrients_reference_df.rename(columns={'id':'inutrient_id', 
-                                                                'name':'nutrient_name'})
-    
-    #Save to database
-    nutrients_reference_df.to_sql('nutrients_reference',
-                                  con=engine,
-                                  schema='worldfood',
-                                  index=False,
-                                  if_exists='replace',
-                                  dtype={'nutrient_id': sa.types.VARCHAR(length=255),
-                                         'important': sa.types.BOOLEAN(),
-                                         'display_in_edit_form': sa.types.BOOLEAN(),
-                                         'name': sa.types.VARCHAR(length=255)})
-    
-    
-def process_brands_reference(engine):
-    
-    #Pull nutrients metadata
-    brands_reference = requests.get('https://us.openfoodfacts.org/brands.json').json()
-    
-    #Convert to dataframe
-    #For simplicity, ignore sub-nutrients
-    brands_reference_df = pd.DataFrame(brands_reference['tags'])
-    
-    #Keep column order consistent in case json data changes
-    brands_reference_df = brands_reference_df[['id', 'known', 'name', 'products', 'url']]
-    
-    #Rename to less generic column names
-    brands_reference_df = brands_reference_df.rename(columns={'id':'brand_id', 
-                                                            'name':'brand_name'})
-    
-    #Save to database
-    brands_reference_df.to_sql('brands_reference',
-                                  con=engine,
-                                  schema='worldfood',
-                                  index=False,
-                                  if_exists='replace',
-                                  dtype={'brand_id': sa.types.VARCHAR(length=255),
-                                         'known': sa.types.INTEGER(),
-                                         'brand_name': sa.types.VARCHAR(length=255),
-                                         'products': sa.types.INTEGER(),
-                                         'url': sa.types.VARCHAR(None)})
-    
-    
-    
-def process_categories_reference(engine):
-    
-    #Pull nutrients metadata
-    categories_reference = requests.get('https://us.openfoodfacts.org/categories.json').json()
-    
-    #Convert to dataframe
-    categories_reference_df = pd.DataFrame(categories_reference['tags'])
-    
-    #Keep column order consistent in case json data changes
-    categories_reference_df = categories_reference_df[['id', 'known', 'name', 'products', 'url']]
-    
-    #Rename to less generic column names
-    categories_reference_df = categories_reference_df.rename(columns={'id':'category_id', 
-                                                            'name':'category_name'})
+from api_product_processing import ALLERGEN_DICTIONARY, BRAND_DICTIONARY, CATEGORY_DICTIONARY, INGREDIENT_DICTIONARY
+from bulk_load import replace_table
+from db import get_engine
+from http_client import (BASE_URL, CACHE_DIR, AdaptiveLimit, add_cache_arguments, configure_response_cache,
+                         fetch_conditional, fetch_with_retry, get_session)
+from json_stream import iter_items
+from metrics import METRICS, add_metrics_arguments, finish_run, start_run
+
+
+
+#Function to flatten the elements of a reference payload (an iterable of dicts, 
+#e.g. parsed one at a time from the response) into a DataFrame, keeping only
+#`columns` (payload field -> column name), in order
+def get_reference_df(items, columns):
     
-    #Save to database
-    categories_reference_df.to_sql('categories_reference',
-                                  con=engine,
-                                  schema='worldfood',
-                                  index=False,
-                                  if_exists='replace',
-                                  dtype={'category_id': sa.types.VARCHAR(length=255),
-                                         'known': sa.types.INTEGER(),
-                                         'category_name': sa.types.VARCHAR(length=255),
-                                         'products': sa.types.INTEGER(),
-                                         'url': sa.types.VARCHAR(None)})
+    values = {column: [] for column in columns.values()}
+    for item in items:
+        for field, column in columns.items():
+            values[column].append(item.get(field))
     
+    return pd.DataFrame(values, columns=list(columns.values()))
+
+
+#Reference tables:
+#- path: source path on the API host
+#- items: top-level key of the array of entries in the payload
+#- columns: payload fields kept (in column order) and their less generic column names
+#  (for nutrients, sub-nutrients are ignored for simplicity)
+#- dtype: database column types
+#- dictionary: tag dictionary seeded with the table's ids (so taxonomy tags have 
+#  keys before products use them)
+REFERENCE_TABLES = {'allergens_reference': {'path': '/allergens.json',
+                                            'items': 'tags',
+                                            'columns': {'id': 'allergen_id', 'known': 'known', 'name': 'allergen_name',
+                                                        'products': 'products', 'url': 'url', 'sameAs': 'same_as'},
+                                            'dictionary': ALLERGEN_DICTIONARY,
+                                            'dtype': {'allergen_id': sa.types.VARCHAR(length=255),
+                                                      'known': sa.types.INTEGER(),
+                                                      'allergen_name': sa.types.VARCHAR(length=255),
+                                                      'products': sa.types.INTEGER(),
+                                                      'url': sa.types.VARCHAR(None),
+                                                      'same_as': sa.types.VARCHAR(None)}},
+                    'ingredients_reference': {'path': '/ingredients.json',
+                                              'items': 'tags',
+                                              'columns': {'id': 'ingredient_id', 'known': 'known', 'name': 'ingredient_name',
+                                                          'products': 'products', 'url': 'url', 'sameAs': 'same_as'},
+                                              'dictionary': INGREDIENT_DICTIONARY,
+                                              'dtype': {'ingredient_id': sa.types.VARCHAR(length=255),
+                                                        'known': sa.types.INTEGER(),
+                                                        'ingredient_name': sa.types.VARCHAR(length=255),
+                                                        'products': sa.types.INTEGER(),
+                                                        'url': sa.types.VARCHAR(None),
+                                                        'same_as': sa.types.VARCHAR(None)}},
+                    'nutrients_reference': {'path': '/cgi/nutrients.pl',
+                                            'items': 'nutrients',
+                                            'columns': {'id': 'nutrient_id', 'important': 'important',
+                                                        'display_in_edit_form': 'display_in_edit_form', 'name': 'nutrient_name'},
+                                            'dtype': {'nutrient_id': sa.types.VARCHAR(length=255),
+                                                      'important': sa.types.BOOLEAN(),
+                                                      'display_in_edit_form': sa.types.BOOLEAN(),
+                                                      'nutrient_name': sa.types.VARCHAR(length=255)}},
+                    'brands_reference': {'path': '/brands.json',
+                                         'items': 'tags',
+                                         'columns': {'id': 'brand_id', 'known': 'known', 'name': 'brand_name',
+                                                     'products': 'products', 'url': 'url'},
+                                         'dictionary': BRAND_DICTIONARY,
+                                         'dtype': {'brand_id': sa.types.VARCHAR(length=255),
+                                                   'known': sa.types.INTEGER(),
+                                                   'brand_name': sa.types.VARCHAR(length=255),
+                                                   'products': sa.types.INTEGER(),
+                                                   'url': sa.types.VARCHAR(None)}},
+                    'categories_reference': {'path': '/categories.json',
+                                             'items': 'tags',
+                                             'columns': {'id': 'category_id', 'known': 'known', 'name': 'category_name',
+                                                         'products': 'products', 'url': 'url'},
+                                             'dictionary': CATEGORY_DICTIONARY,
+                                             'dtype': {'category_id': sa.types.VARCHAR(length=255),
+                                                       'known': sa.types.INTEGER(),
+                                                       'category_name': sa.types.VARCHAR(length=255),
+                                                       'products': sa.types.INTEGER(),
+                                                       'url': sa.types.VARCHAR(None)}}}
+
+
+#Function to flatten a reference payload file, parsing its entries one at a time
+def read_reference_df(table, path):
+    reference = REFERENCE_TABLES[table]
+    with open(path, 'rb') as stream, METRICS.timer('parse', table_name=table):
+        return get_reference_df(iter_items(stream, reference['items']), reference['columns'])
+
+
+#Function to hash a file in chunks
+def get_file_hash(path, chunk_size=2**20):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+#Function to get the payload hash a reference table was last loaded from
+def get_payload_hash(engine, table):
+    with engine.connect() as conn:
+        if not (sa.inspect(conn).has_table('reference_state', schema='worldfood') and
+                sa.inspect(conn).has_table(table, schema='worldfood')):
+            return None
+        return conn.execute(sa.text('select payload_hash from worldfood.reference_state where table_name = :table'),
+                            {'table': table}).scalar()
+
+
+#Function to record the payload hash a reference table was loaded from
+def set_payload_hash(conn, table, payload_hash):
+    conn.execute(sa.text('create table if not exists worldfood.reference_state '
+                         '(table_name VARCHAR(255), payload_hash CHAR(64), refreshed_at TIMESTAMP)'))
+    conn.execute(sa.text('delete from worldfood.reference_state where table_name = :table'), {'table': table})
+    conn.execute(sa.text('insert into worldfood.reference_state (table_name, payload_hash, refreshed_at) '
+                         'values (:table, :payload_hash, :refreshed_at)'),
+                 {'table': table, 'payload_hash': payload_hash, 'refreshed_at': pd.Timestamp.now(tz='UTC').tz_localize(None).to_pydatetime()})
+
+
+#Function to load a reference table from a fetched payload file, unless it was 
+#already loaded from an identical payload. The table is rebuilt in a staging
+#table and swapped in, so readers are never locked out or see it empty.
+#Returns the number of rows written, or None if the table was skipped
+def process_reference(engine, table, path, force=False):
+
+    payload_hash = get_file_hash(path)
+    if not force and get_payload_hash(engine, table) == payload_hash:
+        return None
+
+    reference = REFERENCE_TABLES[table]
+    reference_df = read_reference_df(table, path)
+    replace_table(reference_df, table, engine, dtype=reference['dtype'])
+    if 'dictionary' in reference:
+        dictionary = reference['dictionary']
+        dictionary.intern(engine, reference_df[dictionary.tag_column].dropna().unique().tolist())
+    with engine.begin() as conn:
+        set_payload_hash(conn, table, payload_hash)
+    return len(reference_df)
+
+
+#Function to refresh the reference tables: the payloads are fetched concurrently
+#with conditional requests against the on-disk cache (retried, and cut back while
+#the API throttles, as page fetches: see fetch_with_retry), then each table is 
+#written (or skipped if unchanged) as its payload arrives. Prints and returns 
+#per-table timings
+def process_all_references(engine, tables=None, base_url=BASE_URL, cache_dir=CACHE_DIR, force=False):
+
+    tables = list(tables or REFERENCE_TABLES)
+    session = get_session(pool_size=len(tables), retries=0)
+    limit = AdaptiveLimit(len(tables))
+    fetch_cached = functools.partial(fetch_conditional, cache_dir=cache_dir)
+    results = {}
+
+    def fetch(table):
+        start = time.perf_counter()
+        with METRICS.context(table_name=table):
+            path, modified = fetch_with_retry(base_url + REFERENCE_TABLES[table]['path'], session, limit=limit,
+                                              fetch=fetch_cached)
+        return path, modified, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        futures = {executor.submit(fetch, table): table for table in tables}
+        for future in as_completed(futures):
+            table = futures[future]
+            path, modified, fetch_seconds = future.result()
+
+            start = time.perf_counter()
+            rows = process_reference(engine, table, path, force)
+            results[table] = {'modified': modified,
+                              'rows': rows,
+                              'fetch_seconds': fetch_seconds,
+                              'write_seconds': time.perf_counter() - start}
+            print('{:<22} {:<12} fetch {:6.2f}s ({}), write {:6.2f}s'.format(
+                table, 'skipped' if rows is None else '{:,} rows'.format(rows), fetch_seconds,
+                'modified' if modified else 'not modified', results[table]['write_seconds']))
+
+    return results
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Refresh the worldfood reference tables from the Open Food Facts API')
+    parser.add_argument('tables', nargs='*', help='tables to refresh: {} (default: all)'.format(', '.join(REFERENCE_TABLES)))
+    parser.add_argument('--conditional-cache-dir', default=CACHE_DIR, help='on-disk cache of the last responses, for conditional requests')
+    parser.add_argument('--force', action='store_true', help='rewrite tables even if their payload is unchanged')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    unknown = set(args.tables) - set(REFERENCE_TABLES)
+    if unknown:
+        parser.error('unknown reference tables: {}'.format(', '.join(sorted(unknown))))
+
+    configure_response_cache(args)
     engine=get_engine()
-    process_allergens_reference(engine)
-    print('Allergens processed')
-    process_ingredients_reference(engine)
-    print('Ingredients processed')
-    process_nutrients_reference(engine)
-    print('Nutrients processed')
-    process_brands_reference(engine)
-    print('Brands processed')
-    process_categories_reference(engine)
-    print('Categories processed')
+    start_run('api_reference_processing', engine, args)
+    try:
+        process_all_references(engine, args.tables, cache_dir=args.conditional_cache_dir, force=args.force)
+    finally:
+        finish_run(args)
     
     
 if __name__ == "__main__":
     main()       
-    
-    
-    
-    
-    
-    
-    
-    
-    
\ No newline at end of file
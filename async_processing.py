@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asyncio product page ingestion, an alternative to process_all_pages for
+PostgreSQL: pages are fetched with aiohttp (many requests in flight on one
+event loop), parsed in worker processes, and written in batches with asyncpg
+(COPY) on a small connection pool, while the next pages are fetched.
+Writes the same worldfood tables, with the same replace-by-key semantics, as
+process_page.
+
+Stopping (Ctrl-C or SIGTERM) cancels the fetches in flight; pages already
+parsed are still written.
+
+Needs the optional aiohttp and asyncpg packages.
+
+Usage:
+    python async_processing.py [--page 1 | --resume] [--concurrency 16] [--workers 4] [--pool-size 2] [--cache | --replay]
+"""
+
+
+#Import packages
+import argparse
+import asyncio
+import io
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from api_product_processing import (PAGE_URL, REPLACE_KEYS, WRITE_TABLES, get_error_tables, get_resume_page,
+                                    get_write_error_tables, prepare_tables)
+from bulk_load import COPY_NULL, _key_values, create_tables, drop_replaced_rows
+from db import SERVER_SETTINGS, get_engine
+from http_client import (BASE_URL, FETCH_RETRIES, RETRY_STATUSES, THROTTLE_STATUSES, AdaptiveLimit, CacheMissError,
+                         RateLimiter, add_cache_arguments, backoff_delay, configure_response_cache, get_response_cache,
+                         retry_after)
+from json_stream import loads
+from metrics import METRICS, add_metrics_arguments, finish_run, start_run
+from pipeline import parse_page
+
+
+
+#Function to fail early, with a clear error, when the async engine's optional
+#packages are not installed
+def check_async_packages():
+    if aiohttp is None or asyncpg is None:
+        raise ImportError('the async engine needs the aiohttp and asyncpg packages')
+
+
+#Function to get the asyncpg connection string of a SQLAlchemy PostgreSQL engine
+def get_asyncpg_dsn(engine):
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('the async engine writes with asyncpg and needs a PostgreSQL database, not {}'.format(engine.dialect.name))
+    return engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+#AdaptiveLimit for coroutines: the same limit on the requests in flight,
+#awaited on an asyncio condition instead of blocking a thread
+class AsyncAdaptiveLimit(AdaptiveLimit):
+
+    def __init__(self, max_limit, min_limit=1):
+        super().__init__(max_limit, min_limit)
+        self._async_condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._async_condition:
+            while True:
+                wait = self._wait_time()
+                if wait == 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._async_condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+            return self.decreases
+
+    async def release(self, decreases, throttled=False, pause=0.):
+        async with self._async_condition:
+            self._adapt(decreases, throttled, pause)
+            self._async_condition.notify_all()
+
+
+#Function to GET a url with aiohttp, retrying RETRY_STATUSES and connection
+#errors with jittered exponential backoff (or the server's Retry-After), as
+#http_client.fetch_with_retry. With an AsyncAdaptiveLimit, each attempt takes
+#one of its slots. Goes through the response cache set with set_response_cache,
+#if any
+async def fetch_content_async(url, session, rate_limiter=None, limit=None, retries=FETCH_RETRIES, backoff_factor=0.5):
+
+    cache = get_response_cache()
+    if cache is not None:
+        cached = cache.get(url)
+        if cached is not None:
+            return cached[1]
+        if cache.replay:
+            raise CacheMissError('{} is not in the response cache (replay only)'.format(url))
+
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            delay = rate_limiter.reserve(url)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        throttled, pause = False, 0.
+        if limit is not None:
+            decreases = await limit.acquire()
+        try:
+            async with session.get(url) as response:
+                throttled = response.status in THROTTLE_STATUSES
+                pause = retry_after(response) if throttled else 0.
+                if response.status not in RETRY_STATUSES or attempt == retries:
+                    response.raise_for_status()
+                    content = await response.read()
+                    break
+            delay = max(backoff_delay(attempt, backoff_factor), pause)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as error:
+            if attempt == retries:
+                error.attempts = attempt + 1
+                raise
+            delay = backoff_delay(attempt, backoff_factor)
+        except aiohttp.ClientResponseError as error:
+            error.attempts = attempt + 1
+            raise
+        finally:
+            if limit is not None:
+                await limit.release(decreases, throttled, pause)
+        await asyncio.sleep(delay)
+
+    METRICS.observe('fetch', time.perf_counter() - start, bytes=len(content), retries=attempt)
+    if cache is not None:
+        cache.put(url, response.status, response.headers, content)
+    return content
+
+
+#Function to get the rows of a DataFrame as a CSV buffer for COPY, in the
+#format of bulk_load.copy_insert (values typed by the server)
+def get_copy_buffer(df, dtype):
+    return io.BytesIO(df[list(dtype)].to_csv(header=False, index=False, na_rep=COPY_NULL).encode('utf-8'))
+
+
+#Function to write a set of DataFrames (table name -> DataFrame) in a single
+#transaction on an asyncpg connection: the async counterpart of
+#bulk_load.write_tables, with the same replace_keys semantics
+async def copy_tables(conn, tables, dtypes, replace_keys=None, schema='worldfood'):
+
+    replace_keys = replace_keys or {}
+    async with conn.transaction():
+
+        for table, (key_table, column) in replace_keys.items():
+            if len(tables.get(key_table, ())) > 0:
+                values = _key_values(tables[key_table][column])
+                with METRICS.timer('delete', table_name=table):
+                    await conn.execute('delete from {}.{} where {} = any($1::bigint[])'.format(schema, table, column), values)
+
+        for table, dtype in dtypes.items():
+            if len(tables.get(table, ())) > 0:
+                df = tables[table]
+                if replace_keys.get(table, (None,))[0] == table:
+                    df = df.drop_duplicates(subset=[replace_keys[table][1]], keep='last')
+                with METRICS.timer('write', table_name=table, rows=len(df)):
+                    buffer = await asyncio.to_thread(get_copy_buffer, df, dtype)
+                    await conn.copy_to_table(table, source=buffer, columns=list(dtype), schema_name=schema,
+                                             format='csv', null=COPY_NULL)
+
+
+#Function to concatenate a batch of pages' tables, without the rows a later
+#page replaces (see bulk_load.drop_replaced_rows)
+def _concat_batch(batch, dtypes):
+    batch = drop_replaced_rows(batch, REPLACE_KEYS)
+    return {table: pd.concat([tables[table] for tables in batch if len(tables.get(table, ())) > 0], ignore_index=True)
+            for table in dtypes if any(len(tables.get(table, ())) > 0 for tables in batch)}
+
+
+#Function to write a batch of pages' tables. The CPU-bound steps run in a thread,
+#off the event loop: dictionary encoding (on the sync engine; dimension keys are
+#cached, so it rarely queries) and CSV formatting. Rows are copied on a
+#pooled asyncpg connection. If the batch fails to write, its pages are written
+#one transaction each, and pages that fail again are logged as errors and
+#dead-lettered instead (as bulk_load.WriteBuffer)
+async def write_batch(engine, pool, batch, dtypes=WRITE_TABLES):
+    start = time.perf_counter()
+    tables = await asyncio.to_thread(_concat_batch, batch, dtypes)
+    rows = sum(len(df) for df in tables.values())
+
+    try:
+        with METRICS.timer('prepare'):
+            tables = await asyncio.to_thread(prepare_tables, engine, tables)
+        async with pool.acquire() as conn:
+            await copy_tables(conn, tables, dtypes, REPLACE_KEYS)
+    except Exception as error:
+        if len(batch) == 1:
+            tables = get_write_error_tables(batch[0], error)
+            async with pool.acquire() as conn:
+                await copy_tables(conn, tables, dtypes, REPLACE_KEYS)
+        else:
+            for tables in batch:
+                await write_batch(engine, pool, [tables], dtypes)
+        return
+    METRICS.observe('flush', time.perf_counter() - start, rows=rows)
+
+
+#Function to fetch and process the given product pages. Up to `concurrency`
+#requests are in flight and up to `prefetch` pages fetched or parsed ahead of
+#the writer; `batch_pages` pages are written per transaction, in page order,
+#on a pool of `pool_size` connections. One batch is written while the next is
+#fetched. Parsing runs in `workers` processes
+async def process_pages_async(engine, pages, concurrency=16, prefetch=None, rate_limit=None, base_url=BASE_URL,
+                              batch_pages=10, workers=None, pool_size=2):
+
+    check_async_packages()
+
+    create_tables(engine, WRITE_TABLES, REPLACE_KEYS)
+    rate_limiter = RateLimiter(rate_limit)
+    limit = AsyncAdaptiveLimit(concurrency)
+    loop = asyncio.get_running_loop()
+    fetched = asyncio.Queue(maxsize=concurrency + (concurrency if prefetch is None else prefetch))
+    cnt = 0
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency),
+                                         timeout=aiohttp.ClientTimeout(total=60)) as session, \
+                   asyncpg.create_pool(get_asyncpg_dsn(engine), min_size=1, max_size=pool_size,
+                                       server_settings=SERVER_SETTINGS) as pool:
+
+            #Pages that cannot be fetched or parsed are dead-lettered, and the crawl goes on
+            async def fetch_page(page):
+                try:
+                    content = await fetch_content_async(PAGE_URL.format(base_url, page), session, rate_limiter, limit)
+                except Exception as error:
+                    return get_error_tables(page, error, stage='fetch')
+                try:
+                    tables, seconds = await loop.run_in_executor(executor, parse_page, page, content)
+                except Exception as error:
+                    return get_error_tables(page, error, stage='parse')
+                METRICS.observe('parse', seconds, page=page)
+                return tables
+
+            #Fetches are started in page order, as the queue has room. Those
+            #not finished yet are kept in `fetches`, to be cancelled on exit
+            fetches = set()
+            async def produce():
+                for page in pages:
+                    fetch = asyncio.ensure_future(fetch_page(page))
+                    fetches.add(fetch)
+                    fetch.add_done_callback(fetches.discard)
+                    await fetched.put(fetch)
+                await fetched.put(None)
+
+            producer = asyncio.ensure_future(produce())
+            batch = []
+            writing = None
+            try:
+                while True:
+                    future = await fetched.get()
+                    if future is None:
+                        break
+                    batch.append(await future)
+                    if len(batch) >= batch_pages:
+                        #Batches are written one at a time, in order
+                        if writing is not None:
+                            await writing
+                        writing = asyncio.ensure_future(write_batch(engine, pool, batch))
+                        batch = []
+
+                    #Logging
+                    cnt += 1
+                    if np.mod(cnt,10) == 0:
+                        print(cnt)
+            finally:
+                #Stop fetching (queued or in flight), then write the pages 
+                #already parsed, even if cancelled or failing: the last batch
+                #is written (or dead-lettered) before an error of the batch
+                #being written is raised
+                producer.cancel()
+                for fetch in list(fetches):
+                    fetch.cancel()
+                try:
+                    if writing is not None:
+                        await asyncio.shield(writing)
+                finally:
+                    if batch:
+                        await asyncio.shield(write_batch(engine, pool, batch))
+
+    return cnt
+
+
+#Function to process all product pages (24 products per page), from page_num on
+async def process_all_pages_async(engine, page_num, base_url=BASE_URL, **kwargs):
+    check_async_packages()
+    async with aiohttp.ClientSession() as session:
+        all_food_products = loads(await fetch_content_async(PAGE_URL.format(base_url, 1), session))
+    num_pages = int(np.ceil(all_food_products['count']/24.))
+    return await process_pages_async(engine, range(page_num, num_pages+1), base_url=base_url, **kwargs)
+
+
+#Function to run a coroutine until it completes or SIGTERM/SIGINT cancels it
+async def run_cancellable(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        print('cancelled')
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', type=int, default=1, help='page to start processing at')
+    parser.add_argument('--resume', action='store_true', help='start after the last page in worldfood.logging')
+    parser.add_argument('--concurrency', type=int, default=16, help='page requests in flight')
+    parser.add_argument('--prefetch', type=int, default=None, help='fetched pages buffered ahead of the writer')
+    parser.add_argument('--rate-limit', type=float, default=None, help='max requests/sec to the API host')
+    parser.add_argument('--workers', type=int, default=None, help='parse processes (default: one per core)')
+    parser.add_argument('--pool-size', type=int, default=2, help='database connections')
+    parser.add_argument('--batch-pages', type=int, default=10, help='pages written per transaction')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    configure_response_cache(args)
+    engine=get_engine()
+    start_run('async_processing', engine, args)
+    try:
+        page_num=get_resume_page(engine) if args.resume else args.page
+        asyncio.run(run_cancellable(process_all_pages_async(
+            engine, page_num, concurrency=args.concurrency, prefetch=args.prefetch, rate_limit=args.rate_limit,
+            batch_pages=args.batch_pages, workers=args.workers, pool_size=args.pool_size)))
+    finally:
+        finish_run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1688 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks and parity checks for the worldfood processing scripts.
+
+Usage:
+    python benchmark.py flatten [page_fixture.json]
+    python benchmark.py fetch [--concurrency 1 4 16] [--pages 200] [--latency 0.05]
+    python benchmark.py load [--db-url postgresql://...] [--pages 100]
+    python benchmark.py batch [--db-url postgresql://...] [--pages 200] [--batch-pages 1 10 50]
+    python benchmark.py engine [--db-url postgresql://...] [--pages 500]
+    python benchmark.py delta [--db-url postgresql://...] [--products 24000] [--changed 500]
+    python benchmark.py dump [--db-url postgresql://...] [--products 2000000] [--gzip]
+    python benchmark.py pipeline [--db-url postgresql://...] [--pages 500] [--workers 1 2 4 8]
+    python benchmark.py nutrients-agg --db-url postgresql://... [--pages 2000]
+    python benchmark.py nutrients-engines [--db-url postgresql://...] [--products 200000]
+    python benchmark.py reference [--db-url postgresql://...] [--size 50000] [--latency 0.5]
+    python benchmark.py replay [--db-url postgresql://...] [--pages 500] [--latency 0.2]
+    python benchmark.py parquet [--db-url postgresql://...] [--pages 2000] [--buckets 16]
+    python benchmark.py tag-dims --db-url postgresql://... [--pages 5000]
+    python benchmark.py parse [--tags 300000] [--page-size 1000]
+    python benchmark.py metrics [--db-url postgresql://...] [--pages 500] [--latency 0.02]
+    python benchmark.py async --db-url postgresql://... [--pages 500] [--latency 0.05] [--concurrency 4 16 64]
+    python benchmark.py sharded --db-url postgresql://... [--pages 1000] [--latency 0.2] [--workers 1 2 4 8] [--kill-one]
+    python benchmark.py faults [--db-url postgresql://...] [--pages 500] [--capacity 8] [--fault-rates 0.05 0.2]
+    python benchmark.py suite [--db-url postgresql://...] [--pages 500] [--reference-size 20000] [--output results.json]
+    python benchmark.py compare baseline.json results.json [--threshold 0.1]
+
+Without --db-url, database benchmarks run against a local SQLite file with the
+worldfood schema attached.
+"""
+
+
+#Import packages
+import argparse
+import asyncio
+import functools
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+import requests
+import sqlalchemy as sa
+
+import api_product_processing as app
+import api_reference_processing
+import async_processing
+import columnar
+import data_processing
+import db
+import dump_processing
+import pipeline
+import sharded_crawl
+from bulk_load import _key_values, bulk_insert, create_key_index, forget_tables, get_insert_method, write_tables
+from http_client import ResponseCache, fetch_content, get_session
+from metrics import METRICS
+from stub_api import (SYNTHETIC_LAST_MODIFIED_T, StubHandler, make_synthetic_page, start_fault_stub, start_stub_server,
+                      synthetic_page_body)
+
+
+
+#Function to load a recorded page fixture (a saved .json?page=N response),
+#or a synthetic page if no fixture is given
+def load_page_fixture(path=None):
+    if path is None:
+        return make_synthetic_page()
+    with open(path, 'r') as stream:
+        return json.load(stream)
+
+
+#Reference implementation of the original per-product flattening in process_page,
+#used to check parity of flatten_page. (DataFrame.append is replaced by the
+#equivalent pd.concat so this also runs on current pandas)
+def legacy_flatten_page(all_food_products):
+
+    products = all_food_products['products']
+
+    products_df = pd.DataFrame()
+    ingredients_df = pd.DataFrame()
+    allergens_df = pd.DataFrame()
+    nutrients_df = pd.DataFrame()
+    brands_df = pd.DataFrame()
+    categories_df = pd.DataFrame()
+
+    for product in products:
+
+        if product['lang'] == 'en' and 'product_name' in product:
+
+            products_df = pd.concat([products_df, pd.DataFrame({'product_id': [product['id']],
+                                                                'product_name': [product['product_name']]})])
+
+            if 'ingredients' in product:
+                product_ingredients_df = pd.DataFrame(product['ingredients'])
+                product_ingredients_df['product_id'] = product['_id']
+                ingredients_df = pd.concat([ingredients_df, product_ingredients_df])
+
+            if 'allergens_tags' in product:
+                allergens_df = pd.concat([allergens_df, pd.DataFrame({'product_id': [product['_id']]*len(product['allergens_tags']),
+                                                                      'allergen_id': product['allergens_tags']})])
+
+            if 'nutriments' in product:
+                product_nutrient_df = pd.DataFrame([product['nutriments']])\
+                    .transpose()\
+                    .reset_index()\
+                    .rename(columns = {'index': 'nutrient_name', 0: 'nutrient_value'})
+                product_nutrient_df['product_id'] = product['_id']
+                nutrients_df = pd.concat([nutrients_df, product_nutrient_df])
+
+            if 'brands_tags' in product:
+                brands_df = pd.concat([brands_df, pd.DataFrame({'product_id': [product['_id']]*len(product['brands_tags']),
+                                                                'brand_id': product['brands_tags']})])
+
+            if 'categories_tags' in product:
+                categories_df = pd.concat([categories_df, pd.DataFrame({'product_id': [product['_id']]*len(product['categories_tags']),
+                                                                        'category_id': product['categories_tags']})])
+
+    if len(ingredients_df) > 0:
+        ingredients_df = ingredients_df[['product_id','id','text']]\
+            .rename(columns={'id':'ingredient_id', 'text': 'ingredient_name'})
+
+    return {'products': products_df,
+            'product_ingredients': ingredients_df,
+            'product_allergens': allergens_df,
+            'product_nutrients': nutrients_df,
+            'product_brands': brands_df,
+            'product_categories': categories_df}
+
+
+#Function to normalise a flattened table for comparison: values as they would
+#be stored in VARCHAR/BIGINT columns, missing values as None
+def _normalise_table(df, columns):
+    if len(df) == 0:
+        return []
+    df = df[columns].astype(object).where(df[columns].notnull(), None)
+    return [tuple(None if value is None else str(value) for value in row)
+            for row in df.itertuples(index=False)]
+
+
+#Function to normalise nutrient rows for comparison: (product_id, name, value)
+#with numeric values as floats. The original stored every value as text, the
+#flattener splits them into nutrient_value/nutrient_text
+def _normalise_nutrients(df):
+
+    def typed(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+
+    if len(df) == 0:
+        return []
+    if 'nutrient_text' in df:
+        values = df['nutrient_value'].astype(object).where(df['nutrient_value'].notnull(), df['nutrient_text'])
+    else:
+        values = df['nutrient_value']
+    return [(str(product_id), name, typed(value))
+            for product_id, name, value in zip(df['product_id'], df['nutrient_name'], values)]
+
+
+#Function to check that flatten_page produces the same rows as the original
+#per-product implementation
+def check_flatten_parity(all_food_products):
+
+    expected = legacy_flatten_page(all_food_products)
+    actual = app.flatten_page(all_food_products)
+
+    for table in app.PRODUCT_TABLES:
+        if table == 'product_nutrients':
+            expected_rows = _normalise_nutrients(expected[table])
+            actual_rows = _normalise_nutrients(actual[table])
+        else:
+            expected_rows = _normalise_table(expected[table], list(expected[table].columns))
+            actual_rows = _normalise_table(actual[table], list(expected[table].columns))
+        if expected_rows != actual_rows:
+            raise AssertionError('{} differs: {} expected rows, {} actual rows'.format(table, len(expected_rows), len(actual_rows)))
+
+    return True
+
+
+#Function to time a flattening function over a page, returning rows per second
+def _time_flatten(flatten, all_food_products, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        tables = flatten(all_food_products)
+    elapsed = time.perf_counter() - start
+    rows = sum(len(df) for df in tables.values())*repeat
+    return rows/elapsed
+
+
+#Micro-benchmark of page flattening on a recorded page fixture
+def benchmark_flatten(fixture_path=None, repeat=50):
+
+    all_food_products = load_page_fixture(fixture_path)
+    check_flatten_parity(all_food_products)
+
+    legacy_rate = _time_flatten(legacy_flatten_page, all_food_products, repeat)
+    columnar_rate = _time_flatten(app.flatten_page, all_food_products, repeat)
+
+    print('legacy   : {:,.0f} rows/sec'.format(legacy_rate))
+    print('columnar : {:,.0f} rows/sec ({:.1f}x)'.format(columnar_rate, columnar_rate/legacy_rate))
+
+    return {'legacy_rows_per_sec': legacy_rate, 'columnar_rows_per_sec': columnar_rate}
+
+
+#Benchmark of a crawl replayed from the response cache: pages are fetched from
+#the stub (with `latency`) and cached, then the same crawl is re-run with the 
+#stub shut down, in replay-only mode, so only parsing and loading are timed
+def benchmark_replay(db_url=None, pages=500, latency=0.2, concurrency=4):
+
+    engine = get_local_engine(db_url)
+    server, base_url = start_stub_server(count=pages*24, latency=latency)
+    cache_dir = tempfile.mkdtemp(prefix='worldfood_response_cache_')
+    results = {}
+
+    try:
+        for name, replay in [('record', False), ('replay', True)]:
+            if replay:
+                server.shutdown()
+            cache = ResponseCache(cache_dir, replay=replay)
+            session = get_session(pool_size=concurrency, cache=cache)
+            _drop_product_tables(engine)
+
+            start = time.perf_counter()
+            app.process_pages(engine, range(1, pages+1), concurrency, base_url=base_url, batch_pages=50, session=session)
+            results[name] = pages/(time.perf_counter() - start)
+            print('{:<6}: {:,.1f} pages/sec ({} cache hits, {} misses)'.format(name, results[name], cache.hits, cache.misses))
+    finally:
+        server.shutdown()
+
+    cache_bytes = sum(size for _, _, size in ResponseCache(cache_dir)._entries())
+    raw_bytes = sum(len(synthetic_page_body(page, 24, pages*24)) for page in range(1, pages+1))
+    print('cache: {:,.1f} MB on disk for {:,.1f} MB of responses'.format(cache_bytes/2**20, raw_bytes/2**20))
+    results['cache_bytes'] = cache_bytes
+    return results
+
+
+#Function to generate a synthetic reference payload (allergens.json, 
+#cgi/nutrients.pl, ...) with `size` entries, for a given version of the data
+@functools.lru_cache(maxsize=32)
+def synthetic_reference_body(path, size, version=0):
+    name = path.strip('/').split('.')[0].split('/')[-1]
+    if name == 'nutrients':
+        payload = {'nutrients': [{'id': 'nutrient-{}'.format(i), 'important': i % 2 == 0, 'display_in_edit_form': True,
+                                  'name': 'Nutrient {} v{}'.format(i, version), 'nutrients': []}
+                                 for i in range(min(size, 200))]}
+    else:
+        payload = {'count': size,
+                   'tags': [{'id': 'en:{}-{}'.format(name, i), 'known': 1, 'name': '{} {} v{}'.format(name, i, version),
+                             'products': (i*7919) % 10000, 'url': 'https://us.openfoodfacts.org/{}/{}'.format(name, i),
+                             'sameAs': 'https://www.wikidata.org/wiki/Q{}'.format(i)}
+                            for i in range(size)]}
+    return json.dumps(payload).encode('utf-8')
+
+
+#Stub handler for the reference endpoints, answering conditional requests with
+#304 Not Modified while the path's version (server.versions) is unchanged
+class ReferenceStubHandler(StubHandler):
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        version = self.server.versions.get(path, 0)
+        etag = '"{}-{}"'.format(path, version)
+        self.server.stopped.wait(self.server.latency)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = synthetic_reference_body(path, self.server.count, version)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+#Reference implementation of the original reference flattening: the whole
+#payload decoded, then framed and trimmed to the table's columns
+def legacy_reference_df(payload, table):
+    reference = api_reference_processing.REFERENCE_TABLES[table]
+    return pd.DataFrame(payload[reference['items']])[list(reference['columns'])].rename(columns=reference['columns'])
+
+
+#Benchmark of the reference refresh against a local stub: the original 
+#sequential fetch-and-replace of every table, then process_all_references on a
+#cold cache, with nothing changed, and with one table changed
+def benchmark_reference(db_url=None, size=50000, latency=0.5):
+
+    engine = get_local_engine(db_url)
+    server, base_url = start_stub_server(count=size, latency=latency, handler=ReferenceStubHandler)
+    server.versions = {}
+    cache_dir = tempfile.mkdtemp(prefix='worldfood_http_cache_')
+    results = {}
+
+    try:
+        start = time.perf_counter()
+        for table, reference in api_reference_processing.REFERENCE_TABLES.items():
+            reference_df = legacy_reference_df(requests.get(base_url + reference['path']).json(), table)
+            bulk_insert(reference_df, table, engine, dtype=reference['dtype'], if_exists='replace')
+        results['sequential'] = time.perf_counter() - start
+
+        runs = [('cold cache', None), ('unchanged', None), ('one changed', '/allergens.json')]
+        for name, changed_path in runs:
+            if changed_path:
+                server.versions[changed_path] = server.versions.get(changed_path, 0) + 1
+            start = time.perf_counter()
+            api_reference_processing.process_all_references(engine, base_url=base_url, cache_dir=cache_dir)
+            results[name] = time.perf_counter() - start
+
+        print()
+        for name, seconds in results.items():
+            print('{:<12}: {:.2f}s'.format(name, seconds))
+    finally:
+        server.shutdown()
+
+    return results
+
+
+#Function to run the stub API server until the process is terminated
+def _serve_stub(urls, count, latency, handler, warm_pages):
+    for page in range(1, warm_pages+1):
+        synthetic_page_body(page, 24, count)
+    server, base_url = start_stub_server(count, latency, handler)
+    urls.put(base_url)
+    threading.Event().wait()
+
+
+#Function to start the stub API server in a separate process, so it does not
+#compete with the code benchmarked for the GIL. Pages 1..warm_pages are
+#generated before it starts serving. Returns the process (call terminate()
+#when done) and the server's base url
+def start_stub_process(count=24000, latency=0.05, handler=StubHandler, warm_pages=0):
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_stub, args=(urls, count, latency, handler, warm_pages), daemon=True)
+    process.start()
+    return process, urls.get()
+
+
+#Benchmark of page fetching against the local stub at different concurrency levels
+def benchmark_fetch(concurrency_levels=(1, 2, 4, 8, 16), pages=200, latency=0.05):
+
+    server, base_url = start_stub_server(count=pages*24, latency=latency)
+    results = {}
+    try:
+        for concurrency in concurrency_levels:
+            start = time.perf_counter()
+            fetched = sum(1 for _ in app.fetch_pages(range(1, pages+1), concurrency, base_url=base_url))
+            rate = fetched/(time.perf_counter() - start)
+            results[concurrency] = rate
+            print('concurrency {:>3}: {:,.1f} pages/sec'.format(concurrency, rate))
+    finally:
+        server.shutdown()
+
+    return results
+
+
+#Function to get an engine for database benchmarks: the given url, or a local
+#SQLite database with a 'worldfood' schema attached. With pooled=False, a plain
+#engine without a connection pool or the shared session settings, as the
+#scripts used before db.create_engine
+def get_local_engine(db_url=None, pooled=True):
+
+    if db_url:
+        engine = db.create_engine(db_url) if pooled else sa.create_engine(db_url, poolclass=sa.pool.NullPool)
+        with engine.begin() as conn:
+            conn.execute(sa.text('create schema if not exists worldfood'))
+        return engine
+
+    directory = tempfile.mkdtemp(prefix='worldfood_bench_')
+    engine = sa.create_engine('sqlite:///' + os.path.join(directory, 'main.db'),
+                              **({} if pooled else {'poolclass': sa.pool.NullPool}))
+    worldfood_path = os.path.join(directory, 'worldfood.db')
+
+    @sa.event.listens_for(engine, 'connect')
+    def attach_worldfood(dbapi_conn, connection_record):
+        dbapi_conn.execute("attach database '{}' as worldfood".format(worldfood_path))
+
+    return engine
+
+
+#Function to drop the product tables so each benchmark run starts empty
+def _drop_product_tables(engine):
+    with engine.begin() as conn:
+        for table in app.WRITE_TABLES:
+            conn.execute(sa.text('drop table if exists worldfood.{}'.format(table)))
+    forget_tables(engine, list(app.WRITE_TABLES))
+
+
+#Benchmark of table writes: default DataFrame.to_sql INSERTs versus bulk_insert
+#(COPY on PostgreSQL, multi-row INSERT elsewhere)
+def benchmark_load(db_url=None, pages=100):
+
+    engine = get_local_engine(db_url)
+    tables = app.flatten_products(product for page in range(1, pages+1)
+                                  for product in make_synthetic_page(page)['products'])
+    tables = app.prepare_tables(engine, tables)
+    rows = sum(len(df) for df in tables.values())
+
+    def to_sql_default(df, name, con, dtype):
+        df.to_sql(name, con=con, schema='worldfood', index=False, if_exists='append', dtype=dtype)
+
+    results = {}
+    for label, write in [('to_sql', to_sql_default), ('bulk_insert', bulk_insert)]:
+        _drop_product_tables(engine)
+        start = time.perf_counter()
+        for table, dtype in app.PRODUCT_TABLES.items():
+            write(tables[table], table, engine, dtype=dtype)
+        results[label] = rows/(time.perf_counter() - start)
+        print('{:<12}: {:,.0f} rows/sec ({} dialect)'.format(label, results[label], engine.dialect.name))
+
+    return results
+
+
+#Benchmark of WriteBuffer batch sizes: total write throughput and flush latencies
+def benchmark_batch(db_url=None, pages=200, batch_sizes=(1, 5, 10, 25, 50)):
+
+    engine = get_local_engine(db_url)
+    page_tables = [app.get_page_tables(make_synthetic_page(page)) for page in range(1, pages+1)]
+
+    results = {}
+    for batch_pages in batch_sizes:
+        _drop_product_tables(engine)
+        start = time.perf_counter()
+        with app.get_write_buffer(engine, batch_pages) as buffer:
+            for tables in page_tables:
+                buffer.add(tables)
+        elapsed = time.perf_counter() - start
+
+        latencies = np.array(buffer.flush_latencies)
+        results[batch_pages] = {'pages_per_sec': pages/elapsed,
+                                'flush_p50': float(np.percentile(latencies, 50)),
+                                'flush_p95': float(np.percentile(latencies, 95)),
+                                'histogram': buffer.latency_histogram()}
+        print('batch {:>3} pages: {:,.1f} pages/sec, flush p50 {:.3f}s p95 {:.3f}s'.format(batch_pages,
+                                                                                           results[batch_pages]['pages_per_sec'],
+                                                                                           results[batch_pages]['flush_p50'],
+                                                                                           results[batch_pages]['flush_p95']))
+
+    return results
+
+
+#bulk_load.write_tables as it was before the shared database layer: every
+#insert goes through DataFrame.to_sql and every delete checks the table exists,
+#both reflecting the table, and deletes are chunked IN lists
+def legacy_write_tables(tables, engine, dtypes, replace_keys):
+
+    with engine.begin() as conn:
+        for table, (key_table, column) in replace_keys.items():
+            if len(tables.get(key_table, ())) > 0 and sa.inspect(conn).has_table(table, schema='worldfood'):
+                values = _key_values(tables[key_table][column])
+                statement = sa.text('delete from worldfood.{} where {} in :values'.format(table, column))\
+                    .bindparams(sa.bindparam('values', expanding=True))
+                for i in range(0, len(values), 1000):
+                    conn.execute(statement, {'values': values[i:i+1000]})
+
+        for table, dtype in dtypes.items():
+            if len(tables.get(table, ())) > 0:
+                key_table, column = replace_keys[table]
+                df = tables[table].drop_duplicates(subset=[column], keep='last') if key_table == table else tables[table]
+                method, chunksize = get_insert_method(conn, len(df.columns))
+                df.to_sql(table, con=conn, schema='worldfood', index=False, if_exists='append', dtype=dtype,
+                          method=method, chunksize=chunksize)
+                if (conn.engine.url, table) not in _legacy_key_indexes:
+                    create_key_index(conn, table, column)
+                    _legacy_key_indexes.add((conn.engine.url, table))
+
+_legacy_key_indexes = set()
+
+
+#Benchmark of the shared database layer: per-page write latency of the
+#previous write path (unpooled engine, to_sql) versus write_tables on an engine
+#from db.create_engine, with a check that both write the same rows; then the
+#time to read product_nutrients whole with pandas.read_sql versus streamed
+#with db.read_sql_chunks (server-side cursor), and the rows each holds at once
+def benchmark_engine(db_url=None, pages=500):
+
+    engines = {'before': get_local_engine(db_url, pooled=False), 'after': get_local_engine(db_url)}
+    page_tables = [app.prepare_tables(engines['after'], app.get_page_tables(make_synthetic_page(page, count=pages*24)))
+                   for page in range(1, pages+1)]
+
+    results = {}
+    contents = {}
+    for name, write in [('before', legacy_write_tables), ('after', write_tables)]:
+        engine = engines[name]
+        _drop_product_tables(engine)
+        _legacy_key_indexes.clear()
+        latencies = []
+        for tables in page_tables:
+            start = time.perf_counter()
+            write(tables, engine, app.WRITE_TABLES, app.REPLACE_KEYS)
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies)
+        results[name] = {'pages_per_sec': pages/latencies.sum(),
+                         'write_p50': float(np.percentile(latencies, 50)),
+                         'write_p95': float(np.percentile(latencies, 95))}
+        #The previous write path never creates dead_letters
+        contents[name] = _product_table_contents(engine, [table for table in app.WRITE_TABLES if table != 'dead_letters'])
+        print('{:<6} {:,.1f} pages/sec, write per page p50 {:.1f}ms p95 {:.1f}ms'.format(
+            name, results[name]['pages_per_sec'], results[name]['write_p50']*1000, results[name]['write_p95']*1000))
+
+    for table in contents['after']:
+        pd.testing.assert_frame_equal(contents['before'][table], contents['after'][table], check_dtype=False)
+    print('parity ok: same rows in {} tables'.format(len(contents['after'])))
+
+    query = 'select * from worldfood.product_nutrients'
+    for name, read in [('pandas.read_sql', lambda: [pd.read_sql(query, engines['before'])]),
+                       ('db.read_sql_chunks', lambda: db.read_sql_chunks(query, engines['after']))]:
+        start = time.perf_counter()
+        rows = held = 0
+        for df in read():
+            rows += len(df)
+            held = max(held, len(df))
+        results[name] = time.perf_counter() - start
+        print('{:<18} {:,} rows in {:.2f}s, at most {:,} rows held'.format(name, rows, results[name], held))
+
+    return results
+
+
+#Benchmark of delta ingestion against the local stub: a full load through the
+#delta path, then an incremental run after `changed` products were modified
+def benchmark_delta(db_url=None, products=24000, changed=500):
+
+    server, base_url = start_stub_server(count=products, latency=0.)
+    engine = get_local_engine(db_url)
+    _drop_product_tables(engine)
+    with engine.begin() as conn:
+        conn.execute(sa.text('drop table if exists worldfood.ingest_state'))
+
+    try:
+        #Seed the high-water mark as if everything but the most recent `changed`
+        #products had been ingested before
+        app.set_high_water_mark(engine, SYNTHETIC_LAST_MODIFIED_T - 60*changed)
+        start = time.perf_counter()
+        results = app.process_delta(engine, base_url=base_url)
+        results['seconds'] = time.perf_counter() - start
+        print('delta run took {:.2f}s'.format(results['seconds']))
+    finally:
+        server.shutdown()
+
+    return results
+
+
+#Function to write a synthetic JSONL dump of `products` products, streaming so
+#the file can be much larger than memory
+def write_synthetic_dump(path, products, compress=False):
+    page_size = 1000
+    with (gzip.open(path, 'wt', encoding='utf-8', compresslevel=1) if compress else open(path, 'w', encoding='utf-8')) as stream:
+        for page in range(1, products//page_size + 2):
+            for product in make_synthetic_page(page, page_size, count=products)['products']:
+                stream.write(json.dumps(product))
+                stream.write('\n')
+    return path
+
+
+#Benchmark of bulk-dump ingestion: products/sec and peak memory on a synthetic dump
+def benchmark_dump(db_url=None, products=2000000, compress=False, chunk_size=20000):
+
+    path = os.path.join(tempfile.mkdtemp(prefix='worldfood_dump_'), 'products.jsonl' + ('.gz' if compress else ''))
+    print('writing {:,} synthetic products to {}'.format(products, path))
+    write_synthetic_dump(path, products, compress)
+
+    engine = get_local_engine(db_url)
+    _drop_product_tables(engine)
+    return dump_processing.process_dump(engine, path, chunk_size)
+
+
+#Benchmark of the multi-process pipeline: products/sec by parse worker count,
+#on a local fixture corpus served by the stub (no network latency)
+def benchmark_pipeline(db_url=None, pages=500, worker_counts=(1, 2, 4, 8)):
+
+    server, base_url = start_stub_server(count=pages*24, latency=0.)
+    for page in range(1, pages+1):
+        synthetic_page_body(page, 24, pages*24)
+    engine = get_local_engine(db_url)
+
+    results = {}
+    try:
+        for workers in worker_counts:
+            _drop_product_tables(engine)
+            start = time.perf_counter()
+            pipeline.run_pipeline(engine, range(1, pages+1), workers=workers, concurrency=8,
+                                  base_url=base_url, batch_pages=50)
+            elapsed = time.perf_counter() - start
+            with engine.connect() as conn:
+                products = conn.execute(sa.text('select sum(products) from worldfood.logging')).scalar()
+            results[workers] = products/elapsed
+            print('{:>2} workers: {:,.0f} products/sec'.format(workers, results[workers]))
+    finally:
+        server.shutdown()
+
+    return results
+
+
+#nutrients_agg.sql as it was before product_nutrients was typed and encoded
+LEGACY_NUTRIENTS_AGG = """
+with cte as (
+	select 
+		p.product_id
+		,product_name
+		,pn.nutrient_name
+		,pn.nutrient_value
+		,PERCENT_RANK() over (partition by nutrient_name order by cast(nutrient_value as float)) nutrient_value_percentile
+		,case
+			when PERCENT_RANK() over (partition by nutrient_name order by cast(nutrient_value as float)) >= .9 then 'high'
+			when PERCENT_RANK() over (partition by nutrient_name order by cast(nutrient_value as float)) <= .1 then 'low'
+			else null end nutrient_indicator
+	from 
+		worldfood.product_nutrients_varchar pn 
+	join 
+		worldfood.products p on pn.product_id=p.product_id
+	where 
+		pn.nutrient_name in ('carbohydrates_serving','proteins_serving','energy-kcal_serving')
+)
+select
+	product_id
+	,product_name
+	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value else null end) carbs_per_serving
+	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value_percentile else null end) carbs_per_serving_percentile
+	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_indicator else null end) carbs_per_serving_indicator
+	,max(case when nutrient_name = 'proteins_serving' then nutrient_value else null end) protein_per_serving
+	,max(case when nutrient_name = 'proteins_serving' then nutrient_value_percentile else null end) protein_per_serving_percentile
+	,max(case when nutrient_name = 'proteins_serving' then nutrient_indicator else null end) protein_per_serving_indicator
+	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value else null end) calories_per_serving
+	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value_percentile else null end) calories_per_serving_percentile
+	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_indicator else null end) calories_per_serving_indicator
+from
+	cte
+group by
+	product_id
+	,product_name
+"""
+
+
+#nutrients_agg.sql as it was before the single-scan rewrite: PERCENT_RANK
+#evaluated three times per row, products joined before the pivot
+PREVIOUS_NUTRIENTS_AGG = """
+with cte as (
+	select 
+		p.product_id
+		,product_name
+		,nd.nutrient_name
+		,pn.nutrient_value
+		,PERCENT_RANK() over (partition by pn.nutrient_key order by pn.nutrient_value) nutrient_value_percentile
+		,case
+			when PERCENT_RANK() over (partition by pn.nutrient_key order by pn.nutrient_value) >= .9 then 'high'
+			when PERCENT_RANK() over (partition by pn.nutrient_key order by pn.nutrient_value) <= .1 then 'low'
+			else null end nutrient_indicator
+	from 
+		worldfood.product_nutrients pn 
+	join 
+		worldfood.nutrients_dim nd on pn.nutrient_key=nd.nutrient_key
+	join 
+		worldfood.products p on pn.product_id=p.product_id
+	where 
+		nd.nutrient_name in ('carbohydrates_serving','proteins_serving','energy-kcal_serving')
+		and pn.nutrient_value is not null
+)
+select
+	product_id
+	,product_name
+	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value else null end) carbs_per_serving
+	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_value_percentile else null end) carbs_per_serving_percentile
+	,max(case when nutrient_name = 'carbohydrates_serving' then nutrient_indicator else null end) carbs_per_serving_indicator
+	,max(case when nutrient_name = 'proteins_serving' then nutrient_value else null end) protein_per_serving
+	,max(case when nutrient_name = 'proteins_serving' then nutrient_value_percentile else null end) protein_per_serving_percentile
+	,max(case when nutrient_name = 'proteins_serving' then nutrient_indicator else null end) protein_per_serving_indicator
+	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value else null end) calories_per_serving
+	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_value_percentile else null end) calories_per_serving_percentile
+	,max(case when nutrient_name = 'energy-kcal_serving' then nutrient_indicator else null end) calories_per_serving_indicator
+from
+	cte
+group by
+	product_id
+	,product_name
+"""
+
+
+#Default thresholds bound into SQL/nutrients_agg.sql
+NUTRIENTS_AGG_PARAMS = {'high_threshold': data_processing.HIGH_THRESHOLD,
+                        'low_threshold': data_processing.LOW_THRESHOLD}
+
+
+#Function to time a query, best of `repeat` runs, returning (seconds, row count)
+def _time_query(engine, query, repeat=3, params=None):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with engine.connect() as conn:
+            rows = len(conn.execute(sa.text(query), params or {}).fetchall())
+        timings.append(time.perf_counter() - start)
+    return min(timings), rows
+
+
+#Benchmark of the typed product_nutrients migration (PostgreSQL): loads synthetic
+#products with VARCHAR nutrient values, runs SQL/migrations/001_typed_product_nutrients.sql,
+#then compares table size and nutrients_agg query time before and after
+def benchmark_nutrients_agg(db_url, pages=2000):
+
+    engine = get_local_engine(db_url)
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('nutrients-agg benchmark needs a PostgreSQL --db-url (the migration is PostgreSQL SQL)')
+
+    _drop_product_tables(engine)
+    with engine.begin() as conn:
+        conn.execute(sa.text('drop table if exists worldfood.product_nutrients_varchar'))
+        conn.execute(sa.text('drop table if exists worldfood.nutrients_dim'))
+    app.NUTRIENT_DICTIONARY._keys.clear()
+    app.NUTRIENT_DICTIONARY._created.clear()
+
+    #Load the pre-migration layout
+    for first_page in range(1, pages+1, 500):
+        tables = app.flatten_products(product for page in range(first_page, min(first_page+500, pages+1))
+                                      for product in make_synthetic_page(page)['products'])
+        nutrients_df = tables['product_nutrients']
+        legacy_df = pd.DataFrame({'nutrient_name': nutrients_df['nutrient_name'],
+                                  'nutrient_value': nutrients_df['nutrient_value'].map('{:g}'.format, na_action='ignore')
+                                                    .fillna(nutrients_df['nutrient_text']),
+                                  'product_id': nutrients_df['product_id']})
+        bulk_insert(tables['products'], 'products', engine, dtype=app.PRODUCT_TABLES['products'])
+        bulk_insert(legacy_df, 'product_nutrients', engine,
+                    dtype={'nutrient_name': sa.types.VARCHAR(length=255),
+                           'nutrient_value': sa.types.VARCHAR(length=255),
+                           'product_id': sa.types.BIGINT()})
+
+    with engine.begin() as conn:
+        conn.execute(sa.text('create index product_nutrients_product_id_idx on worldfood.product_nutrients (product_id)'))
+        conn.execute(sa.text('analyze worldfood.products'))
+        conn.execute(sa.text('analyze worldfood.product_nutrients'))
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        conn.exec_driver_sql(open('SQL/migrations/001_typed_product_nutrients.sql').read().replace('%', '%%'))
+    print('migration: {:.1f}s'.format(time.perf_counter() - start))
+
+    size_query = "select pg_table_size('worldfood.{0}'), pg_indexes_size('worldfood.{0}')"
+    with engine.connect() as conn:
+        before_size = conn.execute(sa.text(size_query.format('product_nutrients_varchar'))).fetchone()
+        after_size = conn.execute(sa.text(size_query.format('product_nutrients'))).fetchone()
+
+    before_time, before_rows = _time_query(engine, LEGACY_NUTRIENTS_AGG)
+    after_time, after_rows = _time_query(engine, open('SQL/nutrients_agg.sql').read(), params=NUTRIENTS_AGG_PARAMS)
+
+    print('table           : {:,.1f} MB -> {:,.1f} MB'.format(before_size[0]/2**20, after_size[0]/2**20))
+    print('indexes         : {:,.1f} MB -> {:,.1f} MB (after adds the nutrient_key index)'.format(before_size[1]/2**20, after_size[1]/2**20))
+    print('nutrients_agg   : {:.2f}s ({:,} rows) -> {:.2f}s ({:,} rows)'.format(before_time, before_rows, after_time, after_rows))
+
+    return {'table_bytes_before': before_size[0], 'table_bytes_after': after_size[0],
+            'index_bytes_before': before_size[1], 'index_bytes_after': after_size[1],
+            'query_seconds_before': before_time, 'query_seconds_after': after_time}
+
+
+#Function to load `products` synthetic products with about 25 numeric nutrient
+#rows each straight into products/product_nutrients, without going through the
+#flattener. Values have two decimals, so percentile ranks include ties
+def _load_synthetic_nutrients(engine, products, seed=0, chunk_size=100000):
+
+    rng = np.random.default_rng(seed)
+    nutrient_names = ['{}{}'.format(nutrient, suffix) 
+                      for nutrient in ['carbohydrates', 'proteins', 'energy-kcal', 'fat', 'sugars',
+                                       'salt', 'sodium', 'fiber', 'saturated-fat']
+                      for suffix in ['', '_100g', '_serving', '_value']]
+    nutrient_keys = app.NUTRIENT_DICTIONARY.encode(engine, pd.Series(nutrient_names)).to_numpy(dtype='int64')
+
+    rows = 0
+    for first in range(0, products, chunk_size):
+        product_ids = 10**12 + np.arange(first, min(first + chunk_size, products))
+        bulk_insert(pd.DataFrame({'product_id': product_ids,
+                                  'product_name': ['Product {}'.format(product_id) for product_id in product_ids]}),
+                    'products', engine, dtype=app.PRODUCT_TABLES['products'])
+
+        present = rng.random((len(product_ids), len(nutrient_keys))) < .7
+        product_index, nutrient_index = np.nonzero(present)
+        nutrients_df = pd.DataFrame({'product_id': product_ids[product_index],
+                                     'nutrient_key': nutrient_keys[nutrient_index],
+                                     'nutrient_value': np.round(rng.uniform(0, 100, len(product_index)), 2),
+                                     'nutrient_text': None})
+        bulk_insert(nutrients_df, 'product_nutrients', engine, dtype=app.PRODUCT_TABLES['product_nutrients'])
+        rows += len(nutrients_df)
+
+    return rows
+
+
+#Function to check a nutrients aggregate against a reference one, matching rows
+#on product_id
+def _check_nutrients_agg(expected, actual, name):
+
+    expected = expected.sort_values('product_id').reset_index(drop=True)
+    actual = actual[list(expected.columns)].sort_values('product_id').reset_index(drop=True)
+    if len(expected) != len(actual) or not (expected['product_id'].to_numpy() == actual['product_id'].to_numpy()).all():
+        raise AssertionError('{}: {:,} rows, expected {:,}'.format(name, len(actual), len(expected)))
+
+    for column in expected.columns:
+        if column == 'product_name' or column.endswith('_indicator'):
+            same = expected[column].fillna('').astype(str).str.strip() == actual[column].fillna('').astype(str).str.strip()
+        else:
+            same = np.isclose(expected[column].astype(float), actual[column].astype(float), rtol=0, atol=1e-12, equal_nan=True)
+        if not np.all(same):
+            raise AssertionError('{}: {} differs in {:,} rows'.format(name, column, int((~np.asarray(same)).sum())))
+
+
+#Benchmark of the nutrients aggregate engines on millions of nutrient rows: the
+#previous nutrients_agg.sql (three PERCENT_RANKs per row), the single-scan 
+#SQL/nutrients_agg.sql and the pandas/NumPy compute_nutrients_agg. Both engines
+#are checked against the previous query's results
+def benchmark_nutrients_engines(db_url=None, products=200000, repeat=3):
+
+    engine = get_local_engine(db_url)
+    _drop_product_tables(engine)
+    with engine.begin() as conn:
+        conn.execute(sa.text('drop table if exists worldfood.nutrients_dim'))
+    app.NUTRIENT_DICTIONARY._keys.clear()
+    app.NUTRIENT_DICTIONARY._created.clear()
+
+    start = time.perf_counter()
+    rows = _load_synthetic_nutrients(engine, products)
+    print('loaded {:,} products, {:,} nutrient rows in {:.1f}s'.format(products, rows, time.perf_counter() - start))
+    with engine.begin() as conn:
+        create_key_index(conn, 'products', 'product_id')
+        create_key_index(conn, 'product_nutrients', 'product_id')
+    data_processing.create_nutrient_key_index(engine)
+
+    engines = {'previous sql': lambda: pd.read_sql(sa.text(PREVIOUS_NUTRIENTS_AGG), engine),
+               'single-scan sql': lambda: pd.read_sql(sa.text(open('SQL/nutrients_agg.sql').read()), engine,
+                                                      params=NUTRIENTS_AGG_PARAMS),
+               'numpy': lambda: data_processing.compute_nutrients_agg(engine)}
+
+    results = {}
+    outputs = {}
+    for name, compute in engines.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs[name] = compute()
+            timings.append(time.perf_counter() - start)
+        results[name] = min(timings)
+        print('{:<16}: {:.2f}s ({:,} rows)'.format(name, results[name], len(outputs[name])))
+
+    for name in ['single-scan sql', 'numpy']:
+        _check_nutrients_agg(outputs['previous sql'], outputs[name], name)
+    print('parity: ok')
+
+    return results
+
+
+#Product tag tables as they were before tags were dictionary-encoded
+LEGACY_TAG_DTYPES = {'product_ingredients': {'product_id': sa.types.BIGINT(),
+                                             'ingredient_id': sa.types.VARCHAR(length=255),
+                                             'ingredient_name': sa.types.VARCHAR(length=255)},
+                     'product_allergens': {'product_id': sa.types.BIGINT(),
+                                           'allergen_id': sa.types.VARCHAR(length=255)},
+                     'product_brands': {'product_id': sa.types.BIGINT(),
+                                        'brand_id': sa.types.VARCHAR(length=255)},
+                     'product_categories': {'product_id': sa.types.BIGINT(),
+                                            'category_id': sa.types.VARCHAR(length=255)}}
+
+#Group-by queries on string tags (the migrated *_varchar tables, with the
+#aggregates as they were before the migration) and their integer key versions
+TAG_QUERIES = {'allergens_agg': ("""
+select 
+	a.allergen_id
+	,ar.allergen_name
+	,count(distinct a.product_id) num_products
+	,count(distinct a.product_id)*1.0/(select count(distinct product_id) from worldfood.products) pct_products
+from 
+	worldfood.product_allergens_varchar a
+left join
+	worldfood.allergens_reference ar on a.allergen_id=ar.allergen_id
+group by 
+	a.allergen_id
+	,ar.allergen_name
+order by 
+	count(*) desc
+""", open('SQL/allergens_agg.sql').read()),
+               'ingredients_agg': ("""
+select 
+	ingredient_id
+	,ingredient_name
+	,count(distinct product_id) num_products
+	,count(distinct product_id)*1.0/(select count(distinct product_id) from worldfood.products) pct_products
+from 
+	worldfood.product_ingredients_varchar
+group by 
+	ingredient_id
+	,ingredient_name
+order by 
+	count(*) desc
+""", open('SQL/ingredients_agg.sql').read()),
+               'products per brand': ('select brand_id, count(distinct product_id) from worldfood.product_brands_varchar group by brand_id',
+                                      'select brand_key, count(distinct product_id) from worldfood.product_brands group by brand_key'),
+               'products per category': ('select category_id, count(distinct product_id) from worldfood.product_categories_varchar group by category_id',
+                                         'select category_key, count(distinct product_id) from worldfood.product_categories group by category_key')}
+
+
+#Function to get the total size of the files under a directory
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+#Benchmark of the Parquet path: loads `pages` synthetic pages (and an allergens
+#reference covering half the allergens), then times the three aggregates
+#computed by the database with the SQL files, the Parquet export, and the same
+#aggregates computed from the files with DuckDB, checking both give the same rows
+def benchmark_parquet(db_url=None, pages=2000, buckets=columnar.PRODUCT_BUCKETS):
+
+    engine = get_local_engine(db_url)
+    _drop_product_tables(engine)
+    for first_page in range(1, pages+1, 250):
+        tables = app.flatten_products(product for page in range(first_page, min(first_page+250, pages+1))
+                                      for product in make_synthetic_page(page, count=pages*24)['products'])
+        write_tables(app.prepare_tables(engine, tables), engine, app.PRODUCT_TABLES, app.REPLACE_KEYS)
+
+    allergens = sorted(app.ALLERGEN_DICTIONARY.keys(engine))[::2]
+    reference_dtype = api_reference_processing.REFERENCE_TABLES['allergens_reference']['dtype']
+    reference_df = pd.DataFrame({'allergen_id': allergens, 'allergen_name': [tag.split(':')[-1].title() for tag in allergens]},
+                                columns=list(reference_dtype))
+    bulk_insert(reference_df, 'allergens_reference', engine, dtype=reference_dtype, if_exists='replace')
+
+    results = {}
+    sql_aggs = {}
+    for table, (dtype, query_path) in data_processing.AGGREGATES.items():
+        start = time.perf_counter()
+        sql_aggs[table] = db.read_sql(sa.text(open(query_path).read()), engine, params=NUTRIENTS_AGG_PARAMS
+                                      if table == 'nutrients_agg' else None)
+        results[(table, 'sql')] = time.perf_counter() - start
+
+    directory = tempfile.mkdtemp(prefix='worldfood_parquet_')
+    start = time.perf_counter()
+    rows = data_processing.export_parquet(engine, directory, buckets)
+    results['export'] = time.perf_counter() - start
+    print('exported {:,} rows in {:.2f}s: {:,.1f} MB of Parquet'.format(sum(rows.values()), results['export'],
+                                                                      _directory_size(directory)/2**20))
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            size = sum(conn.execute(sa.text("select pg_total_relation_size('worldfood.{}')".format(table))).scalar()
+                       for table in rows)
+        print('same tables in PostgreSQL: {:,.1f} MB (with indexes)'.format(size/2**20))
+
+    conn = columnar.connect_parquet(directory, data_processing.PARQUET_TABLES)
+    for table, (dtype, query_path) in data_processing.AGGREGATES.items():
+        start = time.perf_counter()
+        parquet_agg = data_processing.query_agg_parquet(conn, table)
+        results[(table, 'parquet')] = time.perf_counter() - start
+
+        columns = list(dtype)
+        expected = sql_aggs[table][columns].sort_values(columns, na_position='first').reset_index(drop=True)
+        actual = parquet_agg[columns].sort_values(columns, na_position='first').reset_index(drop=True)
+        pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+        print('{:<16}: {:,} rows, {} {:.3f}s -> DuckDB on Parquet {:.3f}s'.format(
+            table, len(actual), engine.dialect.name, results[(table, 'sql')], results[(table, 'parquet')]))
+    conn.close()
+    print('parity: ok')
+
+    return results
+
+
+#Benchmark of the tag dimension migration (PostgreSQL): loads synthetic products
+#with VARCHAR tag columns, runs SQL/migrations/003_tag_dimensions.sql, then 
+#compares table sizes and group-by times on string tags versus integer keys,
+#checking that the aggregates are unchanged
+def benchmark_tag_dims(db_url, pages=5000):
+
+    engine = get_local_engine(db_url)
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('tag-dims benchmark needs a PostgreSQL --db-url (the migration is PostgreSQL SQL)')
+
+    _drop_product_tables(engine)
+    with engine.begin() as conn:
+        for table in LEGACY_TAG_DTYPES:
+            conn.execute(sa.text('drop table if exists worldfood.{}_varchar'.format(table)))
+        for _, dictionary in app.TAG_DICTIONARIES.values():
+            conn.execute(sa.text('drop table if exists worldfood.{}'.format(dictionary.table)))
+            dictionary._keys.clear()
+            dictionary._created.clear()
+
+    #Load the pre-migration layout, and reference tables covering part of the tags
+    tags = {table: set() for table in LEGACY_TAG_DTYPES}
+    for first_page in range(1, pages+1, 500):
+        tables = app.flatten_products(product for page in range(first_page, min(first_page+500, pages+1))
+                                      for product in make_synthetic_page(page)['products'])
+        bulk_insert(tables['products'], 'products', engine, dtype={'product_id': sa.types.BIGINT(),
+                                                                   'product_name': sa.types.VARCHAR(length=255)})
+        for table, dtype in LEGACY_TAG_DTYPES.items():
+            bulk_insert(tables[table], table, engine, dtype=dtype)
+            tags[table].update(tables[table][list(dtype)[1]].dropna())
+
+    for table, reference in [('product_ingredients', 'ingredients_reference'), ('product_allergens', 'allergens_reference'),
+                             ('product_brands', 'brands_reference'), ('product_categories', 'categories_reference')]:
+        tag_column = list(LEGACY_TAG_DTYPES[table])[1]
+        name_column = tag_column.replace('_id', '_name')
+        known = sorted(tags[table])[::2]
+        bulk_insert(pd.DataFrame({tag_column: known, name_column: [tag.split(':')[-1].title() for tag in known]}),
+                    reference, engine, if_exists='replace')
+
+    with engine.begin() as conn:
+        for table in ['products'] + list(LEGACY_TAG_DTYPES):
+            create_key_index(conn, table, 'product_id')
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        conn.exec_driver_sql(open('SQL/migrations/003_tag_dimensions.sql').read().replace('%', '%%'))
+    print('migration: {:.1f}s'.format(time.perf_counter() - start))
+
+    results = {}
+    size_query = "select pg_table_size('worldfood.{0}'), pg_indexes_size('worldfood.{0}')"
+    with engine.connect() as conn:
+        for table in LEGACY_TAG_DTYPES:
+            before = conn.execute(sa.text(size_query.format(table + '_varchar'))).fetchone()
+            after = conn.execute(sa.text(size_query.format(table))).fetchone()
+            results[table] = {'bytes_before': before[0] + before[1], 'bytes_after': after[0] + after[1]}
+            print('{:<22}: {:,.1f} MB -> {:,.1f} MB (table + indexes)'.format(table, results[table]['bytes_before']/2**20,
+                                                                            results[table]['bytes_after']/2**20))
+
+    for name, (string_query, key_query) in TAG_QUERIES.items():
+        string_time, string_rows = _time_query(engine, string_query)
+        key_time, key_rows = _time_query(engine, key_query)
+        results[name] = {'seconds_before': string_time, 'seconds_after': key_time}
+        print('{:<22}: {:.3f}s ({:,} rows) -> {:.3f}s ({:,} rows)'.format(name, string_time, string_rows, key_time, key_rows))
+
+    for name in ['allergens_agg', 'ingredients_agg']:
+        string_query, key_query = TAG_QUERIES[name]
+        keys = list(pd.read_sql(sa.text(string_query), engine).columns[:2])
+        expected = pd.read_sql(sa.text(string_query), engine).sort_values(keys, na_position='first').reset_index(drop=True)
+        actual = pd.read_sql(sa.text(key_query), engine).sort_values(keys, na_position='first').reset_index(drop=True)
+        pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+    print('parity: ok')
+
+    return results
+
+
+#Function to get this process's peak RSS in MB. VmHWM is read where available:
+#unlike ru_maxrss, it is not carried over from the parent across exec
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as stream:
+            for line in stream:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024.
+    except OSError:
+        pass
+    return dump_processing.get_peak_memory_mb()
+
+
+#Function to parse a payload file one way, in a fresh process (see 
+#benchmark_parse). Returns (seconds, peak RSS growth in MB, rows)
+def _measure_parse(method, path, table):
+
+    import json_stream
+    if method.endswith('(stdlib)'):
+        json_stream.ijson = None
+        json_stream.loads = json.loads
+    if not method.startswith('stream'):
+        loads = json.loads if method.endswith('(stdlib)') else json_stream.loads
+
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    if table == 'page':
+        with open(path, 'rb') as stream:
+            content = stream.read()
+        if method.startswith('stream'):
+            tables = app.parse_page_tables(1, content)
+        else:
+            tables = app.get_page_tables(loads(content))
+        rows = sum(len(df) for df in tables.values())
+    else:
+        if method.startswith('stream'):
+            df = api_reference_processing.read_reference_df(table, path)
+        else:
+            with open(path, 'rb') as stream:
+                df = legacy_reference_df(loads(stream.read()), table)
+        rows = len(df)
+    return time.perf_counter() - start, _peak_rss_mb() - baseline, rows
+
+
+#Benchmark of page and reference payload parsing: peak RSS and parse time of
+#decoding the whole document (json or, if installed, orjson) versus parsing it
+#incrementally (ijson if installed, or the standard library). Each run is in
+#a fresh process, so peaks do not carry over
+def benchmark_parse(tags=300000, page_size=1000):
+
+    directory = tempfile.mkdtemp(prefix='worldfood_parse_')
+    payloads = {'brands_reference': os.path.join(directory, 'brands.json'),
+                'page': os.path.join(directory, 'page.json')}
+    with open(payloads['brands_reference'], 'wb') as stream:
+        stream.write(synthetic_reference_body('/brands.json', tags))
+    with open(payloads['page'], 'wb') as stream:
+        stream.write(json.dumps(make_synthetic_page(1, page_size=page_size, count=page_size)).encode('utf-8'))
+
+    import json_stream
+    methods = ['full decode (stdlib)', 'stream (stdlib)']
+    if json_stream.orjson is not None:
+        methods.insert(1, 'full decode (orjson)')
+    if json_stream.ijson is not None:
+        methods.append('stream (ijson)')
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for table, path in payloads.items():
+        print('{} ({:,.1f} MB)'.format(table, os.path.getsize(path)/2**20))
+        for method in methods:
+            with context.Pool(1) as pool:
+                seconds, peak_mb, rows = pool.apply(_measure_parse, (method, path, table))
+            results[(table, method)] = {'seconds': seconds, 'peak_rss_mb': peak_mb}
+            print('  {:<22}: {:6.2f}s, peak RSS +{:7,.1f} MB ({:,} rows)'.format(method, seconds, peak_mb, rows))
+
+    return results
+
+
+#Benchmark of the instrumentation: a crawl of the stub with metrics off and on
+#(overhead), then the per-stage report, the rows recorded in worldfood.metrics
+#and the Prometheus text export
+def benchmark_metrics(db_url=None, pages=500, latency=0.02, concurrency=4):
+
+    engine = get_local_engine(db_url)
+    server, base_url = start_stub_server(count=pages*24, latency=latency)
+    results = {}
+
+    try:
+        for name in ['metrics off', 'metrics on']:
+            if name == 'metrics on':
+                METRICS.start_run('benchmark', engine)
+            _drop_product_tables(engine)
+
+            start = time.perf_counter()
+            app.process_pages(engine, range(1, pages+1), concurrency, base_url=base_url, batch_pages=25)
+            METRICS.save()
+            results[name] = pages/(time.perf_counter() - start)
+            print('{:<11}: {:,.1f} pages/sec'.format(name, results[name]))
+    finally:
+        server.shutdown()
+
+    print('overhead: {:+.1%}'.format(results['metrics off']/results['metrics on'] - 1))
+    METRICS.report()
+    with engine.connect() as conn:
+        print('{:,} rows in worldfood.metrics for run {}'.format(
+            conn.execute(sa.text('select count(*) from worldfood.metrics where run_id = :run_id'),
+                         {'run_id': METRICS.run_id}).scalar(), METRICS.run_id))
+
+    path = os.path.join(tempfile.mkdtemp(prefix='worldfood_metrics_'), 'worldfood.prom')
+    METRICS.write_prometheus(path)
+    with open(path) as stream:
+        print(stream.read())
+    return results
+
+
+#Function to get the contents of the product tables (and logging), sorted, for
+#comparing two loads
+def _product_table_contents(engine, tables=app.WRITE_TABLES):
+    contents = {}
+    with engine.connect() as conn:
+        for table in tables:
+            df = pd.read_sql(sa.text('select * from worldfood.{}'.format(table)), conn)
+            df = df.drop(columns=['ingested_at'], errors='ignore')
+            contents[table] = df.sort_values(list(df.columns)).reset_index(drop=True)
+    return contents
+
+
+#Benchmark of the asyncio engine (PostgreSQL) against the sync crawl on the
+#local stub (in its own process) with `latency`: pages/sec of process_pages and
+#process_pages_async at each concurrency level, and a check that both write
+#the same rows
+def benchmark_async(db_url, pages=500, latency=0.05, concurrency_levels=(4, 16, 64), workers=4):
+
+    engine = get_local_engine(db_url)
+    server, base_url = start_stub_process(count=pages*24, latency=latency)
+    results = {}
+
+    try:
+        #Warm up the stub's page bodies
+        list(app.fetch_pages(range(1, pages+1), 16, base_url=base_url, fetch=fetch_content))
+
+        for concurrency in concurrency_levels:
+            contents = {}
+            for name in ['sync', 'async']:
+                _drop_product_tables(engine)
+                start = time.perf_counter()
+                if name == 'sync':
+                    app.process_pages(engine, range(1, pages+1), concurrency, base_url=base_url, batch_pages=50)
+                else:
+                    asyncio.run(async_processing.process_pages_async(engine, range(1, pages+1), concurrency,
+                                                                     base_url=base_url, batch_pages=50, workers=workers))
+                results[(name, concurrency)] = pages/(time.perf_counter() - start)
+                contents[name] = _product_table_contents(engine)
+
+            for table in app.WRITE_TABLES:
+                pd.testing.assert_frame_equal(contents['sync'][table], contents['async'][table], check_dtype=False)
+    finally:
+        server.terminate()
+
+    print('parity ok: same rows in {} tables at every concurrency level'.format(len(app.WRITE_TABLES)))
+    print('{:>11} {:>10} {:>10}'.format('concurrency', 'sync', 'async'))
+    for concurrency in concurrency_levels:
+        print('{:>11} {:>10,.1f} {:>10,.1f}  pages/sec'.format(concurrency, results[('sync', concurrency)],
+                                                              results[('async', concurrency)]))
+    return results
+
+
+#Function to run a sharded crawl worker in its own process, on its own engine
+def _run_sharded_worker(db_url, crawl_id, base_url, concurrency, lease_timeout):
+    sharded_crawl.run_worker(db.create_engine(db_url), crawl_id, concurrency, base_url=base_url, batch_pages=25,
+                             lease_timeout=lease_timeout, poll_interval=min(1., lease_timeout/3.))
+
+
+#Benchmark of the sharded crawl (PostgreSQL): pages/sec by number of worker
+#processes, each with `concurrency` requests in flight to its own stub process
+#(with `latency`), and a check that every lease is done and every page logged.
+#With `kill_one`, the first worker is killed mid-crawl and its lease reclaimed
+#once it expires
+def benchmark_sharded(db_url, pages=1000, latency=0.2, worker_counts=(1, 2, 4, 8), concurrency=4, lease_pages=50,
+                      kill_one=False):
+
+    engine = get_local_engine(db_url)
+    stubs = [start_stub_process(count=pages*24, latency=latency, warm_pages=pages) for _ in range(max(worker_counts))]
+    context = multiprocessing.get_context('spawn')
+    lease_timeout = 5. if kill_one else 60.
+    results = {}
+
+    try:
+        for workers in worker_counts:
+            _drop_product_tables(engine)
+            crawl_id = sharded_crawl.create_leases(engine, pages, lease_pages=lease_pages,
+                                                   crawl_id='benchmark-{}-{}'.format(workers, time.time_ns()))
+            processes = [context.Process(target=_run_sharded_worker,
+                                         args=(db_url, crawl_id, stubs[i][1], concurrency, lease_timeout))
+                         for i in range(workers)]
+
+            start = time.perf_counter()
+            for process in processes:
+                process.start()
+            if kill_one and workers > 1:
+                time.sleep(lease_timeout/2)
+                processes[0].kill()
+            for process in processes:
+                process.join()
+            results[workers] = pages/(time.perf_counter() - start)
+
+            status = sharded_crawl.get_crawl_status(engine, crawl_id)
+            leases = dict(zip(status['leases']['status'], status['leases']['leases']))
+            assert set(leases) == {'done'}, 'leases not done: {}'.format(leases)
+            assert status['pages_logged'] == pages and status['error_pages'] == 0, status
+            print('{:>2} workers: {:,.1f} pages/sec ({} leases done, {:,} pages logged)'.format(
+                workers, results[workers], leases['done'], status['pages_logged']))
+    finally:
+        for process, _ in stubs:
+            process.terminate()
+
+    return results
+
+
+#Function to get the pages logged with errors and the pages dead-lettered
+def _error_pages(engine):
+    with engine.connect() as conn:
+        logged = {row[0] for row in conn.execute(sa.text('select page from worldfood.logging where error_processing'))}
+        dead_letters = {row[0] for row in conn.execute(sa.text('select page from worldfood.dead_letters'))}
+    return logged, dead_letters
+
+
+#Benchmark of crawl throughput under failure, on a stub that throttles beyond
+#`capacity` requests in flight and injects faults (see FaultStubHandler):
+#1. the crawl as before retries were scheduled (urllib3 retries, the first page
+#   that still fails ends the crawl), fetching only
+#2. a clean crawl (no throttling or faults), the baseline for throughput and rows
+#3. a crawl at each fault rate, with `dead_pages` pages that never succeed:
+#   pages/sec, requests made, and a check that every page is logged, with the
+#   dead pages (and only pages that failed) dead-lettered
+#4. a replay pass of the dead letters with the faults off, and a check that the
+#   tables then hold the same rows as the clean crawl
+def benchmark_faults(db_url=None, pages=500, latency=0.05, concurrency=16, capacity=8, fault_rates=(0.05, 0.2),
+                     dead_pages=2, seed=0):
+
+    engine = get_local_engine(db_url)
+    server, base_url = start_fault_stub(count=pages*24, latency=latency, seed=seed)
+    dead = sorted(random.Random(seed).sample(range(1, pages+1), dead_pages))
+    all_pages = range(1, pages+1)
+    results = {}
+
+    try:
+        server.configure(capacity, max(fault_rates), dead)
+        fetched = 0
+        try:
+            for _ in app.fetch_pages(all_pages, concurrency, base_url=base_url, fetch=fetch_content, retries=0,
+                                     session=get_session(pool_size=concurrency)):
+                fetched += 1
+            outcome = 'completed'
+        except Exception as error:
+            outcome = 'aborted: {}'.format(type(error).__name__)
+        print('without scheduled retries (fault rate {:.0%}): {} after {:,} of {:,} pages'.format(
+            max(fault_rates), outcome, fetched, pages))
+
+        for fault_rate in (None,) + tuple(fault_rates):
+            _drop_product_tables(engine)
+            if fault_rate is None:
+                server.configure()
+            else:
+                server.configure(capacity, fault_rate, dead)
+            start = time.perf_counter()
+            app.process_pages(engine, all_pages, concurrency, base_url=base_url, batch_pages=50)
+            elapsed = time.perf_counter() - start
+
+            logged, dead_letters = _error_pages(engine)
+            with engine.connect() as conn:
+                logged_pages = conn.execute(sa.text('select count(distinct page) from worldfood.logging')).scalar()
+            assert logged_pages == pages, 'logged {} of {} pages'.format(logged_pages, pages)
+            assert logged == dead_letters, 'error pages and dead letters differ'
+            assert set(dead) <= dead_letters if fault_rate is not None else not dead_letters, dead_letters
+            results[fault_rate] = {'pages_per_sec': pages/elapsed, 'requests': server.requests,
+                                   'faults': dict(server.faults), 'dead_letters': len(dead_letters)}
+            if fault_rate is None:
+                expected = _product_table_contents(engine)
+
+        #Replay the dead letters of the last crawl once the API recovers
+        server.configure()
+        app.process_error_pages(engine, concurrency, base_url=base_url, batch_pages=50)
+        logged, dead_letters = _error_pages(engine)
+        assert not logged and not dead_letters, 'pages still failing after replay: {}'.format(sorted(dead_letters))
+        actual = _product_table_contents(engine)
+        for table in app.WRITE_TABLES:
+            pd.testing.assert_frame_equal(expected[table], actual[table], check_dtype=False)
+    finally:
+        server.shutdown()
+
+    print('{:>10} {:>10} {:>9} {:>6} {:>7} {:>12}'.format('fault rate', 'pages/sec', 'requests', '429s', 'faults',
+                                                          'dead letters'))
+    for fault_rate, result in results.items():
+        faults = result['faults']
+        print('{:>10} {:>10,.1f} {:>9,} {:>6,} {:>7,} {:>12,}'.format(
+            'clean' if fault_rate is None else '{:.0%}'.format(fault_rate), result['pages_per_sec'],
+            result['requests'], faults.get('429', 0), sum(faults.values()) - faults.get('429', 0),
+            result['dead_letters']))
+    print('replay ok: no dead letters left, same rows as the clean crawl in {} tables'.format(len(app.WRITE_TABLES)))
+    return results
+
+
+#Directory of benchmark suite results, one JSON file per commit
+SUITE_RESULTS_DIR = '.benchmarks'
+
+
+#Function to get the current git commit (and whether the tree has uncommitted
+#changes), or (None, None) outside a git checkout
+def _git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+#Function to run one suite entry point `repeat` times, with metrics recorded
+#(in memory only). Returns the median end-to-end time, the units processed per 
+#second, and the per-stage summary of the last run
+def _run_suite_entry(name, run, units, unit, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        METRICS.start_run(name)
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    seconds = float(np.median(timings))
+    result = {'seconds': seconds,
+              'runs': timings,
+              'throughput': units/seconds if seconds else None,
+              'unit': unit,
+              'stages': {stage: {key: float(value) for key, value in stats.items()}
+                         for stage, stats in METRICS.summary().items()}}
+    print('{:<20}: {:7.2f}s, {:10,.1f} {}'.format(name, seconds, result['throughput'], unit))
+    return result
+
+
+#Benchmark suite: every entry point end to end, on a synthetic corpus of `pages`
+#product pages and reference taxonomies of `reference_size` entries served by
+#local stubs. Results (end-to-end and per-stage timings) are written as JSON,
+#by default to .benchmarks/<commit>.json, for comparison between commits
+#(see compare_suite_results)
+def benchmark_suite(db_url=None, pages=500, reference_size=20000, latency=0., concurrency=4, workers=4,
+                    repeat=1, output=None):
+
+    engine = get_local_engine(db_url)
+    product_server, product_url = start_stub_server(count=pages*24, latency=latency)
+    reference_server, reference_url = start_stub_server(count=reference_size, latency=latency, handler=ReferenceStubHandler)
+    reference_server.versions = {}
+    for page in range(1, pages+1):
+        synthetic_page_body(page, 24, pages*24)
+    all_pages = range(1, pages+1)
+    results = {}
+
+    def drop_delta_state():
+        _drop_product_tables(engine)
+        with engine.begin() as conn:
+            conn.execute(sa.text('drop table if exists worldfood.ingest_state'))
+
+    try:
+        results['reference'] = _run_suite_entry(
+            'reference', lambda: api_reference_processing.process_all_references(
+                engine, base_url=reference_url, cache_dir=tempfile.mkdtemp(prefix='worldfood_http_cache_'), force=True),
+            len(api_reference_processing.REFERENCE_TABLES), 'tables/sec', repeat)
+
+        results['crawl'] = _run_suite_entry(
+            'crawl', lambda: app.process_pages(engine, all_pages, concurrency, base_url=product_url, batch_pages=50),
+            pages, 'pages/sec', repeat, setup=lambda: _drop_product_tables(engine))
+
+        results['crawl_stream'] = _run_suite_entry(
+            'crawl_stream', lambda: app.process_pages(engine, all_pages, concurrency, base_url=product_url,
+                                                      batch_pages=50, stream=True),
+            pages, 'pages/sec', repeat, setup=lambda: _drop_product_tables(engine))
+
+        results['pipeline'] = _run_suite_entry(
+            'pipeline', lambda: pipeline.run_pipeline(engine, all_pages, workers=workers, concurrency=concurrency,
+                                                      base_url=product_url, batch_pages=50),
+            pages, 'pages/sec', repeat, setup=lambda: _drop_product_tables(engine))
+
+        if engine.dialect.name == 'postgresql' and async_processing.aiohttp and async_processing.asyncpg:
+            results['crawl_async'] = _run_suite_entry(
+                'crawl_async', lambda: asyncio.run(async_processing.process_pages_async(
+                    engine, all_pages, concurrency, base_url=product_url, batch_pages=50, workers=workers)),
+                pages, 'pages/sec', repeat, setup=lambda: _drop_product_tables(engine))
+
+        results['delta'] = _run_suite_entry(
+            'delta', lambda: app.process_delta(engine, concurrency, base_url=product_url, batch_pages=50),
+            pages*24, 'products/sec', repeat, setup=drop_delta_state)
+    finally:
+        product_server.shutdown()
+        reference_server.shutdown()
+
+    #Aggregates over the products loaded by the delta run (all of them)
+    with engine.connect() as conn:
+        products = conn.execute(sa.text('select count(*) from worldfood.products')).scalar()
+
+    def refresh_in_db():
+        for table in data_processing.INCREMENTAL_AGGS:
+            data_processing.refresh_agg_in_db(engine, table, 'SQL/{}.sql'.format(table))
+        data_processing.refresh_nutrients_agg(engine)
+
+    def write_pandas():
+        data_processing.write_allergens_agg(engine)
+        data_processing.write_ingredients_agg(engine)
+        data_processing.write_nutrients_agg(engine)
+
+    data_processing.create_nutrient_key_index(engine)
+    results['aggregates_pandas'] = _run_suite_entry('aggregates_pandas', write_pandas, products, 'products/sec', repeat)
+    results['aggregates_in_db'] = _run_suite_entry('aggregates_in_db', refresh_in_db, products, 'products/sec', repeat)
+
+    commit, dirty = _git_commit()
+    suite = {'commit': commit,
+             'dirty': dirty,
+             'created_at': pd.Timestamp.now('UTC').isoformat(),
+             'python': platform.python_version(),
+             'platform': platform.platform(),
+             'database': engine.dialect.name,
+             'config': {'pages': pages, 'reference_size': reference_size, 'latency': latency,
+                        'concurrency': concurrency, 'workers': workers, 'repeat': repeat},
+             'results': results}
+
+    if output is None:
+        os.makedirs(SUITE_RESULTS_DIR, exist_ok=True)
+        output = os.path.join(SUITE_RESULTS_DIR, '{}{}.json'.format((commit or 'unknown')[:12], '-dirty' if dirty else ''))
+    with open(output, 'w') as stream:
+        json.dump(suite, stream, indent=2)
+    print('results written to {}'.format(output))
+    return suite
+
+
+#Function to compare two benchmark suite result files: end-to-end time and
+#per-stage p50 of every entry point, flagging those slower by more than 
+#`threshold` (relative). Returns the entry points whose end-to-end time
+#regressed (stage timings are too noisy on small corpora to fail a comparison)
+def compare_suite_results(baseline_path, results_path, threshold=0.1):
+
+    with open(baseline_path) as stream:
+        baseline = json.load(stream)
+    with open(results_path) as stream:
+        results = json.load(stream)
+    if baseline['config'] != results['config'] or baseline['database'] != results['database']:
+        print('warning: results were produced with different settings')
+
+    print('{} -> {}'.format((baseline['commit'] or 'unknown')[:12], (results['commit'] or 'unknown')[:12]))
+    print('{:<32} {:>10} {:>10} {:>8}'.format('entry point / stage', 'baseline', 'results', 'change'))
+    regressions = []
+
+    def compare(name, old, new, stage=False):
+        change = new/old - 1 if old else 0.
+        regressed = change > threshold
+        if regressed and not stage:
+            regressions.append(name)
+        print('{:<32} {:>10.4f} {:>10.4f} {:>+7.1%}{}'.format(name, old, new, change, '  <- slower' if regressed else ''))
+
+    for entry, result in results['results'].items():
+        if entry not in baseline['results']:
+            print('{:<32} {:>10} {:>10.4f}'.format(entry, '-', result['seconds']))
+            continue
+        compare(entry, baseline['results'][entry]['seconds'], result['seconds'])
+        for stage, stats in sorted(result['stages'].items()):
+            baseline_stats = baseline['results'][entry]['stages'].get(stage)
+            if baseline_stats:
+                compare('  {} p50'.format(stage), baseline_stats['p50'], stats['p50'], stage=True)
+
+    print('{} regression(s) over {:.0%}'.format(len(regressions), threshold))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    flatten_parser = subparsers.add_parser('flatten', help='page flattening rows/sec')
+    flatten_parser.add_argument('fixture', nargs='?', help='recorded .json?page=N response')
+    flatten_parser.add_argument('--repeat', type=int, default=50)
+
+    fetch_parser = subparsers.add_parser('fetch', help='page fetching pages/sec against a local stub')
+    fetch_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    fetch_parser.add_argument('--pages', type=int, default=200)
+    fetch_parser.add_argument('--latency', type=float, default=0.05, help='stub response delay in seconds')
+
+    load_parser = subparsers.add_parser('load', help='table write rows/sec, to_sql versus bulk_insert')
+    load_parser.add_argument('--db-url', default=None)
+    load_parser.add_argument('--pages', type=int, default=100)
+
+    batch_parser = subparsers.add_parser('batch', help='write throughput and flush latency per batch size')
+    batch_parser.add_argument('--db-url', default=None)
+    batch_parser.add_argument('--pages', type=int, default=200)
+    batch_parser.add_argument('--batch-pages', type=int, nargs='+', default=[1, 5, 10, 25, 50])
+
+    engine_parser = subparsers.add_parser('engine', help='write latency per page and read time, before and after the shared database layer')
+    engine_parser.add_argument('--db-url', default=None)
+    engine_parser.add_argument('--pages', type=int, default=500)
+
+    delta_parser = subparsers.add_parser('delta', help='incremental ingestion versus a full crawl')
+    delta_parser.add_argument('--db-url', default=None)
+    delta_parser.add_argument('--products', type=int, default=24000)
+    delta_parser.add_argument('--changed', type=int, default=500)
+
+    dump_parser = subparsers.add_parser('dump', help='JSONL dump ingestion products/sec and peak memory')
+    dump_parser.add_argument('--db-url', default=None)
+    dump_parser.add_argument('--products', type=int, default=2000000)
+    dump_parser.add_argument('--gzip', action='store_true')
+    dump_parser.add_argument('--chunk-size', type=int, default=20000)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='multi-process pipeline products/sec by worker count')
+    pipeline_parser.add_argument('--db-url', default=None)
+    pipeline_parser.add_argument('--pages', type=int, default=500)
+    pipeline_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+
+    nutrients_agg_parser = subparsers.add_parser('nutrients-agg', help='typed product_nutrients size and nutrients_agg time')
+    nutrients_agg_parser.add_argument('--db-url', required=True)
+    nutrients_agg_parser.add_argument('--pages', type=int, default=2000)
+
+    nutrients_engines_parser = subparsers.add_parser('nutrients-engines', help='nutrients_agg time and parity, previous SQL versus single-scan SQL and NumPy')
+    nutrients_engines_parser.add_argument('--db-url', default=None)
+    nutrients_engines_parser.add_argument('--products', type=int, default=200000)
+
+    reference_parser = subparsers.add_parser('reference', help='reference table refresh: sequential versus parallel conditional')
+    reference_parser.add_argument('--db-url', default=None)
+    reference_parser.add_argument('--size', type=int, default=50000, help='entries per reference payload')
+    reference_parser.add_argument('--latency', type=float, default=0.5, help='stub response delay in seconds')
+
+    replay_parser = subparsers.add_parser('replay', help='crawl pages/sec from the network versus replayed from the response cache')
+    replay_parser.add_argument('--db-url', default=None)
+    replay_parser.add_argument('--pages', type=int, default=500)
+    replay_parser.add_argument('--latency', type=float, default=0.2, help='stub response delay in seconds')
+
+    parquet_parser = subparsers.add_parser('parquet', help='dashboard aggregates in the database versus DuckDB on exported Parquet, time and parity')
+    parquet_parser.add_argument('--db-url', default=None)
+    parquet_parser.add_argument('--pages', type=int, default=2000)
+    parquet_parser.add_argument('--buckets', type=int, default=columnar.PRODUCT_BUCKETS, help='partitions of the product tables')
+
+    tag_dims_parser = subparsers.add_parser('tag-dims', help='string tag columns versus integer dimension keys: size and group-by time')
+    tag_dims_parser.add_argument('--db-url', required=True)
+    tag_dims_parser.add_argument('--pages', type=int, default=5000)
+
+    parse_parser = subparsers.add_parser('parse', help='peak RSS and time of full JSON decoding versus incremental parsing')
+    parse_parser.add_argument('--tags', type=int, default=300000, help='entries in the reference payload')
+    parse_parser.add_argument('--page-size', type=int, default=1000, help='products in the page payload')
+
+    metrics_parser = subparsers.add_parser('metrics', help='instrumentation overhead, per-stage report and Prometheus export')
+    metrics_parser.add_argument('--db-url', default=None)
+    metrics_parser.add_argument('--pages', type=int, default=500)
+    metrics_parser.add_argument('--latency', type=float, default=0.02, help='stub response delay in seconds')
+
+    async_parser = subparsers.add_parser('async', help='asyncio engine versus the sync crawl, pages/sec and parity')
+    async_parser.add_argument('--db-url', required=True)
+    async_parser.add_argument('--pages', type=int, default=500)
+    async_parser.add_argument('--latency', type=float, default=0.05, help='stub response delay in seconds')
+    async_parser.add_argument('--concurrency', type=int, nargs='+', default=[4, 16, 64], help='requests in flight')
+    async_parser.add_argument('--workers', type=int, default=4, help='async engine parse processes')
+
+    sharded_parser = subparsers.add_parser('sharded', help='sharded crawl pages/sec by worker processes, with optional lease reclaim')
+    sharded_parser.add_argument('--db-url', required=True)
+    sharded_parser.add_argument('--pages', type=int, default=1000)
+    sharded_parser.add_argument('--latency', type=float, default=0.2, help='stub response delay in seconds')
+    sharded_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='worker processes')
+    sharded_parser.add_argument('--concurrency', type=int, default=4, help='requests in flight per worker')
+    sharded_parser.add_argument('--lease-pages', type=int, default=50)
+    sharded_parser.add_argument('--kill-one', action='store_true', help='kill a worker mid-crawl, so its lease is reclaimed')
+
+    faults_parser = subparsers.add_parser('faults', help='crawl pages/sec under throttling and injected faults, dead letters and replay')
+    faults_parser.add_argument('--db-url', default=None)
+    faults_parser.add_argument('--pages', type=int, default=500)
+    faults_parser.add_argument('--latency', type=float, default=0.05, help='stub response delay in seconds')
+    faults_parser.add_argument('--concurrency', type=int, default=16, help='max requests in flight')
+    faults_parser.add_argument('--capacity', type=int, default=8, help='requests in flight before the stub throttles')
+    faults_parser.add_argument('--fault-rates', type=float, nargs='+', default=[0.05, 0.2], help='share of requests failing')
+    faults_parser.add_argument('--dead-pages', type=int, default=2, help='pages that always fail')
+
+    suite_parser = subparsers.add_parser('suite', help='every entry point end to end and per stage, results written as JSON')
+    suite_parser.add_argument('--db-url', default=None)
+    suite_parser.add_argument('--pages', type=int, default=500, help='synthetic product pages (24 products each)')
+    suite_parser.add_argument('--reference-size', type=int, default=20000, help='entries per reference taxonomy')
+    suite_parser.add_argument('--latency', type=float, default=0., help='stub response delay in seconds')
+    suite_parser.add_argument('--concurrency', type=int, default=4, help='requests in flight')
+    suite_parser.add_argument('--workers', type=int, default=4, help='pipeline parse processes')
+    suite_parser.add_argument('--repeat', type=int, default=1, help='runs per entry point (the median is reported)')
+    suite_parser.add_argument('--output', default=None, help='results file (default: .benchmarks/<commit>.json)')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two suite result files, exit 1 on regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+
+    args = parser.parse_args()
+
+    if args.command == 'flatten':
+        benchmark_flatten(args.fixture, args.repeat)
+    elif args.command == 'fetch':
+        benchmark_fetch(args.concurrency, args.pages, args.latency)
+    elif args.command == 'load':
+        benchmark_load(args.db_url, args.pages)
+    elif args.command == 'batch':
+        benchmark_batch(args.db_url, args.pages, args.batch_pages)
+    elif args.command == 'engine':
+        benchmark_engine(args.db_url, args.pages)
+    elif args.command == 'delta':
+        benchmark_delta(args.db_url, args.products, args.changed)
+    elif args.command == 'dump':
+        benchmark_dump(args.db_url, args.products, args.gzip, args.chunk_size)
+    elif args.command == 'pipeline':
+        benchmark_pipeline(args.db_url, args.pages, args.workers)
+    elif args.command == 'nutrients-agg':
+        benchmark_nutrients_agg(args.db_url, args.pages)
+    elif args.command == 'nutrients-engines':
+        benchmark_nutrients_engines(args.db_url, args.products)
+    elif args.command == 'reference':
+        benchmark_reference(args.db_url, args.size, args.latency)
+    elif args.command == 'replay':
+        benchmark_replay(args.db_url, args.pages, args.latency)
+    elif args.command == 'parquet':
+        benchmark_parquet(args.db_url, args.pages, args.buckets)
+    elif args.command == 'tag-dims':
+        benchmark_tag_dims(args.db_url, args.pages)
+    elif args.command == 'parse':
+        benchmark_parse(args.tags, args.page_size)
+    elif args.command == 'metrics':
+        benchmark_metrics(args.db_url, args.pages, args.latency)
+    elif args.command == 'async':
+        benchmark_async(args.db_url, args.pages, args.latency, args.concurrency, args.workers)
+    elif args.command == 'sharded':
+        benchmark_sharded(args.db_url, args.pages, args.latency, args.workers, args.concurrency, args.lease_pages,
+                          args.kill_one)
+    elif args.command == 'faults':
+        benchmark_faults(args.db_url, args.pages, args.latency, args.concurrency, args.capacity, args.fault_rates,
+                         args.dead_pages)
+    elif args.command == 'suite':
+        benchmark_suite(args.db_url, args.pages, args.reference_size, args.latency, args.concurrency,
+                        args.workers, args.repeat, args.output)
+    elif args.command == 'compare':
+        if compare_suite_results(args.baseline, args.results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
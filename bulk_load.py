@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared bulk-load layer for writing DataFrames into worldfood tables.
+
+On PostgreSQL rows are streamed with COPY FROM STDIN from an in-memory CSV
+buffer. Other backends fall back to executemany (SQLite, where that is the
+fastest path for local runs) or multi-row INSERTs.
+"""
+
+
+#Import packages
+import csv
+import io
+import time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from db import get_table
+from metrics import METRICS
+
+
+
+#Marker for NULL values in the COPY buffer
+COPY_NULL = '\\N'
+
+
+#Function to quote a (possibly schema qualified) identifier for COPY
+def _quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+#Function to load a CSV buffer (with COPY_NULL for NULLs) into the given
+#columns of a table with COPY FROM STDIN
+def copy_buffer(conn, buffer, name, columns, schema=None):
+
+    table_name = _quote_identifier(name)
+    if schema:
+        table_name = '{}.{}'.format(_quote_identifier(schema), table_name)
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(table_name,
+                                                                        ', '.join(_quote_identifier(column) for column in columns),
+                                                                        COPY_NULL)
+
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cursor:
+        if hasattr(cursor, 'copy_expert'):
+            #psycopg2
+            cursor.copy_expert(sql, buffer)
+        else:
+            #psycopg (3)
+            with cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+
+
+#pandas to_sql insert method that writes rows with COPY FROM STDIN
+def copy_insert(pd_table, conn, keys, data_iter):
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in data_iter:
+        writer.writerow([COPY_NULL if value is None else value for value in row])
+    buffer.seek(0)
+    copy_buffer(conn, buffer, pd_table.name, keys, pd_table.schema)
+
+
+#Function to check whether a connectable (engine or connection) supports COPY
+def supports_copy(con):
+    dialect = con.dialect
+    return dialect.name == 'postgresql' and dialect.driver in ('psycopg2', 'psycopg')
+
+
+#Function to pick the to_sql insert method and chunk size for a connectable
+def get_insert_method(con, num_columns):
+    if supports_copy(con):
+        return copy_insert, None
+    if con.dialect.name == 'sqlite':
+        return None, None
+    return 'multi', max(1, 10000//max(num_columns, 1))
+
+
+#Function to append the rows of a DataFrame to an existing table, given its
+#metadata (see db.get_table): with COPY where available, otherwise with one
+#executemany of the table's insert statement
+def insert_rows(df, table, conn):
+
+    if len(df) == 0:
+        return
+    if supports_copy(conn):
+        buffer = io.StringIO()
+        df.to_csv(buffer, header=False, index=False, na_rep=COPY_NULL)
+        buffer.seek(0)
+        copy_buffer(conn, buffer, table.name, list(df.columns), table.schema)
+    else:
+        conn.execute(table.insert(), df.astype(object).where(df.notna(), None).to_dict('records'))
+
+
+#Function to bulk write a DataFrame into a worldfood table.
+#Same arguments as DataFrame.to_sql, but loads via COPY where available.
+#Appends to tables created by create_tables skip to_sql, which reflects the
+#table on every call
+def bulk_insert(df, name, con, dtype=None, if_exists='append', schema='worldfood'):
+
+    if (if_exists == 'append' and dtype is not None and (con.engine.url, schema, name) in _tables
+            and set(df.columns) <= set(dtype)):
+        table = get_table(name, dtype, schema)
+        if isinstance(con, sa.engine.Engine):
+            with con.begin() as conn:
+                insert_rows(df, table, conn)
+        else:
+            insert_rows(df, table, con)
+        return
+
+    method, chunksize = get_insert_method(con, len(df.columns))
+    df.to_sql(name,
+              con=con,
+              schema=schema,
+              index=False,
+              if_exists=if_exists,
+              dtype=dtype,
+              method=method,
+              chunksize=chunksize)
+
+
+#Function to replace worldfood.<table> with worldfood.<table>_new
+def swap_in_new_table(conn, table, schema='worldfood'):
+    conn.execute(sa.text('drop table if exists {}.{}'.format(schema, table)))
+    conn.execute(sa.text('alter table {0}.{1}_new rename to {1}'.format(schema, table)))
+
+
+#Function to replace the contents of a table with a DataFrame without readers
+#ever seeing it empty or half written: the rows are loaded into a staging table
+#(<name>_new), which is swapped in within the same transaction
+def replace_table(df, name, engine, dtype=None, schema='worldfood'):
+    with engine.begin() as conn, METRICS.timer('write', table_name=name, rows=len(df)):
+        bulk_insert(df, name + '_new', conn, dtype=dtype, if_exists='replace', schema=schema)
+        swap_in_new_table(conn, name, schema)
+
+
+#Function to delete the rows of a table whose integer key column is in `values`.
+#On PostgreSQL the keys are bound as one array, so the statement is the same
+#for any number of keys (and prepared by the driver once it repeats)
+def delete_keys(conn, table, column, values, schema='worldfood', chunk_size=1000):
+
+    if len(values) == 0:
+        return
+    if (conn.engine.url, schema, table) not in _tables and not sa.inspect(conn).has_table(table, schema=schema):
+        return
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(sa.text('delete from {}.{} where {} = any(:values)'.format(schema, table, column)), {'values': values})
+        return
+
+    statement = sa.text('delete from {}.{} where {} in :values'.format(schema, table, column))\
+        .bindparams(sa.bindparam('values', expanding=True))
+    for i in range(0, len(values), chunk_size):
+        conn.execute(statement, {'values': values[i:i+chunk_size]})
+
+
+#Function to index the key column of a table, so replacing rows by key does not
+#scan the whole table. The table is analyzed too, otherwise the planner keeps
+#using the statistics of the (empty) new table and ignores the index
+def create_key_index(conn, table, column, schema='worldfood'):
+    index_name = '{}_{}_idx'.format(table, column)
+    if conn.dialect.name == 'sqlite':
+        statement = 'create index if not exists {0}.{1} on {2} ({3})'
+    else:
+        statement = 'create index if not exists {1} on {0}.{2} ({3})'
+    conn.execute(sa.text(statement.format(schema, index_name, table, column)))
+    conn.execute(sa.text('analyze {}.{}'.format(schema, table)))
+
+
+#Function to get the distinct values of an integer key column as python ints
+def _key_values(series):
+    return pd.to_numeric(series, errors='coerce').dropna().astype('int64').unique().tolist()
+
+
+#Tables whose key index has been created, by (database url, table name)
+_key_indexes = set()
+
+#Tables known to exist, by (database url, schema, table name)
+_tables = set()
+
+
+#Function to create tables (table name -> column types) that do not exist yet,
+#with the key indexes of `replace_keys`, ahead of writers that cannot create
+#them on the fly (COPY with asyncpg) or would race to (concurrent workers).
+#Tables are checked once per process; appends to them then skip reflection
+def create_tables(engine, dtypes, replace_keys=None, schema='worldfood'):
+    replace_keys = replace_keys or {}
+    missing = [table for table in dtypes if (engine.url, schema, table) not in _tables]
+    if not missing:
+        return
+
+    with engine.begin() as conn:
+        for table in missing:
+            get_table(table, dtypes[table], schema).create(conn, checkfirst=True)
+
+    with engine.begin() as conn:
+        inspector = sa.inspect(conn)
+        for table in missing:
+            if table in replace_keys and (engine.url, table) not in _key_indexes:
+                #Existing indexes are not re-created: create index locks the
+                #table against other writers, even if the index exists
+                column = replace_keys[table][1]
+                if '{}_{}_idx'.format(table, column) not in {index['name'] for index in inspector.get_indexes(table, schema=schema)}:
+                    create_key_index(conn, table, column, schema)
+                _key_indexes.add((engine.url, table))
+    _tables.update((engine.url, schema, table) for table in missing)
+
+
+#Function to forget tables dropped by a caller, so they are created again
+def forget_tables(engine, tables, schema='worldfood'):
+    for table in tables:
+        _tables.discard((engine.url, schema, table))
+        _key_indexes.discard((engine.url, table))
+
+
+#Function to drop from a batch of pages' tables (a list of table name ->
+#DataFrame) the rows a later page of the batch replaces (see write_tables):
+#rows whose key is written again by a later page. Writing the batch then leaves
+#the same rows as writing its pages one after the other
+def drop_replaced_rows(pages, replace_keys):
+    replace_keys = replace_keys or {}
+    later_keys = {}
+    kept = []
+    for tables in reversed(pages):
+        tables = dict(tables)
+        for table, key in replace_keys.items():
+            if key in later_keys and len(tables.get(table, ())) > 0:
+                tables[table] = tables[table][~tables[table][key[1]].isin(later_keys[key])]
+        for key_table, column in set(replace_keys.values()):
+            if len(tables.get(key_table, ())) > 0:
+                later_keys.setdefault((key_table, column), set()).update(tables[key_table][column])
+        kept.append(tables)
+    return kept[::-1]
+
+
+#Function to write a set of DataFrames (table name -> DataFrame) in a single
+#transaction, in the table order of `dtypes` (table name -> column types).
+#`replace_keys` (table name -> (key table, key column)) makes the write idempotent:
+#rows of the table whose key column matches a key in tables[key table] are deleted
+#first, and the key table's own rows are de-duplicated on its key (other tables
+#can repeat rows legitimately, e.g. an ingredient listed twice).
+#`prepare(engine, tables)`, if given, transforms the tables before the write
+#transaction starts (e.g. dictionary encoding). Tables are created on first use
+def write_tables(tables, engine, dtypes, replace_keys=None, prepare=None):
+    
+    replace_keys = replace_keys or {}
+    create_tables(engine, dtypes, replace_keys)
+    if prepare is not None:
+        with METRICS.timer('prepare'):
+            tables = prepare(engine, tables)
+    with engine.begin() as conn:
+        
+        for table, (key_table, column) in replace_keys.items():
+            if len(tables.get(key_table, ())) > 0:
+                with METRICS.timer('delete', table_name=table):
+                    delete_keys(conn, table, column, _key_values(tables[key_table][column]))
+        
+        for table, dtype in dtypes.items():
+            if len(tables.get(table, ())) > 0:
+                df = tables[table]
+                if replace_keys.get(table, (None,))[0] == table:
+                    df = df.drop_duplicates(subset=[replace_keys[table][1]], keep='last')
+                with METRICS.timer('write', table_name=table, rows=len(df)):
+                    bulk_insert(df, table, conn, dtype=dtype)
+
+
+#Accumulates table rows from many pages and writes them in one transaction per
+#batch, once `max_pages` pages, `max_rows` rows or `max_bytes` bytes are buffered.
+#If a batch fails to write (e.g. a value too long for its column), its pages are
+#written one transaction each, and `on_error(tables, error)` gives the tables to
+#write instead of a page that still fails (e.g. its error logging), or None to
+#skip it. Without on_error the error is raised. Either way the batch is cleared.
+#Use as a context manager so buffered rows are flushed on shutdown or exception
+class WriteBuffer:
+
+    #Upper bounds (seconds) of the flush latency histogram buckets
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., float('inf'))
+
+    def __init__(self, engine, dtypes, max_pages=10, max_rows=None, max_bytes=None, replace_keys=None, prepare=None,
+                 on_error=None):
+        self.engine = engine
+        self.dtypes = dtypes
+        self.replace_keys = replace_keys
+        self.prepare = prepare
+        self.on_error = on_error
+        self.failed_pages = 0
+        self.max_pages = max_pages
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.flush_latencies = []
+        self._reset()
+
+    def _reset(self):
+        self._pending = []
+        self.pages = 0
+        self.rows = 0
+        self.bytes = 0
+
+    #Add one page worth of tables (table name -> DataFrame)
+    def add(self, tables):
+        tables = {table: df for table, df in tables.items() if len(df) > 0}
+        for table, df in tables.items():
+            if table not in self.dtypes:
+                raise KeyError('{} is not one of the tables written'.format(table))
+            self.rows += len(df)
+            if self.max_bytes:
+                self.bytes += int(df.memory_usage(index=False, deep=True).sum())
+        self._pending.append(tables)
+        self.pages += 1
+
+        if ((self.max_pages and self.pages >= self.max_pages) or
+                (self.max_rows and self.rows >= self.max_rows) or
+                (self.max_bytes and self.bytes >= self.max_bytes)):
+            self.flush()
+
+    #Function to write tables (table name -> DataFrame) in one transaction
+    def _write(self, tables):
+        write_tables(tables, self.engine, self.dtypes, self.replace_keys, self.prepare)
+
+    #Write all buffered rows in one transaction
+    def flush(self):
+        if self.pages == 0:
+            return
+        pages = drop_replaced_rows(self._pending, self.replace_keys)
+        tables = {table: pd.concat([page[table] for page in pages if table in page], ignore_index=True)
+                  for table in self.dtypes if any(table in page for page in pages)}
+        start = time.perf_counter()
+        try:
+            try:
+                self._write(tables)
+            except Exception:
+                if self.on_error is None:
+                    raise
+                self._write_pages()
+            self.flush_latencies.append(time.perf_counter() - start)
+            METRICS.observe('flush', self.flush_latencies[-1], rows=self.rows)
+        finally:
+            self._reset()
+
+    #Function to write the buffered pages one transaction each, after their
+    #batch failed, replacing those that fail again with on_error's tables
+    def _write_pages(self):
+        for tables in self._pending:
+            try:
+                self._write(tables)
+            except Exception as error:
+                self.failed_pages += 1
+                tables = self.on_error(tables, error)
+                if tables:
+                    self._write(tables)
+
+    #Counts of flushes per latency bucket, keyed by bucket upper bound
+    def latency_histogram(self):
+        counts = np.histogram(self.flush_latencies, bins=(0.,) + self.LATENCY_BUCKETS)[0]
+        return dict(zip(self.LATENCY_BUCKETS, counts.tolist()))
+
+    def report(self):
+        print('{} flushes'.format(len(self.flush_latencies)))
+        if self.failed_pages:
+            print('{} pages failed to write'.format(self.failed_pages))
+        for bucket, count in self.latency_histogram().items():
+            print('  <= {:>5}s: {}'.format(bucket, count))
+
+    def __enter__(self):
+        return self
+
+    #Rows already handed to the buffer were fully processed, so they are written
+    #on the way out even if an exception is propagating
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar copies of worldfood tables: tables exported from the database to
+compressed Parquet files (large tables partitioned into product_id buckets),
+and a DuckDB connection exposing the files as worldfood.<table> views, so the
+SQL written for the EDW runs unchanged on a laptop.
+
+Layout: <directory>/<table>/part-0.parquet, or for partitioned tables
+<directory>/<table>/bucket=<product_id % buckets>/part-0.parquet. Each table is
+written to a temporary directory and moved into place, so readers never see
+a half-written export.
+
+Needs the optional pyarrow and duckdb packages.
+"""
+
+
+#Import packages
+import glob
+import os
+import re
+import shutil
+
+import pandas as pd
+import sqlalchemy as sa
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from db import READ_CHUNK_SIZE, read_sql_chunks
+
+
+
+#Directory of the Parquet files
+PARQUET_DIR = 'parquet'
+
+#Partitions of the partitioned (product) tables, by product_id modulo
+PRODUCT_BUCKETS = 16
+
+#Parquet compression codec
+COMPRESSION = 'zstd'
+
+
+#Function to get the Arrow type of a SQLAlchemy column type
+def get_arrow_type(column_type):
+    if isinstance(column_type, sa.types.BigInteger):
+        return pa.int64()
+    if isinstance(column_type, sa.types.SmallInteger):
+        return pa.int16()
+    if isinstance(column_type, sa.types.Integer):
+        return pa.int32()
+    if isinstance(column_type, sa.types.Float):
+        return pa.float64()
+    if isinstance(column_type, sa.types.Boolean):
+        return pa.bool_()
+    if isinstance(column_type, sa.types.DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+#Function to get the Arrow schema of a table's column types (column name -> SQLAlchemy type)
+def get_arrow_schema(dtype):
+    return pa.schema([(column, get_arrow_type(column_type)) for column, column_type in dtype.items()])
+
+
+#Function to check the optional packages are installed
+def _check_packages(*packages):
+    missing = [name for name, module in [('pyarrow', pa), ('duckdb', duckdb)] if name in packages and module is None]
+    if missing:
+        raise ImportError('the Parquet export and query path need the {} package(s)'.format(', '.join(missing)))
+
+
+#Function to write DataFrames (e.g. the chunks of a read) to a table's
+#directory as one Arrow dataset. Rows are converted to the Arrow types of
+#`dtype`, and split into `buckets` partitions by product_id if given
+def write_parquet(dfs, directory, table, dtype, buckets=None, compression=COMPRESSION):
+
+    _check_packages('pyarrow')
+    schema = get_arrow_schema(dtype)
+    if buckets:
+        schema = schema.append(pa.field('bucket', pa.int32()))
+
+    def batches():
+        for df in dfs:
+            df = df[list(dtype)]
+            if buckets:
+                df = df.assign(bucket=(df['product_id'] % buckets).astype('int32'))
+            yield from pa.Table.from_pandas(df, schema=schema, preserve_index=False).to_batches()
+
+    path = os.path.join(directory, table)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    ds.write_dataset(batches(), tmp_path, schema=schema, format='parquet',
+                     partitioning=['bucket'] if buckets else None, partitioning_flavor='hive' if buckets else None,
+                     basename_template='part-{i}.parquet',
+                     file_options=ds.ParquetFileFormat().make_write_options(compression=compression))
+    os.makedirs(tmp_path, exist_ok=True)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+#Function to export a worldfood table to Parquet, streaming it through a
+#server-side cursor `chunksize` rows at a time. Returns the number of rows
+def export_table(engine, table, directory, dtype, buckets=None, compression=COMPRESSION, chunksize=READ_CHUNK_SIZE):
+    query = sa.text('select {} from worldfood.{}'.format(', '.join(dtype), table))
+    write_parquet(read_sql_chunks(query, engine, chunksize=chunksize), directory, table, dtype, buckets, compression)
+    return ds.dataset(os.path.join(directory, table), format='parquet').count_rows()
+
+
+#Function to open an in-memory DuckDB database with a worldfood.<table> view
+#over the Parquet files of each table of `dtypes` (table name -> column types).
+#Tables without files get an empty view of their columns, as for an empty
+#table in the EDW
+def connect_parquet(directory, dtypes):
+
+    _check_packages('pyarrow', 'duckdb')
+    conn = duckdb.connect()
+    conn.execute('create schema worldfood')
+    for table, dtype in dtypes.items():
+        pattern = os.path.join(directory, table, '**', '*.parquet')
+        if glob.glob(pattern, recursive=True):
+            conn.execute("create view worldfood.{} as select {} from read_parquet('{}', hive_partitioning = true)".format(
+                table, ', '.join(dtype), pattern.replace("'", "''")))
+        else:
+            conn.register('empty_{}'.format(table), get_arrow_schema(dtype).empty_table())
+            conn.execute('create view worldfood.{0} as select * from empty_{0}'.format(table))
+    return conn
+
+
+#Function to run a query written for the EDW (with :name parameters) on a
+#DuckDB connection, returning a DataFrame
+def query_parquet(conn, query, params=None):
+    return conn.execute(re.sub(r'(?<!:):(\w+)', r'$\1', query), params or {}).df()
@@ -6,50 +6,43 @@ Created on Thu Dec  9 20:15:26 2021
 @author: dh08loma
 """
 
+import argparse
 import numpy as np
 import pandas as pd
 import sqlalchemy as sa 
-import os
-import yaml
-
-
-#Get credentials stored in secrets.yaml file (saved in same directory)
-#(Note: Nuvalence credentials have read access only)
-def get_engine():
-
-	if os.path.isfile('secrets.yaml'):
-		with open('secrets.yaml', 'r') as stream:
-			data_loaded = yaml.load(stream)
-			
-			user=data_loaded['EDW']['user']
-			password=data_loaded['EDW']['password']
-			endpoint=data_loaded['EDW']['endpoint']
-			port=data_loaded['EDW']['port']
-			database=data_loaded['EDW']['database']
-			
-	db_string = "postgres://{0}:{1}@{2}:{3}/{4}".format(user,password,endpoint,port,database)
-	engine=sa.create_engine(db_string)
-	
-	return engine  
+
+from api_product_processing import PRODUCT_TABLES, TAG_DICTIONARIES
+from api_reference_processing import REFERENCE_TABLES
+from bulk_load import bulk_insert, create_key_index, replace_table, swap_in_new_table
+from columnar import PARQUET_DIR, PRODUCT_BUCKETS, connect_parquet, export_table, query_parquet, write_parquet
+from db import get_engine, read_sql, read_sql_chunks
+from metrics import METRICS, add_metrics_arguments, finish_run, start_run
+
 
 	
+#Column types of the allergens and ingredients aggregates
+ALLERGENS_AGG_DTYPE = {'allergen_id': sa.types.VARCHAR(length=255),
+                       'allergen_name': sa.types.VARCHAR(length=255),
+                       'num_products': sa.types.INTEGER(),
+                       'pct_products': sa.types.FLOAT()}
+
+INGREDIENTS_AGG_DTYPE = {'ingredient_id': sa.types.VARCHAR(length=255),
+                         'ingredient_name': sa.types.VARCHAR(length=255),
+                         'num_products': sa.types.INTEGER(),
+                         'pct_products': sa.types.FLOAT()}
+
+
 #Function to process allergens aggregate query and store in EDW,
 #for use in downstream dashboard
 def write_allergens_agg(engine):
 
     query = open('SQL/allergens_agg.sql').read()
 
-    allergens_agg_df=pd.read_sql(query,engine)
+    allergens_agg_df=read_sql(query,engine)
 
-    allergens_agg_df.to_sql('allergens_agg',
-    						 con=engine,
-    						 schema='worldfood',
-    						 index=False,
-    						 if_exists='replace',
-    						 dtype={'allergen_id': sa.types.VARCHAR(length=255),
-    								'allergen_name': sa.types.VARCHAR(length=255),
-    								'num_products': sa.types.INTEGER(),
-                                    'pct_products': sa.types.FLOAT()})
+    bulk_insert(allergens_agg_df, 'allergens_agg', engine,
+                if_exists='replace',
+                dtype=ALLERGENS_AGG_DTYPE)
 
 #Function to process ingredients aggregate query and store in EDW,
 #for use in downstream dashboard
@@ -57,54 +50,339 @@ def write_ingredients_agg(engine):
 
     query = open('SQL/ingredients_agg.sql').read()
 
-    ingredients_agg_df=pd.read_sql(query,engine)
+    ingredients_agg_df=read_sql(query,engine)
     
-    ingredients_agg_df.to_sql('ingredients_agg',
-    						 con=engine,
-    						 schema='worldfood',
-    						 index=False,
-    						 if_exists='replace',
-    						 dtype={'ingredient_id': sa.types.VARCHAR(length=255),
-    								'ingredient_name': sa.types.VARCHAR(length=255),
-    								'num_products': sa.types.INTEGER(),
-                                    'pct_products': sa.types.FLOAT()})
+    bulk_insert(ingredients_agg_df, 'ingredients_agg', engine,
+                if_exists='replace',
+                dtype=INGREDIENTS_AGG_DTYPE)
 
 	
+#Column types of the nutrients aggregate
+NUTRIENTS_AGG_DTYPE = {'product_id': sa.types.BIGINT(),
+                       'product_name': sa.types.VARCHAR(length=255),
+                       'carbs_per_serving': sa.types.FLOAT(),
+                       'carbs_per_serving_percentile': sa.types.FLOAT(),
+                       'carbs_per_serving_indicator': sa.types.CHAR(4),
+                       'protein_per_serving': sa.types.FLOAT(),
+                       'protein_per_serving_percentile': sa.types.FLOAT(),
+                       'protein_per_serving_indicator': sa.types.CHAR(4),
+                       'calories_per_serving': sa.types.FLOAT(),
+                       'calories_per_serving_percentile': sa.types.FLOAT(),
+                       'calories_per_serving_indicator': sa.types.CHAR(4)}
+
+#Nutrients ranked in the nutrients aggregate, by the column prefix they get
+NUTRIENTS_AGG_NUTRIENTS = {'carbs_per_serving': 'carbohydrates_serving',
+                           'protein_per_serving': 'proteins_serving',
+                           'calories_per_serving': 'energy-kcal_serving'}
+
+#Percentile at or above which a nutrient is flagged 'high', and at or below
+#which it is flagged 'low'
+HIGH_THRESHOLD = .9
+LOW_THRESHOLD = .1
+
+
+#Function to index product_nutrients on nutrient_key, so the three ranked 
+#nutrients are read without scanning the whole table. The index is created 
+#(and the table analyzed) once: nothing is done if it exists already (e.g. 
+#from migration 001) or product_nutrients does not exist yet
+def create_nutrient_key_index(engine):
+    with engine.begin() as conn:
+        inspector = sa.inspect(conn)
+        if not inspector.has_table('product_nutrients', schema='worldfood'):
+            return
+        indexes = {index['name'] for index in inspector.get_indexes('product_nutrients', schema='worldfood')}
+        if 'product_nutrients_nutrient_key_idx' not in indexes:
+            create_key_index(conn, 'product_nutrients', 'nutrient_key')
+
+
+#Function to compute the nutrients aggregate in pandas/NumPy rather than in the
+#EDW: only the ranked nutrients' rows are read, and each nutrient's percentile
+#rank is computed with one sort. Matches SQL/nutrients_agg.sql, where
+#PERCENT_RANK = (number of smaller values)/(number of values - 1).
+#Both reads are streamed (see read_sql_chunks): of each chunk, only the
+#product ids and values of each nutrient are kept as NumPy arrays, and only
+#the names of products in the aggregate
+def compute_nutrients_agg(engine, high_threshold=HIGH_THRESHOLD, low_threshold=LOW_THRESHOLD):
+
+    query = sa.text('''select pn.product_id, nd.nutrient_name, pn.nutrient_value
+                       from worldfood.product_nutrients pn
+                       join worldfood.nutrients_dim nd on pn.nutrient_key=nd.nutrient_key
+                       where nd.nutrient_name in :names and pn.nutrient_value is not null''')\
+        .bindparams(sa.bindparam('names', expanding=True))
+    columns = {nutrient_name: ([], []) for nutrient_name in NUTRIENTS_AGG_NUTRIENTS.values()}
+    for chunk in read_sql_chunks(query, engine, params={'names': list(columns)}):
+        for nutrient_name, nutrient_df in chunk.groupby('nutrient_name'):
+            columns[nutrient_name][0].append(nutrient_df['product_id'].to_numpy(dtype='int64'))
+            columns[nutrient_name][1].append(nutrient_df['nutrient_value'].to_numpy(dtype='float64'))
+
+    agg_df = pd.DataFrame({'product_id': pd.Series(dtype='int64')})
+    for prefix, nutrient_name in NUTRIENTS_AGG_NUTRIENTS.items():
+        product_ids, values = (np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+                               for arrays, dtype in zip(columns[nutrient_name], ('int64', 'float64')))
+        smaller = np.searchsorted(np.sort(values), values, side='left')
+        percentiles = smaller/(len(values) - 1) if len(values) > 1 else np.zeros(len(values))
+        
+        nutrient_df = pd.DataFrame({'product_id': product_ids,
+                                    prefix: values,
+                                    prefix + '_percentile': percentiles})\
+            .groupby('product_id', as_index=False).max()
+        agg_df = agg_df.merge(nutrient_df, on='product_id', how='outer')
+
+    for prefix in NUTRIENTS_AGG_NUTRIENTS:
+        percentiles = agg_df[prefix + '_percentile']
+        agg_df[prefix + '_indicator'] = np.select([percentiles >= high_threshold, percentiles <= low_threshold],
+                                                  ['high', 'low'], None)
+
+    products = [chunk[chunk['product_id'].isin(agg_df['product_id'])]
+                for chunk in read_sql_chunks('select product_id, product_name from worldfood.products', engine)]
+    products_df = pd.concat(products, ignore_index=True) if products else pd.DataFrame(columns=['product_id', 'product_name'])
+    agg_df = products_df.merge(agg_df, on='product_id', how='inner')
+    return agg_df[list(NUTRIENTS_AGG_DTYPE)]
+
+
 #Function to process nutrients aggregate query and store in EDW,
-#for use in downstream dashboard
-def write_nutrients_agg(engine):
+#for use in downstream dashboard. With method='numpy' the aggregate is 
+#computed by compute_nutrients_agg instead, for when the EDW is overloaded
+def write_nutrients_agg(engine, method='sql', high_threshold=HIGH_THRESHOLD, low_threshold=LOW_THRESHOLD):
+
+    if method == 'numpy':
+        nutrients_agg_df = compute_nutrients_agg(engine, high_threshold, low_threshold)
+    else:
+        query = sa.text(open('SQL/nutrients_agg.sql').read())
+        nutrients_agg_df = read_sql(query, engine, params={'high_threshold': high_threshold,
+                                                              'low_threshold': low_threshold})
 
-    query = open('SQL/nutrients_agg.sql').read()
+    bulk_insert(nutrients_agg_df, 'nutrients_agg', engine,
+                if_exists='replace',
+                dtype=NUTRIENTS_AGG_DTYPE)
     
-    nutrients_agg_df=pd.read_sql(query,engine)
-
-    nutrients_agg_df.to_sql('nutrients_agg',
-    						 con=engine,
-    						 schema='worldfood',
-    						 index=False,
-    						 if_exists='replace',
-    						 dtype={'product_id': sa.types.BIGINT(),
-    								'product_name': sa.types.VARCHAR(length=255),
-                                    'carbs_per_serving': sa.types.FLOAT(),
-                                    'carbs_per_serving_percentile': sa.types.FLOAT(),
-                                    'carbs_per_serving_indicator': sa.types.CHAR(4),
-                                    'protein_per_serving': sa.types.FLOAT(),
-                                    'protein_per_serving_percentile': sa.types.FLOAT(),
-                                    'protein_per_serving_indicator': sa.types.CHAR(4),
-                                    'calories_per_serving': sa.types.FLOAT(),
-                                    'calories_per_serving_percentile': sa.types.FLOAT(),
-                                    'calories_per_serving_indicator': sa.types.CHAR(4)})
     
+#Function to rebuild an aggregate table inside the database from a query, 
+#without pulling it through pandas. The new table is built under a temporary name
+#and swapped in within the same transaction, so readers (e.g. the dashboard)
+#see either the old or the new table, never an empty one
+def swap_table(conn, table, query, params=None):
+    conn.execute(sa.text('drop table if exists worldfood.{}_new'.format(table)))
+    conn.execute(sa.text('create table worldfood.{}_new as {}'.format(table, query)), params or {})
+    swap_in_new_table(conn, table)
+
+
+#Function to refresh an aggregate table in the database from its SQL file
+def refresh_agg_in_db(engine, table, query_path, params=None):
+    query = open(query_path).read()
+    with engine.begin() as conn:
+        swap_table(conn, table, query, params)
+
+
+#Function to refresh the nutrients aggregate in the database, either with 
+#SQL/nutrients_agg.sql or (method='numpy') with compute_nutrients_agg, swapping
+#the new table in either way
+def refresh_nutrients_agg(engine, method='sql', high_threshold=HIGH_THRESHOLD, low_threshold=LOW_THRESHOLD):
     
+    if method == 'numpy':
+        nutrients_agg_df = compute_nutrients_agg(engine, high_threshold, low_threshold)
+        replace_table(nutrients_agg_df, 'nutrients_agg', engine, dtype=NUTRIENTS_AGG_DTYPE)
+    else:
+        refresh_agg_in_db(engine, 'nutrients_agg', 'SQL/nutrients_agg.sql',
+                          {'high_threshold': high_threshold, 'low_threshold': low_threshold})
+
+
+#Aggregates that can be refreshed incrementally. The distinct (product, key) 
+#pairs already counted are kept in worldfood.<agg>_products and the number of
+#products per key in worldfood.<agg>_counts; the aggregate itself is rebuilt
+#from the (small) counts table with `query`
+INCREMENTAL_AGGS = {'allergens_agg': {'source': 'product_allergens',
+                                      'keys': ['allergen_key'],
+                                      'query': 'SQL/allergens_agg_incremental.sql'},
+                    'ingredients_agg': {'source': 'product_ingredients',
+                                        'keys': ['ingredient_key', 'ingredient_name'],
+                                        'query': 'SQL/ingredients_agg_incremental.sql'}}
+
+
+#Function to get the ingested_at high-water mark of the last incremental refresh
+def get_refresh_mark(conn, table):
+    if not sa.inspect(conn).has_table('agg_refresh_state', schema='worldfood'):
+        return None
+    mark = conn.execute(sa.text('select ingested_at from worldfood.agg_refresh_state where agg_name = :table'),
+                        {'table': table}).scalar()
+    return None if mark is None else pd.Timestamp(mark).to_pydatetime()
+
+
+#Function to record the ingested_at high-water mark of an incremental refresh
+def set_refresh_mark(conn, table, mark):
+    conn.execute(sa.text('create table if not exists worldfood.agg_refresh_state (agg_name VARCHAR(255), ingested_at TIMESTAMP)'))
+    conn.execute(sa.text('delete from worldfood.agg_refresh_state where agg_name = :table'), {'table': table})
+    conn.execute(sa.text('insert into worldfood.agg_refresh_state (agg_name, ingested_at) values (:table, :mark)'),
+                 {'table': table, 'mark': mark})
+
+
+#Function to refresh allergens_agg/ingredients_agg incrementally: only products
+#ingested since the last refresh (products.ingested_at) have their counted pairs
+#replaced, and only the counts of the keys they touch are recomputed. Products
+#ingested up to `overlap` before the last mark are re-counted too, in case they 
+#were committed after it was taken; re-counting a product is harmless.
+#The first refresh (or one with full=True) builds everything from scratch
+def refresh_agg_incremental(engine, table, full=False, overlap=pd.Timedelta(hours=1)):
+    
+    agg = INCREMENTAL_AGGS[table]
+    pairs = '{}_products'.format(table)
+    counts = '{}_counts'.format(table)
+    keys = ', '.join(agg['keys'])
+    
+    with engine.begin() as conn:
+        
+        #Null-safe comparison, as ingredient names can be null
+        is_same = 'is' if conn.dialect.name == 'sqlite' else 'is not distinct from'
+        
+        mark = conn.execute(sa.text('select max(ingested_at) from worldfood.products')).scalar()
+        since = None if full else get_refresh_mark(conn, table)
+        
+        if since is None or not sa.inspect(conn).has_table(pairs, schema='worldfood'):
+            statements = ['drop table if exists worldfood.{pairs}',
+                          'drop table if exists worldfood.{counts}',
+                          'create table worldfood.{pairs} as select distinct product_id, {keys} from worldfood.{source}',
+                          'create table worldfood.{counts} as select {keys}, count(*) num_products from worldfood.{pairs} group by {keys}']
+            params = {}
+        else:
+            delta = 'select product_id from agg_delta_products'
+            statements = ['create temporary table agg_delta_products as select product_id from worldfood.products where ingested_at > :since',
+                          #Keys the delta products were counted under before...
+                          'create temporary table agg_affected_keys as select distinct {keys} from worldfood.{pairs} where product_id in (' + delta + ')',
+                          'delete from worldfood.{pairs} where product_id in (' + delta + ')',
+                          'insert into worldfood.{pairs} (product_id, {keys}) select distinct product_id, {keys} from worldfood.{source} where product_id in (' + delta + ')',
+                          #...and now
+                          'insert into agg_affected_keys select distinct {keys} from worldfood.{pairs} where product_id in (' + delta + ')',
+                          'delete from worldfood.{counts} where exists (select 1 from agg_affected_keys a where {match_counts})',
+                          'insert into worldfood.{counts} ({keys}, num_products) select {pair_keys}, count(*) from worldfood.{pairs} p '
+                          'where exists (select 1 from agg_affected_keys a where {match_pairs}) group by {pair_keys}',
+                          'drop table agg_delta_products',
+                          'drop table agg_affected_keys']
+            params = {'since': since - overlap.to_pytimedelta()}
+        
+        for statement in statements:
+            conn.execute(sa.text(statement.format(pairs=pairs, counts=counts, keys=keys, source=agg['source'],
+                                                  pair_keys=', '.join('p.' + key for key in agg['keys']),
+                                                  match_counts=' and '.join('a.{0} {1} {2}.{0}'.format(key, is_same, counts) for key in agg['keys']),
+                                                  match_pairs=' and '.join('a.{0} {1} p.{0}'.format(key, is_same) for key in agg['keys']))),
+                         params)
+        
+        create_key_index(conn, pairs, 'product_id')
+        swap_table(conn, table, open(agg['query']).read())
+        if mark is not None:
+            set_refresh_mark(conn, table, pd.Timestamp(mark).to_pydatetime())
+
+
+#Aggregates used by the dashboard: column types and SQL
+AGGREGATES = {'allergens_agg': (ALLERGENS_AGG_DTYPE, 'SQL/allergens_agg.sql'),
+              'ingredients_agg': (INGREDIENTS_AGG_DTYPE, 'SQL/ingredients_agg.sql'),
+              'nutrients_agg': (NUTRIENTS_AGG_DTYPE, 'SQL/nutrients_agg.sql')}
+
+#Tables exported to Parquet (table name -> column types): the product tables
+#(partitioned by product_id), the dimension and reference tables the
+#aggregates join, and the aggregates themselves
+PARQUET_TABLES = dict(PRODUCT_TABLES,
+                      **{dictionary.table: dictionary.dtype for _, dictionary in TAG_DICTIONARIES.values()},
+                      **{table: reference['dtype'] for table, reference in REFERENCE_TABLES.items()},
+                      **{table: dtype for table, (dtype, _) in AGGREGATES.items()})
+
+
+#Function to export the PARQUET_TABLES found in the database to Parquet files
+#in `directory`. Returns the rows exported per table
+def export_parquet(engine, directory=PARQUET_DIR, buckets=PRODUCT_BUCKETS):
+    
+    with engine.connect() as conn:
+        tables = [table for table in PARQUET_TABLES if sa.inspect(conn).has_table(table, schema='worldfood')]
+    
+    rows = {}
+    for table in tables:
+        with METRICS.timer('export', table_name=table):
+            rows[table] = export_table(engine, table, directory, PARQUET_TABLES[table],
+                                       buckets if table in PRODUCT_TABLES else None)
+        print('{:<22} {:>12,} rows'.format(table, rows[table]))
+    return rows
+
+
+#Function to compute an aggregate with its EDW SQL on a DuckDB connection
+#over the Parquet files (see connect_parquet)
+def query_agg_parquet(conn, table, high_threshold=HIGH_THRESHOLD, low_threshold=LOW_THRESHOLD):
+    query = open(AGGREGATES[table][1]).read()
+    params = {'high_threshold': high_threshold, 'low_threshold': low_threshold}
+    return query_parquet(conn, query, {name: value for name, value in params.items() if ':' + name in query})
+
+
+#Function to compute the aggregates from the Parquet files in `directory`
+#with DuckDB. Returns a DataFrame per aggregate
+def compute_aggs_parquet(directory=PARQUET_DIR, high_threshold=HIGH_THRESHOLD, low_threshold=LOW_THRESHOLD):
+    conn = connect_parquet(directory, PARQUET_TABLES)
+    try:
+        return {table: query_agg_parquet(conn, table, high_threshold, low_threshold) for table in AGGREGATES}
+    finally:
+        conn.close()
+
+
+#Function to refresh the aggregates from the Parquet files in `directory`,
+#without a database: computed with DuckDB and written next to the tables
+def refresh_aggs_parquet(directory=PARQUET_DIR, high_threshold=HIGH_THRESHOLD, low_threshold=LOW_THRESHOLD):
+    conn = connect_parquet(directory, PARQUET_TABLES)
+    try:
+        for table, (dtype, _) in AGGREGATES.items():
+            with METRICS.timer('aggregate', table_name=table):
+                write_parquet([query_agg_parquet(conn, table, high_threshold, low_threshold)], directory, table, dtype)
+    finally:
+        conn.close()
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Refresh the worldfood aggregate tables used by the dashboard')
+    parser.add_argument('--mode', choices=['pandas', 'in-db', 'incremental', 'parquet'], default='pandas',
+                        help='pandas: query and rewrite through pandas; in-db: rebuild inside the database and swap; '
+                             'incremental: like in-db, but only re-count allergens/ingredients of newly ingested products; '
+                             'parquet: compute from the Parquet files of --parquet-dir with DuckDB, without the database')
+    parser.add_argument('--nutrients-engine', choices=['sql', 'numpy'], default='sql',
+                        help='compute nutrients_agg in the database (sql) or in pandas/NumPy (numpy), e.g. when the EDW is overloaded')
+    parser.add_argument('--high-threshold', type=float, default=HIGH_THRESHOLD, help='percentile flagged as high nutrient content')
+    parser.add_argument('--low-threshold', type=float, default=LOW_THRESHOLD, help='percentile flagged as low nutrient content')
+    parser.add_argument('--parquet-dir', default=None,
+                        help='export the product tables and aggregates to Parquet files in this directory '
+                             '(with --mode parquet, the directory read; default: {})'.format(PARQUET_DIR))
+    parser.add_argument('--buckets', type=int, default=PRODUCT_BUCKETS, help='partitions of the exported product tables')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    
+    if args.mode == 'parquet':
+        start_run('data_processing', None, args)
+        try:
+            refresh_aggs_parquet(args.parquet_dir or PARQUET_DIR, args.high_threshold, args.low_threshold)
+        finally:
+            finish_run(args)
+        return
+    
     engine=get_engine()
-    write_allergens_agg(engine)
-    write_ingredients_agg(engine)
-    write_nutrients_agg(engine)
+    start_run('data_processing', engine, args)
+    try:
+        create_nutrient_key_index(engine)
+        if args.mode == 'pandas':
+            with METRICS.timer('aggregate', table_name='allergens_agg'):
+                write_allergens_agg(engine)
+            with METRICS.timer('aggregate', table_name='ingredients_agg'):
+                write_ingredients_agg(engine)
+            with METRICS.timer('aggregate', table_name='nutrients_agg'):
+                write_nutrients_agg(engine, args.nutrients_engine, args.high_threshold, args.low_threshold)
+        else:
+            for table in INCREMENTAL_AGGS:
+                with METRICS.timer('aggregate', table_name=table):
+                    if args.mode == 'incremental':
+                        refresh_agg_incremental(engine, table)
+                    else:
+                        refresh_agg_in_db(engine, table, 'SQL/{}.sql'.format(table))
+            with METRICS.timer('aggregate', table_name='nutrients_agg'):
+                refresh_nutrients_agg(engine, args.nutrients_engine, args.high_threshold, args.low_threshold)
+        if args.parquet_dir:
+            export_parquet(engine, args.parquet_dir, args.buckets)
+    finally:
+        finish_run(args)
     
 	
 	
 if __name__ == "__main__":
 	main()
-
-
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared database layer for the worldfood scripts:
+
+- get_engine: one pooled engine per process for the EDW, from secrets.yaml
+- get_table: table metadata built once from the column types the scripts
+  declare (PRODUCT_TABLES, REFERENCE_TABLES, ...), so writes never reflect
+  the database
+- read_sql: reads into a DataFrame on a pooled connection, and
+  read_sql_chunks: large reads streamed through a server-side cursor
+"""
+
+
+#Import packages
+import functools
+import os
+
+import pandas as pd
+import sqlalchemy as sa
+import yaml
+
+
+
+#Credentials file (saved in the working directory)
+SECRETS_PATH = 'secrets.yaml'
+
+#Connection pool of an engine. Scripts write on one connection at a time, with
+#a few more for the metrics, heartbeats and dimension lookups. Connections
+#are checked before use and recycled ahead of server idle timeouts, so a
+#dropped connection is replaced rather than failing a write hours into a crawl;
+#the most recently used connection is reused first, so idle ones can expire
+POOL_SETTINGS = {'pool_size': 5,
+                 'max_overflow': 5,
+                 'pool_pre_ping': True,
+                 'pool_recycle': 1800,
+                 'pool_use_lifo': True}
+
+#Settings of PostgreSQL sessions. Some drivers prepare statements that repeat
+#(psycopg 3 after 5 runs, asyncpg always; psycopg2 never, and its inserts go
+#through COPY instead), and after a few runs PostgreSQL
+#switches to a generic plan, which for the deletes by key (planned when the
+#tables were small) is a sequential scan that grows with the table. Custom
+#plans keep using the key indexes
+SERVER_SETTINGS = {'plan_cache_mode': 'force_custom_plan'}
+
+#Rows fetched per round trip by streamed reads (read_sql_chunks)
+READ_CHUNK_SIZE = 50000
+
+
+#Function to create an engine with the shared pool and session settings
+def create_engine(url, **kwargs):
+    url = sa.engine.make_url(url)
+    if url.get_backend_name() == 'postgresql':
+        options = ' '.join('-c {}={}'.format(name, value) for name, value in SERVER_SETTINGS.items())
+        kwargs.setdefault('connect_args', {'options': options})
+    return sa.create_engine(url, **dict(POOL_SETTINGS, **kwargs))
+
+
+#Get credentials stored in secrets.yaml file (saved in same directory)
+#(Note: Nuvalence credentials have read access only).
+#The engine is created once per process and shared by all callers
+@functools.lru_cache(maxsize=None)
+def get_engine(secrets_path=SECRETS_PATH, section='EDW'):
+
+    if not os.path.isfile(secrets_path):
+        raise FileNotFoundError('database credentials not found: {}'.format(secrets_path))
+    with open(secrets_path, 'r') as stream:
+        credentials = yaml.safe_load(stream)[section]
+
+    url = sa.engine.URL.create('postgresql',
+                               username=credentials['user'],
+                               password=credentials['password'],
+                               host=credentials['endpoint'],
+                               port=credentials['port'],
+                               database=credentials['database'])
+    return create_engine(url)
+
+
+#Tables built by get_table, by (schema, name, columns)
+_tables = {}
+
+
+#Function to get the metadata of a table from its column types (column name ->
+#SQLAlchemy type), built once. Statements on the same Table object share
+#SQLAlchemy's compiled statement cache
+def get_table(name, dtype, schema='worldfood'):
+    key = (schema, name, tuple((column, repr(column_type)) for column, column_type in dtype.items()))
+    table = _tables.get(key)
+    if table is None:
+        table = sa.Table(name, sa.MetaData(), *[sa.Column(column, column_type) for column, column_type in dtype.items()],
+                         schema=schema)
+        _tables[key] = table
+    return table
+
+
+#Function to read a query into a DataFrame on one of the engine's pooled
+#connections. Same arguments as pandas.read_sql. For large results consumed a
+#chunk at a time, see read_sql_chunks
+def read_sql(query, engine, params=None):
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+
+#Function to iterate over the rows of a query as DataFrames of up to `chunksize`
+#rows, streamed through a server-side cursor, so only one chunk is held (by the
+#driver and pandas) at a time. Callers keep what they need of each chunk;
+#concatenating them all back is slower than one read_sql
+def read_sql_chunks(query, engine, params=None, chunksize=READ_CHUNK_SIZE):
+    with engine.connect().execution_options(stream_results=True, max_row_buffer=chunksize) as conn:
+        yield from pd.read_sql(query, conn, params=params, chunksize=chunksize)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dictionary encoding of repeated tag strings (nutrient names, allergen, 
+ingredient, brand and category tags) as small integer surrogate keys, stored
+in worldfood dimension tables.
+"""
+
+
+#Import packages
+import pandas as pd
+import sqlalchemy as sa
+
+
+
+#Interns tags into integer keys held in a worldfood.<table> dimension table
+#(key column, tag column, plus optional attribute columns derived from the tag).
+#Keys already seen are cached in-process (per database), so most batches need
+#no database round trip. Unknown tags are inserted on the fly, in their own transaction, so
+#keys stay valid even if the data transaction using them is rolled back.
+#Concurrent writers are safe: the tag column is unique and keys come from an
+#identity column
+class TagDictionary:
+
+    def __init__(self, table, tag_column, key_column, key_type='INTEGER', attributes=None, schema='worldfood'):
+        self.table = table
+        self.tag_column = tag_column
+        self.key_column = key_column
+        self.key_type = key_type
+        self.attributes = attributes or {}
+        self.schema = schema
+        self._keys = {}
+        self._created = set()
+
+    #Column types of the dimension table
+    @property
+    def dtype(self):
+        key_type = sa.types.SMALLINT() if self.key_type == 'SMALLINT' else sa.types.INTEGER()
+        return dict({self.key_column: key_type, self.tag_column: sa.types.VARCHAR(length=255)},
+                    **{column: sa.types.VARCHAR(length=255) for column in self.attributes})
+
+    def create_table(self, conn):
+        if conn.dialect.name == 'sqlite':
+            key_sql = '{} INTEGER PRIMARY KEY'.format(self.key_column)
+        else:
+            key_sql = '{} {} GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY'.format(self.key_column, self.key_type)
+        columns = [key_sql, '{} VARCHAR(255) NOT NULL UNIQUE'.format(self.tag_column)]
+        columns += ['{} VARCHAR(255)'.format(column) for column in self.attributes]
+        conn.execute(sa.text('create table if not exists {}.{} ({})'.format(self.schema, self.table, ', '.join(columns))))
+
+    #Function to get the cached keys (tag -> key) for a database
+    def keys(self, engine):
+        return self._keys.setdefault(engine.url, {})
+
+    #Function to load the keys of the given tags from the dimension table into the cache
+    def _load(self, conn, tags, chunk_size=1000):
+        keys = self.keys(conn.engine)
+        statement = sa.text('select {}, {} from {}.{} where {} in :tags'.format(self.key_column, self.tag_column,
+                                                                             self.schema, self.table, self.tag_column))\
+            .bindparams(sa.bindparam('tags', expanding=True))
+        for i in range(0, len(tags), chunk_size):
+            for key, tag in conn.execute(statement, {'tags': tags[i:i+chunk_size]}):
+                keys[tag] = key
+
+    #Function to make sure all tags have keys, inserting unknown ones
+    def intern(self, engine, tags):
+
+        keys = self.keys(engine)
+        missing = [tag for tag in tags if tag not in keys]
+        if not missing:
+            return
+
+        with engine.begin() as conn:
+            if engine.url not in self._created:
+                self.create_table(conn)
+                self._created.add(engine.url)
+
+            self._load(conn, missing)
+            #Inserted in sorted order, so concurrent writers interning the
+            #same tags wait on each other rather than deadlock
+            missing = sorted(tag for tag in missing if tag not in keys)
+            if missing:
+                columns = [self.tag_column] + list(self.attributes)
+                statement = sa.text('insert into {}.{} ({}) values ({}) on conflict ({}) do nothing'.format(
+                    self.schema, self.table, ', '.join(columns), ', '.join(':' + column for column in columns), self.tag_column))
+                conn.execute(statement, [dict({self.tag_column: tag}, **{column: attribute(tag) for column, attribute in self.attributes.items()})
+                                         for tag in missing])
+                self._load(conn, missing)
+
+    #Function to encode a Series of tags as a Series of integer keys
+    def encode(self, engine, tags):
+        self.intern(engine, pd.unique(tags.dropna()).tolist())
+        return tags.map(self.keys(engine)).astype('Int64')
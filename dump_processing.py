@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load a local Open Food Facts JSONL export (one product per line, optionally
+gzip-compressed) into the worldfood product tables.
+
+The file is decoded line by line and flattened in chunks, so memory stays
+bounded however large the dump is.
+
+Usage:
+    python dump_processing.py openfoodfacts-products.jsonl.gz [--chunk-size 20000]
+"""
+
+
+#Import packages
+import argparse
+import gzip
+import itertools
+import os
+import resource
+import time
+
+import pandas as pd
+import sqlalchemy as sa
+
+from api_product_processing import (DEAD_LETTERS_DTYPE, PRODUCT_TABLES, REPLACE_KEYS, flatten_products,
+                                    get_dead_letter_df, get_write_buffer, prepare_tables)
+from bulk_load import write_tables
+from db import get_engine
+from json_stream import loads
+from metrics import METRICS, add_metrics_arguments, finish_run, start_run
+
+
+
+#Tables written for a dump: the product tables, and dead letters of the products
+#that could not be loaded (cleared once a product is loaded)
+DUMP_TABLES = dict(PRODUCT_TABLES, dead_letters=DEAD_LETTERS_DTYPE)
+
+DUMP_REPLACE_KEYS = dict({table: REPLACE_KEYS[table] for table in PRODUCT_TABLES},
+                         dead_letters=('products', 'product_id'))
+
+
+#Function to open a dump as text, decompressing gzip files (detected by magic bytes)
+def open_dump(path):
+    with open(path, 'rb') as stream:
+        is_gzip = stream.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+#Function to get the source recorded in the dead letters of a dump's lines
+def get_dump_source(path):
+    return os.path.abspath(path)[-255:]
+
+
+#Function to delete the dead letters of a dump's lines that failed to decode,
+#before the dump is loaded again (its products' dead letters are replaced by
+#product_id as they are written)
+def clear_decode_errors(engine, path):
+    with engine.begin() as conn:
+        if sa.inspect(conn).has_table('dead_letters', schema='worldfood'):
+            conn.execute(sa.text("delete from worldfood.dead_letters where stage = 'decode' and source = :source"),
+                         {'source': get_dump_source(path)})
+
+
+#Function to stream products from a JSONL dump, one decoded line at a time.
+#Lines that cannot be decoded raise, or if given an `errors` list, have their
+#dead letter (with the dump as source, and the line number) appended to it and
+#are skipped
+def iter_dump_products(path, errors=None):
+    with open_dump(path) as stream:
+        for line_number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    product = loads(line)
+                except ValueError as error:
+                    if errors is None:
+                        raise
+                    errors.append(get_dead_letter_df(ValueError('line {}: {}'.format(line_number, error)), 'decode',
+                                                      source=get_dump_source(path)))
+                    continue
+                #Dump records always carry _id, but not always the API's id field
+                product.setdefault('id', product.get('_id'))
+                yield product
+
+
+#Function to group an iterable into lists of at most `size` items
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+#Function to get the peak resident memory of this process, in MB
+def get_peak_memory_mb():
+    #ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+#Function to flatten a chunk of products. If the chunk fails to flatten, its
+#products are flattened one at a time, and those that fail are dead-lettered
+def flatten_chunk(chunk):
+    try:
+        return flatten_products(chunk)
+    except Exception:
+        pass
+
+    product_tables = []
+    dead_letters = []
+    for product in chunk:
+        try:
+            product_tables.append(flatten_products([product]))
+        except Exception as error:
+            product_id = pd.to_numeric(pd.Series([product.get('id')]), errors='coerce').iloc[0]
+            dead_letters.append(get_dead_letter_df(error, 'parse', product_id=None if pd.isnull(product_id) else int(product_id)))
+    print('{:,} products failed to flatten, see worldfood.dead_letters'.format(len(dead_letters)))
+    tables = {table: pd.concat([tables[table] for tables in product_tables], ignore_index=True)
+              for table in PRODUCT_TABLES} if product_tables else {}
+    tables['dead_letters'] = pd.concat(dead_letters, ignore_index=True)
+    return tables
+
+
+#Function to get the rows of a chunk's tables for some of its products
+def _select_products(tables, product_ids):
+    return {table: df[df['product_id'].isin(product_ids)] for table, df in tables.items()}
+
+
+#Function to write the products of a chunk that failed to write, halving them
+#until the products that fail on their own are isolated. Returns the dead
+#letters of those products
+def write_products(engine, tables, product_ids, error):
+    if len(product_ids) == 1:
+        product_id = pd.to_numeric(pd.Series(product_ids), errors='coerce').iloc[0]
+        return [get_dead_letter_df(error, 'write', product_id=None if pd.isnull(product_id) else int(product_id))]
+
+    dead_letters = []
+    for half in (product_ids[:len(product_ids)//2], product_ids[len(product_ids)//2:]):
+        try:
+            write_tables(_select_products(tables, half), engine, DUMP_TABLES, DUMP_REPLACE_KEYS, prepare_tables)
+        except Exception as half_error:
+            dead_letters += write_products(engine, tables, half, half_error)
+    return dead_letters
+
+
+#Function to get the tables written instead of a chunk that failed to write
+#(see WriteBuffer): its products are written in smaller transactions, and
+#the dead letters of those that still fail are returned
+def get_write_error_tables(engine, tables, error):
+    product_ids = pd.unique(pd.concat([df['product_id'] for df in tables.values()], ignore_index=True)).tolist()
+    dead_letters = write_products(engine, tables, product_ids, error)
+    print('{:,} products failed to write, see worldfood.dead_letters'.format(len(dead_letters)))
+    return {'dead_letters': pd.concat(dead_letters, ignore_index=True)} if dead_letters else None
+
+
+#Function to load a dump into the product tables. Every `chunk_size` products
+#are flattened together and written in one transaction (replacing existing rows
+#for the same products, so re-loading a dump is idempotent). Records that fail
+#to decode, flatten or write are dead-lettered and the load goes on (lines
+#that failed to decode in a previous load of the dump are cleared first)
+def process_dump(engine, path, chunk_size=20000):
+
+    products = 0
+    rows = 0
+    errors = []
+    start = time.perf_counter()
+    clear_decode_errors(engine, path)
+
+    with get_write_buffer(engine, batch_pages=1, dtypes=DUMP_TABLES, replace_keys=DUMP_REPLACE_KEYS,
+                          on_error=lambda tables, error: get_write_error_tables(engine, tables, error)) as buffer:
+        for chunk in iter_chunks(iter_dump_products(path, errors), chunk_size):
+            with METRICS.timer('flatten'):
+                tables = flatten_chunk(chunk)
+            if errors:
+                tables['dead_letters'] = pd.concat(([tables['dead_letters']] if 'dead_letters' in tables else []) + errors,
+                                                   ignore_index=True)
+                print('{:,} lines failed to decode, see worldfood.dead_letters'.format(len(errors)))
+                errors.clear()
+            buffer.add(tables)
+
+            products += len(chunk)
+            rows += sum(len(df) for df in tables.values())
+            print('{:,} products, {:,.0f} products/sec'.format(products, products/(time.perf_counter() - start)))
+
+        #Lines after the last product
+        if errors:
+            print('{:,} lines failed to decode, see worldfood.dead_letters'.format(len(errors)))
+            buffer.add({'dead_letters': pd.concat(errors, ignore_index=True)})
+
+    elapsed = time.perf_counter() - start
+    results = {'products': products,
+               'rows': rows,
+               'seconds': elapsed,
+               'products_per_sec': products/elapsed if elapsed else 0.,
+               'peak_memory_mb': get_peak_memory_mb()}
+    print('{products:,} products ({rows:,} rows) in {seconds:.1f}s: {products_per_sec:,.0f} products/sec, '
+          'peak memory {peak_memory_mb:,.0f} MB'.format(**results))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='Open Food Facts JSONL export (.jsonl or .jsonl.gz)')
+    parser.add_argument('--chunk-size', type=int, default=20000, help='products flattened and written per transaction')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    engine=get_engine()
+    start_run('dump_processing', engine, args)
+    try:
+        process_dump(engine, args.path, args.chunk_size)
+    finally:
+        finish_run(args)
+
+
+if __name__ == "__main__":
+    main()
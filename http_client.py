@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP helpers for the Open Food Facts API: pooled keep-alive sessions,
+retry with backoff, a per-host rate limit, conditional requests revalidating
+an on-disk cache, and an optional compressed on-disk response cache (with an
+offline replay-only mode) in front of every session GET.
+
+Crawls fetch through fetch_with_retry: timeouts, connection errors and
+retryable statuses are retried with jittered exponential backoff, and an
+AdaptiveLimit shared by the crawl's threads lowers the number of requests in
+flight when the API throttles (429/503) and raises it back as requests succeed.
+"""
+
+
+#Import packages
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+from json_stream import loads
+from metrics import METRICS
+
+
+
+BASE_URL = 'https://us.openfoodfacts.org'
+
+#Directory of the on-disk cache used by fetch_conditional
+CACHE_DIR = os.path.join('.cache', 'http')
+
+#Directory of the on-disk response cache (ResponseCache)
+RESPONSE_CACHE_DIR = os.path.join('.cache', 'responses')
+
+#Response headers kept with cached responses
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+#Statuses retried with exponential backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+#Statuses by which the API asks clients to slow down
+THROTTLE_STATUSES = (429, 503)
+
+#Timeouts (seconds) of a fetch by fetch_with_retry: to connect, and between
+#bytes received
+FETCH_TIMEOUT = (10., 60.)
+
+#Retries of a fetch by fetch_with_retry before the url is given up on
+FETCH_RETRIES = 3
+
+
+#Raised in replay-only mode for a url that is not in the response cache
+class CacheMissError(requests.exceptions.ConnectionError):
+    pass
+
+
+#On-disk cache of GET responses, keyed by the SHA-256 of the url. Each entry is
+#one gzip file holding a json header line (url, status, headers, time stored) 
+#followed by the body. Entries older than `ttl` seconds are refetched; once the
+#cache is over `max_bytes`, the least recently used entries (by file mtime, 
+#touched on every hit) are evicted. With replay=True the network is never used:
+#entries are served whatever their age and misses raise CacheMissError
+class ResponseCache:
+
+    def __init__(self, cache_dir=RESPONSE_CACHE_DIR, ttl=None, max_bytes=None, replay=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.gz')
+
+    #Function to get the cached (header, body) of a url, or None
+    def get(self, url):
+        path = self._path(url)
+        try:
+            with gzip.open(path, 'rb') as stream:
+                header = json.loads(stream.readline())
+                body = stream.read()
+        except (OSError, EOFError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        if not self.replay and self.ttl is not None and time.time() - header['stored_at'] > self.ttl:
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return header, body
+
+    #Function to store a response body (and some of its headers) for a url
+    def put(self, url, status, headers, body):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        header = {'url': url, 'status': status, 'stored_at': time.time(),
+                  'headers': {name: headers[name] for name in CACHED_HEADERS if name in headers}}
+        data = gzip.compress(json.dumps(header).encode('utf-8') + b'\n' + body, compresslevel=6)
+        
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._entries())
+            previous = os.path.getsize(path) if os.path.isfile(path) else 0
+            _write_atomic(path, data)
+            self._size += len(data) - previous
+            if self.max_bytes and self._size > self.max_bytes:
+                self._evict()
+
+    #Function to list cached entries as (mtime, path, size)
+    def _entries(self):
+        entries = []
+        for directory, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.gz'):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    #Function to remove least recently used entries until the cache is back
+    #under 90% of max_bytes (so eviction does not run on every put)
+    def _evict(self):
+        for _, path, size in sorted(self._entries()):
+            if self._size <= .9*self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+
+#Transport adapter serving GETs from a ResponseCache, and storing successful
+#network responses in it. Mounted on a session, it sits in front of every
+#session.get (retries included)
+class CachingAdapter(HTTPAdapter):
+
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+        
+        cached = self.cache.get(request.url)
+        if cached is not None:
+            header, body = cached
+            response = requests.Response()
+            response.status_code = header['status']
+            response.headers = CaseInsensitiveDict(header['headers'])
+            response._content = body
+            response._content_consumed = True
+            response.url = request.url
+            response.request = request
+            response.reason = 'OK'
+            return response
+        
+        if self.cache.replay:
+            raise CacheMissError('{} is not in the response cache (replay only)'.format(request.url), request=request)
+        
+        response = super().send(request, **kwargs)
+        if response.status_code == 200:
+            self.cache.put(request.url, response.status_code, response.headers, response.content)
+        return response
+
+
+#Response cache used by sessions from get_session unless one is passed in
+_default_cache = None
+
+
+#Function to set (or with None, unset) the response cache used by get_session
+def set_response_cache(cache):
+    global _default_cache
+    _default_cache = cache
+
+
+#Function to get the response cache set with set_response_cache (or None)
+def get_response_cache():
+    return _default_cache
+
+
+#Function to add the response cache options to a script's argument parser
+def add_cache_arguments(parser):
+    parser.add_argument('--cache', action='store_true', help='cache API responses on disk')
+    parser.add_argument('--cache-dir', default=RESPONSE_CACHE_DIR, help='response cache directory')
+    parser.add_argument('--cache-ttl', type=float, default=None, help='hours before a cached response is refetched')
+    parser.add_argument('--cache-max-mb', type=float, default=None, help='response cache size bound, least recently used evicted')
+    parser.add_argument('--replay', action='store_true', help='serve responses from the cache only, never the network')
+
+
+#Function to set up the response cache from the options of add_cache_arguments
+def configure_response_cache(args):
+    if args.cache or args.replay:
+        set_response_cache(ResponseCache(args.cache_dir,
+                                         ttl=None if args.cache_ttl is None else args.cache_ttl*3600,
+                                         max_bytes=None if args.cache_max_mb is None else int(args.cache_max_mb*2**20),
+                                         replay=args.replay))
+
+
+#Per-host rate limit: at most `rate` requests per second to any one host,
+#shared by all threads using the limiter
+class RateLimiter:
+
+    def __init__(self, rate=None):
+        self.interval = 1./rate if rate else 0.
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    #Function to reserve the next request slot for a url's host, returning the
+    #seconds to wait before sending it
+    def reserve(self, url):
+        if not self.interval:
+            return 0.
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        return slot - now
+
+    def wait(self, url):
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+
+#Function to create a keep-alive session with a connection pool sized for
+#`pool_size` concurrent requests, retrying failed GETs `retries` times with 
+#exponential backoff.
+#GETs go through `cache` (default: the one set with set_response_cache), if any
+def get_session(pool_size=10, retries=3, backoff_factor=0.5, cache=None):
+
+    #With retries=0, responses with retryable statuses are returned rather than
+    #raised, for callers that retry themselves (see fetch_with_retry)
+    retry = Retry(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=('GET',)) if retries else 0
+    cache = cache or _default_cache
+    if cache is not None:
+        adapter = CachingAdapter(cache, pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+#Function to get the number of retries urllib3 made for a response (0 for
+#responses served from the response cache)
+def _retries(response):
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
+
+
+#Function to GET a url and return the raw response body
+def fetch_content(url, session=None, rate_limiter=None, timeout=60):
+
+    if rate_limiter is not None:
+        rate_limiter.wait(url)
+
+    start = time.perf_counter()
+    response = (session or get_session(pool_size=1)).get(url, timeout=timeout)
+    response.raise_for_status()
+    content = response.content
+    METRICS.observe('fetch', time.perf_counter() - start, bytes=len(content), retries=_retries(response))
+    return content
+
+
+#Function to GET a url and hand the response body to `parse` as a binary stream,
+#read off the connection as `parse` consumes it, so the body is never held in
+#memory whole (responses from the response cache are read from memory).
+#Returns what `parse` returns
+def fetch_stream(url, session=None, rate_limiter=None, timeout=60, parse=None):
+
+    if rate_limiter is not None:
+        rate_limiter.wait(url)
+
+    start = time.perf_counter()
+    with (session or get_session(pool_size=1)).get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        if response.raw is None or response._content_consumed:
+            return parse(io.BytesIO(response.content))
+        response.raw.decode_content = True
+        try:
+            result = parse(response.raw)
+        #Errors reading the body, as requests raises them when it reads it
+        except ProtocolError as error:
+            raise requests.exceptions.ChunkedEncodingError(error)
+        except ReadTimeoutError as error:
+            raise requests.exceptions.ReadTimeout(error)
+        METRICS.observe('fetch', time.perf_counter() - start, bytes=response.raw.tell(), retries=_retries(response))
+    return result
+
+
+#Function to GET a url and decode the json response
+def fetch_json(url, session=None, rate_limiter=None, timeout=60):
+    content = fetch_content(url, session, rate_limiter, timeout)
+    with METRICS.timer('decode'):
+        return loads(content)
+
+
+#Adaptive limit on the requests in flight, shared by the threads of a crawl
+#(additive increase, multiplicative decrease): each success raises the limit by
+#1/limit, so by about one per window of requests, up to `max_limit`; a
+#throttled response halves it, down to `min_limit`. Requests started before the
+#last decrease were sent at the old limit, so their throttled responses do not
+#decrease it again. A Retry-After pause holds back all new requests
+class AdaptiveLimit:
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.throttled = 0
+        self.decreases = 0
+        self._condition = threading.Condition()
+        self._paused_until = 0.
+
+    #Function to get the seconds to wait before a request can start: 0 if a slot
+    #is free, None to wait until one is released
+    def _wait_time(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.in_flight < int(self.limit):
+            return 0.
+        return None
+
+    #Function to free a request slot and adapt the limit to how the request went
+    def _adapt(self, decreases, throttled, pause):
+        self.in_flight -= 1
+        if throttled:
+            self.throttled += 1
+            if decreases == self.decreases:
+                self.limit = max(self.min_limit, self.limit/2)
+                self.decreases += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1./self.limit)
+
+    #Function to wait for a free request slot. Returns the number of decreases
+    #so far, to pass back to release
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self._wait_time()
+                if wait == 0:
+                    break
+                self._condition.wait(wait)
+            self.in_flight += 1
+            return self.decreases
+
+    #Function to free a request slot, adapting the limit to how the request went
+    def release(self, decreases, throttled=False, pause=0.):
+        with self._condition:
+            self._adapt(decreases, throttled, pause)
+            self._condition.notify_all()
+
+
+#Function to get the seconds to wait before retrying, with "full jitter": 
+#uniform up to the exponential backoff, so clients that failed together do
+#not retry together
+def backoff_delay(attempt, backoff_factor=0.5, max_backoff=60.):
+    return random.uniform(0, min(max_backoff, backoff_factor*2**attempt))
+
+
+#Function to get the seconds of a response's Retry-After header (0 if absent,
+#or given as an HTTP date)
+def retry_after(response):
+    try:
+        return max(0., float(response.headers.get('Retry-After', 0)))
+    except (AttributeError, ValueError):
+        return 0.
+
+
+#Function to get the status of the response a fetch error came with, if any
+#(requests errors carry the response, aiohttp errors its status)
+def error_status(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', getattr(error, 'status', None))
+
+
+#Function to check whether a fetch error may succeed on retry: timeouts,
+#dropped connections and truncated bodies, and retryable statuses. Misses of
+#the replay-only response cache never will
+def is_retryable(error):
+    if isinstance(error, CacheMissError):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error_status(error) in RETRY_STATUSES
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                              requests.exceptions.ChunkedEncodingError, requests.exceptions.RetryError))
+
+
+#Function to fetch a url with `fetch` (fetch_content, fetch_json, ...), retrying
+#retryable errors (see is_retryable) up to `retries` times, after a jittered
+#backoff (see backoff_delay) or the server's Retry-After, if longer. With an
+#AdaptiveLimit, each attempt takes one of its slots. The error of the last
+#attempt is raised, with the number of attempts made as its `attempts`
+def fetch_with_retry(url, session=None, rate_limiter=None, limit=None, fetch=fetch_content, retries=FETCH_RETRIES,
+                     backoff_factor=0.5, max_backoff=60., timeout=FETCH_TIMEOUT):
+
+    for attempt in range(retries + 1):
+        throttled, pause = False, 0.
+        if limit is not None:
+            decreases = limit.acquire()
+        try:
+            return fetch(url, session, rate_limiter, timeout)
+        except Exception as error:
+            throttled = error_status(error) in THROTTLE_STATUSES
+            pause = retry_after(getattr(error, 'response', None)) if throttled else 0.
+            if attempt == retries or not is_retryable(error):
+                error.attempts = attempt + 1
+                raise
+        finally:
+            if limit is not None:
+                limit.release(decreases, throttled, pause)
+
+        delay = max(backoff_delay(attempt, backoff_factor, max_backoff), pause)
+        METRICS.observe('backoff', delay, retries=1)
+        time.sleep(delay)
+
+
+#Function to write a file atomically (readers see the old or the new file)
+def _write_atomic(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(tmp_path, 'wb') as stream:
+        stream.write(data)
+    os.replace(tmp_path, path)
+
+
+#Function to GET a url with a conditional request: the last response is kept in
+#`cache_dir` with its ETag/Last-Modified validators, which are sent with the next
+#request. The body is streamed to the cache file rather than held in memory.
+#Returns (path of the cached body, modified), modified=False if the server 
+#answered 304 Not Modified
+def fetch_conditional(url, session=None, rate_limiter=None, timeout=60, cache_dir=CACHE_DIR, chunk_size=2**20):
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    headers = {}
+    if os.path.isfile(cache_path + '.meta') and os.path.isfile(cache_path):
+        with open(cache_path + '.meta', 'r') as stream:
+            meta = json.load(stream)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    if rate_limiter is not None:
+        rate_limiter.wait(url)
+
+    start = time.perf_counter()
+    with (session or get_session(pool_size=1)).get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304 and headers:
+            METRICS.observe('fetch', time.perf_counter() - start, bytes=0, retries=_retries(response))
+            return cache_path, False
+        response.raise_for_status()
+
+        #Body first, so validators never describe a body that is not cached
+        tmp_path = '{}.{}.tmp'.format(cache_path, threading.get_ident())
+        size = 0
+        with open(tmp_path, 'wb') as stream:
+            for chunk in response.iter_content(chunk_size):
+                stream.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, cache_path)
+        METRICS.observe('fetch', time.perf_counter() - start, bytes=size, retries=_retries(response))
+
+    _write_atomic(cache_path + '.meta', json.dumps({'url': url,
+                                                    'etag': response.headers.get('ETag'),
+                                                    'last_modified': response.headers.get('Last-Modified')}).encode('utf-8'))
+    return cache_path, True
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON decoding helpers: incremental parsing of the large arrays in API
+responses (a page's products, a taxonomy's tags), one element at a time,
+without decoding the whole document first.
+
+Faster backends are used when installed: ijson (with its C backend) for
+incremental parsing and orjson for whole documents. Otherwise both fall back to
+the standard library.
+"""
+
+
+#Import packages
+import codecs
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+
+#Function to decode a whole JSON document (bytes or str)
+loads = orjson.loads if orjson is not None else json.loads
+
+
+#Reads a JSON document from a binary (or text) stream into a sliding text
+#buffer, decoding one value at a time with the standard library decoder
+class _StreamReader:
+
+    WHITESPACE = ' \t\n\r'
+    NUMBER_CHARS = '0123456789+-.eE'
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    #Function to read the next chunk, dropping the consumed part of the buffer
+    def fill(self):
+        if self.eof:
+            raise ValueError('unexpected end of JSON document')
+        chunk = self.stream.read(self.chunk_size)
+        if isinstance(chunk, bytes):
+            text = self.utf8.decode(chunk, final=not chunk)
+        else:
+            text = chunk
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+
+    #Function to skip whitespace and return the next character (not consumed)
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self.fill()
+
+    #Function to consume the next character, which must be one of `chars`
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('expected one of {!r} at offset {}, found {!r}'.format(chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    #Function to decode the next value. A number is truncated when the buffer
+    #ends inside it, which may be just after its '.', 'e' or sign (e.g. '12.'
+    #decodes as 12), so it is only accepted once non-numeric text follows it,
+    #or at EOF
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if self.eof or (end < len(self.buffer) and not (isinstance(obj, (int, float))
+                                                               and self.buffer[end] in self.NUMBER_CHARS)):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+#Function to yield the elements of the array under top-level `key` with the
+#standard library decoder. Other top-level values are decoded and skipped
+def _iter_items_stdlib(stream, key, chunk_size):
+
+    reader = _StreamReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.value()
+                if reader.expect(',]') == ']':
+                    return
+        reader.value()
+        if reader.expect(',}') == '}':
+            return
+
+
+#Function to iterate over the elements of the array under top-level `key` of
+#the JSON document in `stream` (e.g. key='products' for a page of products),
+#decoding one element at a time
+def iter_items(stream, key, chunk_size=65536):
+    if ijson is not None:
+        return ijson.items(stream, key + '.item', use_float=True)
+    return _iter_items_stdlib(stream, key, chunk_size)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipeline instrumentation: timings and counts per stage (fetch, decode,
+flatten, write, ...), recorded to worldfood.metrics, summarised with
+p50/p95/p99 per stage and optionally exported as a Prometheus text file (for
+the node_exporter textfile collector).
+
+Observations are only recorded while a run is active (start_run), in the
+process that started it.
+"""
+
+
+#Import packages
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+
+
+#Column types of worldfood.metrics, one row per observation
+METRICS_DTYPE = {'run_id': sa.types.VARCHAR(length=32),
+                 'script': sa.types.VARCHAR(length=64),
+                 'stage': sa.types.VARCHAR(length=32),
+                 'page': sa.types.INTEGER(),
+                 'table_name': sa.types.VARCHAR(length=255),
+                 'seconds': sa.types.FLOAT(),
+                 'rows': sa.types.INTEGER(),
+                 'bytes': sa.types.BIGINT(),
+                 'retries': sa.types.INTEGER(),
+                 'recorded_at': sa.types.TIMESTAMP()}
+
+#Fields of an observation, besides its stage and duration
+FIELDS = ('page', 'table_name', 'rows', 'bytes', 'retries')
+
+#Quantiles reported per stage
+QUANTILES = (.5, .95, .99)
+
+#Seconds between saves of the pending rows, if fewer than save_every are pending
+SAVE_INTERVAL = 60.
+
+
+#Collects the observations of one run. Rows for worldfood.metrics are written
+#by a background thread, once `save_every` are pending or every `save_interval`
+#seconds, never by the thread observing: observations are made inside the
+#data transactions (e.g. timers in write_tables), which a metrics write must
+#neither wait on nor fail. Durations are kept per stage (as floats only) for 
+#the summary
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._context = threading.local()
+        self.run_id = None
+        self._pid = None
+        self.engine = None
+        self._saver = None
+
+    #Function to start recording a run of `script`, saving rows to `engine`'s
+    #worldfood.metrics (if given)
+    def start_run(self, script, engine=None, save_every=10000, save_interval=SAVE_INTERVAL):
+        self.stop_saver()
+        with self._lock:
+            self.run_id = uuid.uuid4().hex
+            self.script = script
+            self.engine = engine
+            self.save_every = save_every
+            self._pid = os.getpid()
+            self._pending = []
+            self._seconds = {}
+            self._totals = {}
+            self.started = time.time()
+            self._save_requested = threading.Event()
+            self._stopped = threading.Event()
+        if engine is not None:
+            self._saver = threading.Thread(target=self._save_loop, args=(save_interval, self._save_requested, self._stopped),
+                                           daemon=True)
+            self._saver.start()
+
+    #Background saver: saves pending rows when asked to by observe, or every
+    #`interval` seconds, until stopped
+    def _save_loop(self, interval, save_requested, stopped):
+        while not stopped.is_set():
+            save_requested.wait(interval)
+            save_requested.clear()
+            if not stopped.is_set():
+                self.save()
+
+    #Function to stop the background saver (pending rows are left to save)
+    def stop_saver(self):
+        saver, self._saver = self._saver, None
+        if saver is not None:
+            self._stopped.set()
+            self._save_requested.set()
+            saver.join()
+
+    @property
+    def active(self):
+        return self.run_id is not None and self._pid == os.getpid()
+
+    #Context manager setting default fields (e.g. page) for observations made
+    #in this thread
+    @contextmanager
+    def context(self, **fields):
+        previous = getattr(self._context, 'fields', {})
+        self._context.fields = dict(previous, **fields)
+        try:
+            yield
+        finally:
+            self._context.fields = previous
+
+    #Function to record one observation of `stage`
+    def observe(self, stage, seconds, **fields):
+        if not self.active:
+            return
+        fields = dict(getattr(self._context, 'fields', {}), **fields)
+        row = (stage, seconds) + tuple(fields.get(field) for field in FIELDS) + (time.time(),)
+
+        with self._lock:
+            self._pending.append(row)
+            self._seconds.setdefault(stage, []).append(seconds)
+            for field in ('rows', 'bytes', 'retries'):
+                if fields.get(field) is not None:
+                    key = (field, stage, fields.get('table_name'))
+                    self._totals[key] = self._totals.get(key, 0) + fields[field]
+            save = self.engine is not None and len(self._pending) >= self.save_every
+
+        if save:
+            self._save_requested.set()
+
+    #Context manager timing a block as one observation of `stage`
+    @contextmanager
+    def timer(self, stage, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **fields)
+
+    #Function to write pending rows to worldfood.metrics. Metrics never fail a
+    #run: if the rows cannot be written, the error is printed and they are kept
+    #pending for the next save
+    def save(self):
+        if not self.active or self.engine is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        try:
+            self._insert(pending)
+        except Exception as error:
+            print('metrics not saved ({:,} rows pending): {}: {}'.format(len(pending), type(error).__name__, error))
+            with self._lock:
+                self._pending = pending + self._pending
+
+    #Function to insert rows into worldfood.metrics
+    def _insert(self, pending):
+        df = pd.DataFrame(pending, columns=['stage', 'seconds'] + list(FIELDS) + ['recorded_at'])
+        df['recorded_at'] = pd.to_datetime(df['recorded_at'], unit='s')
+        for column in ('page', 'rows', 'bytes', 'retries'):
+            df[column] = df[column].astype('Int64')
+        df.insert(0, 'run_id', self.run_id)
+        df.insert(1, 'script', self.script)
+
+        #Imported here, as bulk_load itself records write timings
+        from bulk_load import bulk_insert
+        with self.engine.begin() as conn:
+            bulk_insert(df[list(METRICS_DTYPE)], 'metrics', conn, dtype=METRICS_DTYPE)
+
+    #Function to get per stage counts, totals and quantiles of durations
+    def summary(self):
+        with self._lock:
+            seconds = {stage: np.array(values) for stage, values in self._seconds.items()}
+        return {stage: dict({'count': len(values), 'total': values.sum()},
+                            **{'p{:g}'.format(q*100): np.quantile(values, q) for q in QUANTILES})
+                for stage, values in seconds.items()}
+
+    #Function to get the run's totals of rows, bytes and retries, keyed by
+    #(field, stage, table_name)
+    def totals(self):
+        with self._lock:
+            return dict(self._totals)
+
+    def report(self):
+        print('{:<10} {:>8} {:>10} {:>9} {:>9} {:>9}'.format('stage', 'count', 'total s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for stage, stats in sorted(self.summary().items(), key=lambda item: -item[1]['total']):
+            print('{:<10} {:>8,} {:>10.2f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                stage, stats['count'], stats['total'], stats['p50']*1000, stats['p95']*1000, stats['p99']*1000))
+        totals = {}
+        for (field, stage, table_name), value in self.totals().items():
+            totals[(field, stage)] = totals.get((field, stage), 0) + value
+        for (field, stage), value in sorted(totals.items()):
+            print('{} {}: {:,}'.format(stage, field, value))
+
+    #Function to write the run's summary as a Prometheus text file. Written
+    #atomically, so a collector never reads a partial file
+    def write_prometheus(self, path):
+        labels = 'script="{}"'.format(self.script)
+        lines = ['# HELP worldfood_stage_seconds Time spent per pipeline stage in the last run',
+                 '# TYPE worldfood_stage_seconds summary']
+        for stage, stats in sorted(self.summary().items()):
+            stage_labels = '{},stage="{}"'.format(labels, stage)
+            for q in QUANTILES:
+                lines.append('worldfood_stage_seconds{{{},quantile="{:g}"}} {:.6f}'.format(stage_labels, q, stats['p{:g}'.format(q*100)]))
+            lines.append('worldfood_stage_seconds_sum{{{}}} {:.6f}'.format(stage_labels, stats['total']))
+            lines.append('worldfood_stage_seconds_count{{{}}} {}'.format(stage_labels, stats['count']))
+
+        for field in ('rows', 'bytes', 'retries'):
+            lines += ['# HELP worldfood_{}_total {} per stage (and table) in the last run'.format(field, field.capitalize()),
+                      '# TYPE worldfood_{}_total counter'.format(field)]
+            for (total_field, stage, table_name), value in sorted(self.totals().items(), key=str):
+                if total_field == field:
+                    table_label = ',table="{}"'.format(table_name) if table_name else ''
+                    lines.append('worldfood_{}_total{{{},stage="{}"{}}} {}'.format(field, labels, stage, table_label, value))
+
+        lines += ['# HELP worldfood_last_run_timestamp_seconds Start time of the last run',
+                  '# TYPE worldfood_last_run_timestamp_seconds gauge',
+                  'worldfood_last_run_timestamp_seconds{{{}}} {:.0f}'.format(labels, self.started)]
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as stream:
+            stream.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+#Metrics of the current run, shared by all modules
+METRICS = Metrics()
+
+
+#Function to add the metrics options to a script's argument parser
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-file', default=None, help='write a Prometheus text file of run metrics to this path')
+    parser.add_argument('--no-metrics-table', action='store_true', help='do not record metrics in worldfood.metrics')
+
+
+#Function to start recording a script's run, with the options of add_metrics_arguments
+def start_run(script, engine, args):
+    METRICS.start_run(script, None if args.no_metrics_table else engine)
+
+
+#Function to finish a run: saves the remaining rows, prints the summary report
+#and writes the Prometheus file, if asked for
+def finish_run(args):
+    METRICS.stop_saver()
+    METRICS.save()
+    METRICS.report()
+    if args.metrics_file:
+        METRICS.write_prometheus(args.metrics_file)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Staged, multi-process product page pipeline:
+
+1. fetch   - page bodies fetched concurrently (see fetch_pages), undecoded
+2. parse   - incremental JSON decoding and flattening in a ProcessPoolExecutor
+3. write   - a single writer thread that owns the database connection and
+             writes batches through WriteBuffer
+
+Stages are connected by bounded queues, so a slow stage holds back the ones
+before it. Pages are written (and logged) in page order.
+
+Usage:
+    python pipeline.py [--page 1 | --resume] [--workers 4] [--concurrency 8] [--cache | --replay]
+"""
+
+
+#Import packages
+import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+
+from api_product_processing import (PAGE_URL, fetch_pages, get_error_tables, get_resume_page, get_write_buffer,
+                                    parse_page_tables)
+from db import get_engine
+from http_client import (BASE_URL, add_cache_arguments, configure_response_cache, fetch_content, fetch_json,
+                         fetch_with_retry, get_session)
+from metrics import METRICS, add_metrics_arguments, finish_run, start_run
+
+
+
+#Parse stage: decode and flatten one page body (runs in a worker process).
+#Returns the page's tables and the parse time, which workers cannot record
+#themselves (metrics are recorded by the main process)
+def parse_page(page, content):
+    start = time.perf_counter()
+    try:
+        tables = parse_page_tables(page, content)
+    except Exception as error:
+        tables = get_error_tables(page, error)
+    return tables, time.perf_counter() - start
+
+
+#Write stage: takes (page, parse future) off the queue in page order and hands
+#their tables to the write buffer, until it receives None
+def _write_stage(futures, buffer, errors):
+    try:
+        while True:
+            item = futures.get()
+            if item is None:
+                return
+            page, future = item
+            tables, seconds = future.result()
+            METRICS.observe('parse', seconds, page=page)
+            buffer.add(tables)
+    except BaseException as error:
+        errors.append(error)
+        #Keep draining so the producer is never blocked on a full queue
+        while futures.get() is not None:
+            pass
+
+
+#Function to run the pipeline over the given pages.
+#`workers` parse processes, `concurrency` fetches in flight, and at most
+#`queue_size` pages parsed or parsing ahead of the writer. Pages that cannot be
+#fetched are dead-lettered (see get_error_tables) without a parse
+def run_pipeline(engine, pages, workers=None, concurrency=4, prefetch=None, rate_limit=None,
+                 base_url=BASE_URL, batch_pages=10, batch_rows=None, queue_size=None):
+
+    workers = workers or os.cpu_count()
+    queue_size = queue_size or 2*workers
+    futures = queue.Queue(maxsize=queue_size)
+    errors = []
+    cnt = 0
+    start = time.perf_counter()
+
+    with get_write_buffer(engine, batch_pages, batch_rows) as buffer:
+        writer = threading.Thread(target=_write_stage, args=(futures, buffer, errors), name='writer')
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            writer.start()
+            try:
+                for page, content in fetch_pages(pages, concurrency, prefetch, rate_limit, base_url,
+                                                 fetch=fetch_content, return_exceptions=True):
+                    if errors:
+                        break
+                    if isinstance(content, Exception):
+                        future = Future()
+                        future.set_result((get_error_tables(page, content, stage='fetch'), 0.))
+                    else:
+                        future = pool.submit(parse_page, page, content)
+                    futures.put((page, future))
+
+                    #Logging
+                    cnt += 1
+                    if np.mod(cnt,10) == 0:
+                        print(cnt)
+            finally:
+                #Ordered shutdown: stop fetching, let the writer drain what was
+                #parsed, then stop the workers. The buffer flushes on exit
+                futures.put(None)
+                writer.join()
+
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    print('{:,} pages in {:.1f}s ({:,.1f} pages/sec, {} workers)'.format(cnt, elapsed, cnt/elapsed, workers))
+    return {'pages': cnt, 'seconds': elapsed, 'workers': workers}
+
+
+#Function to run the pipeline over all product pages, from page_num on
+def run_all_pages(engine, page_num, **kwargs):
+    session = get_session(retries=0)
+    all_food_products = fetch_with_retry(PAGE_URL.format(kwargs.get('base_url', BASE_URL), 1), session, fetch=fetch_json)
+    num_pages = int(np.ceil(all_food_products['count']/24.))
+    return run_pipeline(engine, range(page_num, num_pages+1), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', type=int, default=1, help='page to start processing at')
+    parser.add_argument('--resume', action='store_true', help='start after the last page in worldfood.logging')
+    parser.add_argument('--workers', type=int, default=None, help='parse processes (default: one per core)')
+    parser.add_argument('--concurrency', type=int, default=4, help='page requests in flight')
+    parser.add_argument('--rate-limit', type=float, default=None, help='max requests/sec to the API host')
+    parser.add_argument('--batch-pages', type=int, default=10, help='pages written per transaction')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    configure_response_cache(args)
+    engine=get_engine()
+    start_run('pipeline', engine, args)
+    try:
+        page_num=get_resume_page(engine) if args.resume else args.page
+        run_all_pages(engine, page_num, workers=args.workers, concurrency=args.concurrency,
+                      rate_limit=args.rate_limit, batch_pages=args.batch_pages)
+    finally:
+        finish_run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sharded crawl of the product pages by any number of worker processes, on any
+number of hosts, coordinated through a PostgreSQL work table
+(worldfood.crawl_leases):
+
+1. init   - the coordinator splits pages 1..num_pages into leases of
+            --lease-pages pages, and creates the tables workers write
+2. work   - workers claim leases (select ... for update skip locked), process
+            their pages with process_pages and heartbeat while they do. A lease
+            whose heartbeat is older than --lease-timeout is reclaimed by the
+            next worker asking, so leases of crashed workers are picked up
+3. status - leases by status, and progress in worldfood.logging
+
+Pages are written and logged in worldfood.logging as in a single process
+crawl, and rewriting a page is idempotent, so a reclaimed lease can safely be
+processed again. Times come from the database clock, so hosts need not agree.
+
+Usage:
+    python sharded_crawl.py init [--page 1] [--lease-pages 100]
+    python sharded_crawl.py work [--crawl-id ID] [--concurrency 4] [--lease-timeout 300]
+    python sharded_crawl.py status [--crawl-id ID]
+"""
+
+
+#Import packages
+import argparse
+import itertools
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from api_product_processing import PAGE_URL, REPLACE_KEYS, TAG_DICTIONARIES, WRITE_TABLES, process_pages
+from bulk_load import create_tables
+from db import get_engine
+from http_client import BASE_URL, add_cache_arguments, configure_response_cache, fetch_json, fetch_with_retry, get_session
+from metrics import add_metrics_arguments, finish_run, start_run
+
+
+
+#Work table: one row per lease of a crawl
+LEASES_DDL = """
+create table if not exists worldfood.crawl_leases (
+    crawl_id VARCHAR(64) NOT NULL
+    ,lease_id INTEGER NOT NULL
+    ,first_page INTEGER NOT NULL
+    ,last_page INTEGER NOT NULL
+    ,status VARCHAR(16) NOT NULL DEFAULT 'pending'
+    ,worker VARCHAR(255)
+    ,attempts INTEGER NOT NULL DEFAULT 0
+    ,created_at TIMESTAMP NOT NULL DEFAULT now()
+    ,claimed_at TIMESTAMP
+    ,heartbeat_at TIMESTAMP
+    ,completed_at TIMESTAMP
+    ,error TEXT
+    ,PRIMARY KEY (crawl_id, lease_id)
+)
+"""
+
+#Claims the first lease that is pending, or claimed but without a heartbeat
+#for `lease_timeout` seconds. Rows locked by other claims are skipped rather
+#than waited for, so workers never block each other
+CLAIM_LEASE = """
+update worldfood.crawl_leases l
+set
+    status = 'claimed'
+    ,worker = :worker
+    ,attempts = l.attempts + 1
+    ,claimed_at = now()
+    ,heartbeat_at = now()
+    ,error = null
+where
+    (l.crawl_id, l.lease_id) = (
+        select crawl_id, lease_id
+        from worldfood.crawl_leases
+        where
+            crawl_id = :crawl_id
+            and attempts < :max_attempts
+            and (status = 'pending'
+                 or (status = 'claimed' and heartbeat_at < now() - make_interval(secs => :lease_timeout)))
+        order by first_page
+        limit 1
+        for update skip locked
+    )
+returning l.lease_id, l.first_page, l.last_page, l.attempts
+"""
+
+#Leases out of attempts are marked failed instead of being reclaimed
+FAIL_EXPIRED_LEASES = """
+update worldfood.crawl_leases
+set status = 'failed'
+where
+    crawl_id = :crawl_id
+    and attempts >= :max_attempts
+    and status = 'claimed'
+    and heartbeat_at < now() - make_interval(secs => :lease_timeout)
+"""
+
+
+#Function to check the database can hold the work table
+def _check_postgresql(engine):
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('sharded crawls lease pages with select ... for update skip locked and need a PostgreSQL database, '
+                         'not {}'.format(engine.dialect.name))
+
+
+#Function to get the name a worker claims leases under
+def get_worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+#Function to split pages first_page..last_page into leases of `lease_pages` pages
+#for a new crawl, and create the tables the workers write (so they do not race
+#to create them). Returns the crawl id
+def create_leases(engine, last_page, first_page=1, lease_pages=100, crawl_id=None):
+
+    _check_postgresql(engine)
+    crawl_id = crawl_id or pd.Timestamp.now('UTC').strftime('%Y%m%dT%H%M%S')
+
+    create_tables(engine, WRITE_TABLES, REPLACE_KEYS)
+    with engine.begin() as conn:
+        for _, dictionary in TAG_DICTIONARIES.values():
+            dictionary.create_table(conn)
+        conn.execute(sa.text(LEASES_DDL))
+        conn.execute(sa.text('insert into worldfood.crawl_leases (crawl_id, lease_id, first_page, last_page) '
+                             'values (:crawl_id, :lease_id, :first_page, :last_page)'),
+                     [{'crawl_id': crawl_id, 'lease_id': lease_id, 'first_page': page,
+                       'last_page': min(page + lease_pages - 1, last_page)}
+                      for lease_id, page in enumerate(range(first_page, last_page + 1, lease_pages))])
+    return crawl_id
+
+
+#Function to get the most recently created crawl
+def get_latest_crawl(engine):
+    with engine.connect() as conn:
+        return conn.execute(sa.text('select crawl_id from worldfood.crawl_leases order by created_at desc limit 1')).scalar()
+
+
+#Function to claim a lease for `worker`. Returns (lease_id, first_page, last_page,
+#attempts), or None if no lease is available right now
+def claim_lease(engine, crawl_id, worker, lease_timeout=300, max_attempts=3):
+    params = {'crawl_id': crawl_id, 'worker': worker, 'lease_timeout': lease_timeout, 'max_attempts': max_attempts}
+    with engine.begin() as conn:
+        conn.execute(sa.text(FAIL_EXPIRED_LEASES), params)
+        return conn.execute(sa.text(CLAIM_LEASE), params).first()
+
+
+#Function to update a lease still held by `worker`. Returns False if the lease
+#was lost (reclaimed by another worker after expiring)
+def update_lease(engine, crawl_id, lease_id, worker, status='claimed', error=None):
+    with engine.begin() as conn:
+        result = conn.execute(sa.text("""
+            update worldfood.crawl_leases
+            set
+                status = cast(:status as varchar)
+                ,heartbeat_at = now()
+                ,completed_at = case when cast(:status as varchar) = 'done' then now() else null end
+                ,worker = case when cast(:status as varchar) = 'pending' then null else worker end
+                ,error = :error
+            where crawl_id = :crawl_id and lease_id = :lease_id and worker = :worker and status = 'claimed'
+            """), {'crawl_id': crawl_id, 'lease_id': lease_id, 'worker': worker, 'status': status, 'error': error})
+    return result.rowcount == 1
+
+
+#Function to check whether a crawl has leases left to process (pending, or
+#claimed by a worker that may still finish or expire)
+def has_open_leases(engine, crawl_id, max_attempts=3):
+    with engine.connect() as conn:
+        return conn.execute(sa.text("select count(*) from worldfood.crawl_leases "
+                                    "where crawl_id = :crawl_id and (status = 'claimed' or "
+                                    "(status = 'pending' and attempts < :max_attempts))"),
+                            {'crawl_id': crawl_id, 'max_attempts': max_attempts}).scalar() > 0
+
+
+#Heartbeats a lease every `interval` seconds in a background thread while its
+#pages are processed. Sets `lost` if the lease was reclaimed by another worker
+class LeaseHeartbeat:
+
+    def __init__(self, engine, crawl_id, lease_id, worker, interval):
+        self.engine = engine
+        self.crawl_id = crawl_id
+        self.lease_id = lease_id
+        self.worker = worker
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not update_lease(self.engine, self.crawl_id, self.lease_id, self.worker):
+                    self.lost.set()
+                    return
+            except sa.exc.DBAPIError as error:
+                #A missed heartbeat only shortens the lease; keep trying
+                print('heartbeat of lease {} failed: {}'.format(self.lease_id, error))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+#Function to run a worker: claims and processes leases of a crawl until none
+#are left. While other workers still hold leases, it polls every `poll_interval`
+#seconds, to take over leases whose worker stops heartbeating.
+#Returns the number of leases the worker completed
+def run_worker(engine, crawl_id=None, concurrency=1, prefetch=None, rate_limit=None, base_url=BASE_URL,
+               batch_pages=10, stream=False, lease_timeout=300, max_attempts=3, poll_interval=10, worker=None):
+
+    _check_postgresql(engine)
+    crawl_id = crawl_id or get_latest_crawl(engine)
+    worker = worker or get_worker_name()
+    create_tables(engine, WRITE_TABLES, REPLACE_KEYS)
+    session = get_session(pool_size=concurrency, retries=0)
+    completed = 0
+
+    while True:
+        lease = claim_lease(engine, crawl_id, worker, lease_timeout, max_attempts)
+        if lease is None:
+            if not has_open_leases(engine, crawl_id, max_attempts):
+                break
+            time.sleep(poll_interval)
+            continue
+
+        lease_id, first_page, last_page, attempts = lease
+        print('{} processing lease {} (pages {}-{}, attempt {})'.format(worker, lease_id, first_page, last_page, attempts))
+        try:
+            with LeaseHeartbeat(engine, crawl_id, lease_id, worker, lease_timeout/3.) as heartbeat:
+                #Stop early if the lease is lost: another worker is processing it
+                pages = itertools.takewhile(lambda page: not heartbeat.lost.is_set(), range(first_page, last_page + 1))
+                process_pages(engine, pages, concurrency, prefetch, rate_limit, base_url, batch_pages,
+                              session=session, stream=stream)
+        except BaseException as error:
+            #Hand the lease back for another attempt, or fail it once out of attempts
+            update_lease(engine, crawl_id, lease_id, worker, status='pending' if attempts < max_attempts else 'failed',
+                         error=repr(error)[:1000])
+            if not isinstance(error, Exception):
+                raise
+            print('{} released lease {} after an error: {!r}'.format(worker, lease_id, error))
+            continue
+
+        if heartbeat.lost.is_set() or not update_lease(engine, crawl_id, lease_id, worker, status='done'):
+            print('{} lost lease {} to another worker'.format(worker, lease_id))
+        else:
+            completed += 1
+
+    print('{} done: {} leases completed'.format(worker, completed))
+    return completed
+
+
+#Function to get a crawl's progress: leases and pages by lease status, and
+#pages of its range logged in worldfood.logging (successfully and with errors)
+def get_crawl_status(engine, crawl_id=None):
+    crawl_id = crawl_id or get_latest_crawl(engine)
+    with engine.connect() as conn:
+        leases = pd.read_sql(sa.text('select status, count(*) leases, sum(last_page - first_page + 1) pages '
+                                     'from worldfood.crawl_leases where crawl_id = :crawl_id group by status order by status'),
+                             conn, params={'crawl_id': crawl_id})
+        logged = conn.execute(sa.text("""
+            select
+                count(distinct case when not error_processing then page end)
+                ,count(distinct case when error_processing then page end)
+            from worldfood.logging
+            where page between (select min(first_page) from worldfood.crawl_leases where crawl_id = :crawl_id)
+                           and (select max(last_page) from worldfood.crawl_leases where crawl_id = :crawl_id)
+            """), {'crawl_id': crawl_id}).first()
+    return {'crawl_id': crawl_id, 'leases': leases, 'pages_logged': logged[0], 'error_pages': logged[1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help='split the page range into leases for a new crawl')
+    init_parser.add_argument('--page', type=int, default=1, help='first page of the crawl')
+    init_parser.add_argument('--last-page', type=int, default=None, help='last page of the crawl (default: all pages)')
+    init_parser.add_argument('--lease-pages', type=int, default=100, help='pages per lease')
+    init_parser.add_argument('--crawl-id', default=None, help='crawl id (default: the current UTC time)')
+
+    work_parser = subparsers.add_parser('work', help='claim and process leases until the crawl is done')
+    work_parser.add_argument('--crawl-id', default=None, help='crawl to work on (default: the latest)')
+    work_parser.add_argument('--concurrency', type=int, default=1, help='page requests in flight')
+    work_parser.add_argument('--prefetch', type=int, default=None, help='fetched pages buffered ahead of processing')
+    work_parser.add_argument('--rate-limit', type=float, default=None, help='max requests/sec to the API host, per worker')
+    work_parser.add_argument('--batch-pages', type=int, default=10, help='pages written per transaction')
+    work_parser.add_argument('--stream', action='store_true', help='parse page bodies incrementally')
+    work_parser.add_argument('--lease-timeout', type=float, default=300, help='seconds without a heartbeat before a lease is reclaimed')
+    work_parser.add_argument('--max-attempts', type=int, default=3, help='claims of a lease before it is marked failed')
+    work_parser.add_argument('--poll-interval', type=float, default=10, help='seconds between claims while other workers hold the last leases')
+    add_cache_arguments(work_parser)
+    add_metrics_arguments(work_parser)
+
+    status_parser = subparsers.add_parser('status', help='progress of a crawl')
+    status_parser.add_argument('--crawl-id', default=None, help='crawl to report on (default: the latest)')
+    args = parser.parse_args()
+
+    engine=get_engine()
+    if args.command == 'init':
+        last_page = args.last_page
+        if last_page is None:
+            all_food_products = fetch_with_retry(PAGE_URL.format(BASE_URL, 1), get_session(pool_size=1, retries=0),
+                                                 fetch=fetch_json)
+            last_page = int(np.ceil(all_food_products['count']/24.))
+        crawl_id = create_leases(engine, last_page, args.page, args.lease_pages, args.crawl_id)
+        print('crawl {}: pages {}-{} in leases of {} pages'.format(crawl_id, args.page, last_page, args.lease_pages))
+    elif args.command == 'work':
+        configure_response_cache(args)
+        start_run('sharded_crawl', engine, args)
+        try:
+            run_worker(engine, args.crawl_id, args.concurrency, args.prefetch, args.rate_limit,
+                       batch_pages=args.batch_pages, stream=args.stream, lease_timeout=args.lease_timeout,
+                       max_attempts=args.max_attempts, poll_interval=args.poll_interval)
+        finally:
+            finish_run(args)
+    else:
+        status = get_crawl_status(engine, args.crawl_id)
+        print('crawl {}'.format(status['crawl_id']))
+        print(status['leases'].to_string(index=False))
+        print('{:,} pages logged, {:,} with errors'.format(status['pages_logged'], status['error_pages']))
+
+
+if __name__ == "__main__":
+    main()
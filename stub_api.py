@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Open Food Facts API, serving synthetic product pages,
+shared by the benchmarks and the tests so neither needs a network.
+
+start_stub_server serves clean pages after an artificial latency;
+start_fault_stub also throttles requests beyond a capacity, fails dead pages
+and injects random faults (see FaultStubHandler).
+"""
+
+
+#Import packages
+import functools
+import json
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+
+#Modification time of the most recently modified synthetic product
+SYNTHETIC_LAST_MODIFIED_T = 1640000000
+
+
+#Function to generate a synthetic page of products, shaped like the
+#https://us.openfoodfacts.org/.json?page=N response. Products are ordered by
+#last_modified_t, most recent first, one minute apart
+def make_synthetic_page(page=1, page_size=24, count=24000, seed=0):
+
+    rng = random.Random(seed*100003 + page)
+
+    allergens = ['en:milk', 'en:gluten', 'en:soybeans', 'en:eggs', 'en:nuts',
+                 'en:peanuts', 'en:fish', 'en:sesame-seeds']
+    ingredients = ['en:sugar', 'en:salt', 'en:water', 'en:wheat-flour', 'en:milk',
+                   'en:palm-oil', 'en:soy-lecithin', 'en:cocoa-butter', 'en:corn-syrup']
+    nutrients = ['carbohydrates', 'proteins', 'energy-kcal', 'fat', 'sugars',
+                 'salt', 'sodium', 'fiber', 'saturated-fat']
+
+    products = []
+    for i in range(page_size):
+        index = (page-1)*page_size + i
+        if index >= count:
+            break
+        product_id = str(10**12 + index)
+        product = {'id': product_id,
+                   '_id': product_id,
+                   'lang': 'en' if rng.random() < .9 else 'fr',
+                   'product_name': 'Product {}'.format(product_id),
+                   'last_modified_t': SYNTHETIC_LAST_MODIFIED_T - 60*index}
+
+        product['ingredients'] = [{'id': ingredient,
+                                   'text': ingredient.split(':')[1].replace('-', ' '),
+                                   'rank': rank+1}
+                                  for rank, ingredient in enumerate(rng.sample(ingredients, rng.randint(1, 8)))]
+        product['allergens_tags'] = rng.sample(allergens, rng.randint(0, 3))
+        product['brands_tags'] = ['brand-{}'.format(rng.randint(1, 500))]
+        product['categories_tags'] = ['en:category-{}'.format(rng.randint(1, 200))
+                                      for _ in range(rng.randint(1, 5))]
+
+        nutriments = {}
+        for nutrient in rng.sample(nutrients, rng.randint(3, len(nutrients))):
+            value = round(rng.uniform(0, 50), 2)
+            nutriments[nutrient] = value
+            nutriments[nutrient + '_100g'] = value
+            nutriments[nutrient + '_serving'] = round(value*rng.uniform(.2, 3), 2)
+            nutriments[nutrient + '_unit'] = 'kcal' if nutrient == 'energy-kcal' else 'g'
+        product['nutriments'] = nutriments
+
+        products.append(product)
+
+    return {'count': count, 'page': page, 'page_size': page_size, 'products': products}
+
+
+#Function to get the encoded json of a synthetic page, cached so that serving a
+#corpus repeatedly does not make the stub the bottleneck
+@functools.lru_cache(maxsize=100000)
+def synthetic_page_body(page, page_size=24, count=24000):
+    return json.dumps(make_synthetic_page(page, page_size, count=count)).encode('utf-8')
+
+
+#Stub handler serving synthetic product pages at /.json?page=N and
+#/api/v2/search?sort_by=last_modified_t&page_size=M&page=N after
+#`server.latency` (cut short when the server is stopped)
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        page = int(query.get('page', ['1'])[0])
+        page_size = int(query.get('page_size', ['24'])[0])
+        self.server.stopped.wait(self.server.latency)
+
+        body = synthetic_page_body(page, page_size, self.server.count)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+#Stub handler injecting faults: requests beyond `server.capacity` in flight are
+#throttled with 429, pages in `server.dead_pages` always fail with 500, and a
+#`server.fault_rate` share of the other requests fail at random with one of
+#FAULTS: a 503 or 500, a connection dropped without a response, or a body cut
+#short. Counts of requests and faults are kept on the server
+class FaultStubHandler(StubHandler):
+
+    FAULTS = ('503', '500', 'reset', 'truncated')
+
+    def do_GET(self):
+        server = self.server
+        page = int(parse_qs(urlsplit(self.path).query).get('page', ['1'])[0])
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            if server.capacity and server.in_flight > server.capacity:
+                fault = '429'
+            elif page in server.dead_pages:
+                fault = 'dead'
+            elif server.random.random() < server.fault_rate:
+                fault = server.random.choice(self.FAULTS)
+            else:
+                fault = None
+            if fault is not None:
+                server.faults[fault] = server.faults.get(fault, 0) + 1
+
+        try:
+            if fault is None:
+                return super().do_GET()
+            if fault == '429':
+                return self._send_status(429)
+            server.stopped.wait(server.latency)
+            if fault == 'reset':
+                self.close_connection = True
+            elif fault == 'truncated':
+                body = synthetic_page_body(page, 24, server.count)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body)//2])
+                self.close_connection = True
+            else:
+                self._send_status(500 if fault == 'dead' else int(fault))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send_status(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+#Stub server of `count` products with a listen backlog for many concurrent
+#clients (the default of 5 drops connection attempts in bursts, which then wait
+#out a 1s SYN retry). Faults only apply with a FaultStubHandler
+class StubServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, count=24000, latency=0.05, handler=StubHandler, seed=0):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.count = count
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.configure()
+
+    #Function to set the faults injected, and reset their counts
+    def configure(self, capacity=None, fault_rate=0., dead_pages=()):
+        with self.lock:
+            self.capacity = capacity
+            self.fault_rate = fault_rate
+            self.dead_pages = set(dead_pages)
+            self.requests = 0
+            self.faults = {}
+
+    #Function to stop serving, cutting short the latency of requests in flight
+    def stop(self):
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+    #Clients dropping connections mid-response (e.g. a cancelled crawl) are expected
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+#Function to start the stub API server in a background thread.
+#Returns the server (call stop() when done) and its base url
+def start_stub_server(count=24000, latency=0.05, handler=StubHandler):
+    server = StubServer(count, latency, handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}'.format(*server.server_address)
+
+
+#Function to start a stub API server injecting faults (see FaultStubHandler) in
+#a background thread. Returns the server and its base url
+def start_fault_stub(count=24000, latency=0.05, capacity=None, fault_rate=0., dead_pages=(), seed=0):
+    server = StubServer(count, latency, FaultStubHandler, seed)
+    server.configure(capacity, fault_rate, dead_pages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}'.format(*server.server_address)
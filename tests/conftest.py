@@ -0,0 +1,76 @@
+#Shared fixtures: local SQLite databases with a 'worldfood' schema, and the stub
+#of the Open Food Facts API from stub_api.py serving synthetic pages, so tests
+#run without a network or a server. Tests of PostgreSQL-only code use the
+#database at WORLDFOOD_TEST_DB_URL, and are skipped without one
+
+
+#Import packages
+import os
+import sys
+
+import pytest
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import http_client
+from stub_api import start_fault_stub
+
+
+
+#Function to create an engine on a SQLite database in `directory`, with a
+#'worldfood' database attached as the schema the scripts write to
+def create_local_engine(directory):
+    engine = sa.create_engine('sqlite:///' + os.path.join(directory, 'main.db'))
+    worldfood_path = os.path.join(directory, 'worldfood.db')
+
+    @sa.event.listens_for(engine, 'connect')
+    def attach_worldfood(dbapi_conn, connection_record):
+        dbapi_conn.execute("attach database '{}' as worldfood".format(worldfood_path))
+
+    return engine
+
+
+#Factory of local engines, each on its own database, disposed after the test
+@pytest.fixture
+def local_engine(tmp_path_factory):
+    engines = []
+    def make_engine():
+        engines.append(create_local_engine(str(tmp_path_factory.mktemp('worldfood'))))
+        return engines[-1]
+    yield make_engine
+    for engine in engines:
+        engine.dispose()
+
+
+@pytest.fixture
+def engine(local_engine):
+    return local_engine()
+
+
+@pytest.fixture
+def pg_engine():
+    db_url = os.environ.get('WORLDFOOD_TEST_DB_URL')
+    if not db_url:
+        pytest.skip('set WORLDFOOD_TEST_DB_URL to a PostgreSQL database to run')
+    engine = db.create_engine(db_url)
+    with engine.begin() as conn:
+        conn.execute(sa.text('create schema if not exists worldfood'))
+    yield engine
+    engine.dispose()
+
+
+#Stub API server of 10 pages (240 products), without latency or faults until
+#configured. Yields the server and its base url
+@pytest.fixture
+def fault_stub():
+    server, base_url = start_fault_stub(count=240, latency=0.)
+    yield server, base_url
+    server.stop()
+
+
+#Retries without waiting out their backoff
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(http_client, 'backoff_delay', lambda *args, **kwargs: 0.)
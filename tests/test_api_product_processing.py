@@ -0,0 +1,218 @@
+#Import packages
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+import api_product_processing as app
+import benchmark
+
+
+
+#Function to read the product tables, sorted, without ingestion times and with
+#tags decoded (dictionary keys depend on the order tags were first seen)
+def product_tables(engine):
+    tables = {}
+    for table in app.PRODUCT_TABLES:
+        if table in app.TAG_DICTIONARIES:
+            tag_column, dictionary = app.TAG_DICTIONARIES[table]
+            query = ('select t.*, d.{tag} from worldfood.{table} t join worldfood.{dim} d using ({key})'
+                     .format(tag=tag_column, table=table, dim=dictionary.table, key=dictionary.key_column))
+            df = pd.read_sql(query, engine).drop(columns=dictionary.key_column)
+        else:
+            df = pd.read_sql('select * from worldfood.{}'.format(table), engine)
+        df = df.drop(columns='ingested_at', errors='ignore')
+        tables[table] = df.sort_values(list(df.columns)).reset_index(drop=True)
+    return tables
+
+
+#Function to get the pages logged with errors and the pages dead-lettered
+def error_pages(engine):
+    with engine.connect() as conn:
+        logged = {row[0] for row in conn.execute(sa.text('select page from worldfood.logging where error_processing'))}
+        dead_letters = {row[0] for row in conn.execute(sa.text('select page from worldfood.dead_letters'))}
+    return logged, dead_letters
+
+
+#Function to read the dead letters, by page
+def dead_letters(engine):
+    return pd.read_sql('select * from worldfood.dead_letters', engine).set_index('page')
+
+
+#Numbers (and numeric strings) go to nutrient_value, anything else to nutrient_text
+def test_split_nutrient_values():
+    nutrients_df = pd.DataFrame({'product_id': ['1']*6,
+                                 'nutrient_name': ['fat_100g', 'salt', 'energy-kcal_unit', 'sugars', 'fiber', 'nova'],
+                                 'nutrient_value': [3.5, '0.25', 'kcal', 12, None, 'unknown']})
+    df = app.split_nutrient_values(nutrients_df)
+
+    assert df['nutrient_value'].dtype == float
+    assert df['nutrient_value'].tolist()[:2] == [3.5, 0.25]
+    assert df['nutrient_value'].iloc[3] == 12.
+    assert df['nutrient_value'].isnull().tolist() == [False, False, True, False, True, True]
+    assert df['nutrient_text'].dropna().to_dict() == {2: 'kcal', 5: 'unknown'}
+    assert df[['product_id', 'nutrient_name']].equals(nutrients_df[['product_id', 'nutrient_name']])
+
+
+#Padded numbers are numeric, with the same rule as the migration of existing rows
+def test_split_nutrient_values_padded_text():
+    values = [' 1.5 ', '\t2\n', '1.', '.5', '-1e3', '1.5 g', 'inf', True]
+    df = app.split_nutrient_values(pd.DataFrame({'product_id': ['1']*len(values), 'nutrient_name': ['fat']*len(values),
+                                                 'nutrient_value': values}))
+    assert df['nutrient_value'].tolist()[:5] == [1.5, 2., 1., .5, -1000.]
+    assert df['nutrient_text'].dropna().tolist() == ['1.5 g', 'inf', 'True']
+    with open('SQL/migrations/001_typed_product_nutrients.sql') as stream:
+        assert "'^{}$'".format(app.NUMERIC_TEXT) in stream.read()
+
+
+#Function to get a table's rows as strings (missing values as None), as they
+#would be stored, for comparing the two flatteners
+def table_rows(df, columns):
+    if len(df) == 0:
+        return []
+    return [tuple(None if pd.isnull(value) else str(value) for value in row)
+            for row in df[columns].astype(object).itertuples(index=False)]
+
+
+#Pages of synthetic products, and one with the cases the flattener skips or
+#leaves empty (other languages, no name, no ingredients/nutriments, untexted
+#ingredients, text nutrient values)
+def edge_case_page():
+    page = benchmark.make_synthetic_page(2)
+    products = page['products']
+    products[0]['lang'] = 'fr'
+    del products[1]['product_name']
+    del products[2]['ingredients'], products[2]['nutriments'], products[2]['allergens_tags']
+    del products[3]['ingredients'][0]['text']
+    products[4]['nutriments']['nova-group'] = 'unknown'
+    return page
+
+
+@pytest.mark.parametrize('all_food_products', [benchmark.make_synthetic_page(1), edge_case_page(),
+                                               benchmark.make_synthetic_page(3, page_size=100, seed=1)])
+def test_flatten_products_matches_per_product_flatten(all_food_products):
+    expected = benchmark.legacy_flatten_page(all_food_products)
+    actual = app.flatten_products(all_food_products['products'])
+
+    for table in app.PRODUCT_TABLES:
+        if table == 'product_nutrients':
+            continue
+        columns = list(expected[table].columns)
+        assert table_rows(actual[table], columns) == table_rows(expected[table], columns), table
+
+    #Numeric nutrient values are split from the text ones
+    nutrients = actual['product_nutrients']
+    values = nutrients['nutrient_value'].astype(object).where(nutrients['nutrient_value'].notnull(),
+                                                              nutrients['nutrient_text'])
+    expected_values = [float(value) if isinstance(value, (int, float)) else value
+                       for value in expected['product_nutrients']['nutrient_value']]
+    assert table_rows(nutrients, ['product_id', 'nutrient_name']) == \
+        table_rows(expected['product_nutrients'], ['product_id', 'nutrient_name'])
+    assert values.tolist() == expected_values
+
+
+def test_flatten_products_skips_products_without_lang():
+    page = benchmark.make_synthetic_page(1)
+    del page['products'][0]['lang']
+    tables = app.flatten_page(page)
+    assert page['products'][0]['id'] not in tables['products']['product_id'].tolist()
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_process_pages_matches_page_by_page(engine, local_engine, fault_stub, stream):
+    server, base_url = fault_stub
+    app.process_pages(engine, range(1, 6), concurrency=4, base_url=base_url, batch_pages=2, stream=stream)
+    crawled = product_tables(engine)
+
+    expected = local_engine()
+    for page in range(1, 6):
+        app.process_page(benchmark.make_synthetic_page(page, count=server.count), expected)
+    for table, df in product_tables(expected).items():
+        pd.testing.assert_frame_equal(crawled[table], df, check_dtype=False)
+    assert app.get_error_pages(engine) == []
+
+
+#Pages that still fail after retries are logged as errors and dead-lettered,
+#the crawl goes on, and a replay pass recovers them
+@pytest.mark.parametrize('stream', [False, True])
+def test_dead_letters_and_replay(engine, local_engine, fault_stub, no_backoff, stream):
+    server, base_url = fault_stub
+    server.configure(dead_pages=(2, 4))
+    app.process_pages(engine, range(1, 6), concurrency=4, base_url=base_url, stream=stream)
+
+    assert error_pages(engine) == ({2, 4}, {2, 4})
+    letters = dead_letters(engine)
+    assert letters['stage'].tolist() == ['fetch', 'fetch']
+    assert letters['status'].tolist() == [500, 500]
+    assert letters['attempts'].tolist() == [app.FETCH_RETRIES + 1]*2
+    assert app.get_resume_page(engine) == 6
+
+    server.configure()
+    app.process_error_pages(engine, base_url=base_url, stream=stream)
+    assert error_pages(engine) == (set(), set())
+
+    expected = local_engine()
+    app.process_pages(expected, range(1, 6), base_url=base_url, stream=stream)
+    for table, df in product_tables(expected).items():
+        pd.testing.assert_frame_equal(product_tables(engine)[table], df, check_dtype=False)
+
+
+def test_unparseable_page_is_dead_lettered(engine, fault_stub, monkeypatch):
+    server, base_url = fault_stub
+    flatten_page = app.flatten_page
+    def failing_flatten_page(all_food_products):
+        if all_food_products['page'] == 3:
+            raise ValueError('bad page')
+        return flatten_page(all_food_products)
+    monkeypatch.setattr(app, 'flatten_page', failing_flatten_page)
+
+    app.process_pages(engine, range(1, 5), base_url=base_url)
+    assert error_pages(engine) == ({3}, {3})
+    assert dead_letters(engine).loc[3, 'stage'] == 'parse'
+
+
+#A page whose rows cannot be written is dead-lettered, and the rest of its
+#batch is written
+def test_unwritable_page_is_dead_lettered(engine, fault_stub, monkeypatch):
+    server, base_url = fault_stub
+    get_page_tables = app.get_page_tables
+    def bad_page_tables(all_food_products):
+        tables = get_page_tables(all_food_products)
+        if all_food_products['page'] == 2:
+            tables['products'] = tables['products'].assign(unknown_column=1)
+        return tables
+    monkeypatch.setattr(app, 'get_page_tables', bad_page_tables)
+
+    app.process_pages(engine, range(1, 5), base_url=base_url, batch_pages=10)
+    assert error_pages(engine) == ({2}, {2})
+    assert dead_letters(engine).loc[2, 'stage'] == 'write'
+    with engine.connect() as conn:
+        pages = conn.execute(sa.text('select page from worldfood.logging where not error_processing order by page'))
+        assert [row[0] for row in pages] == [1, 3, 4]
+
+
+#A delta run stops at the first page reaching products older than the
+#high-water mark, then advances it to the most recent product
+def test_process_delta_stops_at_high_water_mark(engine, fault_stub):
+    server, base_url = fault_stub
+    app.set_high_water_mark(engine, benchmark.SYNTHETIC_LAST_MODIFIED_T - 60*150)
+    results = app.process_delta(engine, base_url=base_url)
+
+    assert results['pages_fetched'] == 2
+    assert results['changed_products'] == 151
+    assert app.get_high_water_mark(engine) == benchmark.SYNTHETIC_LAST_MODIFIED_T
+    products = [product for page in (1, 2) for product in benchmark.make_synthetic_page(page, 100, server.count)['products']][:151]
+    assert sorted(product_tables(engine)['products']['product_id']) == \
+        sorted(int(product['id']) for product in products if product['lang'] == 'en')
+
+    #Only the product at the high-water mark is re-ingested
+    results = app.process_delta(engine, base_url=base_url)
+    assert (results['pages_fetched'], results['changed_products']) == (1, 1)
+
+
+#Without a high-water mark, the whole listing is ingested
+def test_process_delta_without_high_water_mark(engine, fault_stub):
+    server, base_url = fault_stub
+    results = app.process_delta(engine, base_url=base_url)
+    assert results['pages_fetched'] == 3
+    assert results['changed_products'] == server.count
+    assert app.get_high_water_mark(engine) == benchmark.SYNTHETIC_LAST_MODIFIED_T
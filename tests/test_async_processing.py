@@ -0,0 +1,104 @@
+#Import packages
+import asyncio
+
+import pytest
+
+import async_processing
+from async_processing import AsyncAdaptiveLimit, fetch_content_async
+
+aiohttp = pytest.importorskip('aiohttp')
+
+
+
+#Function to fetch pages concurrently with fetch_content_async
+async def fetch_all(base_url, pages, limit, retries=10):
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*[fetch_content_async('{}/.json?page={}'.format(base_url, page), session,
+                                                          limit=limit, retries=retries) for page in pages],
+                                    return_exceptions=True)
+
+
+def test_async_adaptive_limit_bounds_in_flight():
+    limit = AsyncAdaptiveLimit(3)
+    in_flight = []
+
+    async def request():
+        decreases = await limit.acquire()
+        in_flight.append(limit.in_flight)
+        await asyncio.sleep(0.01)
+        await limit.release(decreases)
+
+    async def run():
+        await asyncio.gather(*[request() for _ in range(12)])
+    asyncio.run(run())
+    assert max(in_flight) == 3
+    assert limit.in_flight == 0
+
+
+def test_async_adaptive_limit_halves_once_per_epoch():
+    limit = AsyncAdaptiveLimit(8)
+
+    async def run():
+        decreases = [await limit.acquire() for _ in range(4)]
+        for decrease in decreases:
+            await limit.release(decrease, throttled=True)
+    asyncio.run(run())
+    assert limit.limit == 4.
+    assert limit.throttled == 4
+
+
+def test_fetch_content_async_recovers_from_throttling(fault_stub, monkeypatch):
+    monkeypatch.setattr(async_processing, 'backoff_delay', lambda *args, **kwargs: 0.)
+    server, base_url = fault_stub
+    server.capacity = 2
+    server.latency = 0.05
+    limit = AsyncAdaptiveLimit(8)
+    contents = asyncio.run(fetch_all(base_url, range(1, 11), limit))
+    assert all(isinstance(content, bytes) for content in contents)
+    assert server.faults.get('429', 0) > 0
+    assert limit.throttled > 0
+    assert limit.limit < 8
+
+
+def test_fetch_content_async_raises_after_retries(fault_stub, monkeypatch):
+    monkeypatch.setattr(async_processing, 'backoff_delay', lambda *args, **kwargs: 0.)
+    server, base_url = fault_stub
+    server.dead_pages = {2}
+    error = asyncio.run(fetch_all(base_url, [2], AsyncAdaptiveLimit(4), retries=2))[0]
+    assert isinstance(error, aiohttp.ClientResponseError)
+    assert error.status == 500
+    assert error.attempts == 3
+
+
+#Pool of process_pages_async, without a database: batches go to a fake writer
+class FakePool:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+#A batch that fails to write does not drop the batch parsed after it
+def test_process_pages_async_writes_last_batch_after_write_error(engine, fault_stub, monkeypatch):
+    pytest.importorskip('asyncpg')
+    written = []
+    async def write_batch(engine, pool, batch, dtypes=None):
+        written.append([int(tables['logging']['page'].iloc[0]) for tables in batch])
+        if len(written) == 1:
+            raise RuntimeError('write failed')
+
+    monkeypatch.setattr(async_processing, 'write_batch', write_batch)
+    monkeypatch.setattr(async_processing, 'get_asyncpg_dsn', lambda engine: None)
+    monkeypatch.setattr(async_processing.asyncpg, 'create_pool', lambda *args, **kwargs: FakePool())
+    server, base_url = fault_stub
+    with pytest.raises(RuntimeError):
+        asyncio.run(async_processing.process_pages_async(engine, range(1, 8), concurrency=2, base_url=base_url,
+                                                         batch_pages=2, workers=1))
+    assert written == [[1, 2], [3, 4]]
+
+
+def test_process_all_pages_async_needs_packages(engine, monkeypatch):
+    monkeypatch.setattr(async_processing, 'aiohttp', None)
+    with pytest.raises(ImportError, match='aiohttp and asyncpg'):
+        asyncio.run(async_processing.process_all_pages_async(engine, 1))
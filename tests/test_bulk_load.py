@@ -0,0 +1,122 @@
+#Import packages
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+import api_product_processing as app
+import benchmark
+from bulk_load import WriteBuffer, drop_replaced_rows, write_tables
+
+
+
+KEYS = {'products': ('products', 'product_id'), 'product_ingredients': ('products', 'product_id'),
+        'logging': ('logging', 'page')}
+
+DTYPES = {'products': {'product_id': sa.types.BIGINT(), 'product_name': sa.types.VARCHAR(length=20)},
+          'product_ingredients': {'product_id': sa.types.BIGINT(), 'ingredient_id': sa.types.VARCHAR(length=255)},
+          'logging': {'page': sa.types.INTEGER(), 'error_processing': sa.types.BOOLEAN()}}
+
+
+#Function to get the tables of a page of products (product id -> (name, ingredients))
+def page_tables(page, products):
+    return {'products': pd.DataFrame({'product_id': list(products),
+                                      'product_name': [name for name, _ in products.values()]}),
+            'product_ingredients': pd.DataFrame([(product_id, ingredient) for product_id, (_, ingredients) in products.items()
+                                                 for ingredient in ingredients],
+                                                columns=['product_id', 'ingredient_id']),
+            'logging': pd.DataFrame({'page': [page], 'error_processing': [False]})}
+
+
+#Function to read a table, sorted
+def read_table(engine, table):
+    df = pd.read_sql('select * from worldfood.{}'.format(table), engine)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_write_tables_replaces_rows_by_key(engine):
+    write_tables(page_tables(1, {1: ('a', ['sugar', 'salt']), 2: ('b', ['water'])}), engine, DTYPES, KEYS)
+    write_tables(page_tables(1, {1: ('a2', ['sugar'])}), engine, DTYPES, KEYS)
+
+    assert read_table(engine, 'products').values.tolist() == [[1, 'a2'], [2, 'b']]
+    assert read_table(engine, 'product_ingredients').values.tolist() == [[1, 'sugar'], [2, 'water']]
+    assert read_table(engine, 'logging')['page'].tolist() == [1]
+
+
+#Only key tables are de-duplicated: other tables can repeat rows legitimately
+def test_write_tables_keeps_repeated_rows(engine):
+    write_tables(page_tables(1, {1: ('a', ['sugar', 'sugar'])}), engine, DTYPES, KEYS)
+    assert read_table(engine, 'product_ingredients').values.tolist() == [[1, 'sugar'], [1, 'sugar']]
+
+
+def test_drop_replaced_rows():
+    pages = drop_replaced_rows([page_tables(1, {1: ('a', ['sugar']), 2: ('b', ['salt'])}),
+                                page_tables(2, {1: ('a2', ['water'])})], KEYS)
+    assert pages[0]['products']['product_id'].tolist() == [2]
+    assert pages[0]['product_ingredients']['ingredient_id'].tolist() == ['salt']
+    assert pages[0]['logging']['page'].tolist() == [1]
+    assert pages[1]['products']['product_name'].tolist() == ['a2']
+
+
+#A product on two pages of a batch is written once, as on its later page
+def test_write_buffer_batch_matches_page_writes(engine):
+    with WriteBuffer(engine, DTYPES, max_pages=10, replace_keys=KEYS) as buffer:
+        buffer.add(page_tables(1, {1: ('a', ['sugar', 'salt']), 2: ('b', ['water'])}))
+        buffer.add(page_tables(2, {1: ('a2', ['sugar']), 3: ('c', [])}))
+
+    assert read_table(engine, 'products').values.tolist() == [[1, 'a2'], [2, 'b'], [3, 'c']]
+    assert read_table(engine, 'product_ingredients').values.tolist() == [[1, 'sugar'], [2, 'water']]
+    assert read_table(engine, 'logging')['page'].tolist() == [1, 2]
+
+
+#Function to get the tables of a page that cannot be written (a column its
+#table does not have)
+def bad_page_tables(page, products):
+    tables = page_tables(page, products)
+    tables['products'] = tables['products'].assign(unknown_column=1)
+    return tables
+
+
+#A page failing to write is replaced by on_error's tables, and the rest of its
+#batch is still written
+def test_write_buffer_falls_back_to_pages(engine):
+    failed = []
+    def on_error(tables, error):
+        failed.append(int(tables['logging']['page'].iloc[0]))
+        return {'logging': pd.DataFrame({'page': failed[-1:], 'error_processing': [True]})}
+
+    with WriteBuffer(engine, DTYPES, max_pages=10, replace_keys=KEYS, on_error=on_error) as buffer:
+        buffer.add(page_tables(1, {1: ('a', ['sugar'])}))
+        buffer.add(bad_page_tables(2, {2: ('b', ['salt'])}))
+        buffer.add(page_tables(3, {3: ('c', ['water'])}))
+
+    assert failed == [2]
+    assert buffer.failed_pages == 1
+    assert buffer.pages == 0
+    assert read_table(engine, 'products')['product_id'].tolist() == [1, 3]
+    assert read_table(engine, 'product_ingredients')['product_id'].tolist() == [1, 3]
+    assert read_table(engine, 'logging').values.tolist() == [[1, False], [2, True], [3, False]]
+
+
+def test_write_buffer_raises_without_on_error(engine):
+    buffer = WriteBuffer(engine, DTYPES, max_pages=10, replace_keys=KEYS)
+    buffer.add(bad_page_tables(1, {1: ('a', [])}))
+    with pytest.raises(Exception):
+        buffer.flush()
+    assert buffer.pages == 0
+
+
+def test_write_buffer_rejects_unknown_tables(engine):
+    buffer = WriteBuffer(engine, DTYPES)
+    with pytest.raises(KeyError):
+        buffer.add({'unknown': pd.DataFrame({'a': [1]})})
+
+
+#Rewriting a page of the product tables leaves the same rows
+def test_process_page_is_idempotent(engine):
+    all_food_products = benchmark.make_synthetic_page(1)
+    app.process_page(all_food_products, engine)
+    first = {table: read_table(engine, table).drop(columns='ingested_at', errors='ignore')
+             for table in app.PRODUCT_TABLES}
+    app.process_page(all_food_products, engine)
+    for table, df in first.items():
+        pd.testing.assert_frame_equal(read_table(engine, table).drop(columns='ingested_at', errors='ignore'), df)
@@ -0,0 +1,64 @@
+#Import packages
+import os
+
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+import api_product_processing as app
+import benchmark
+import data_processing
+from api_reference_processing import REFERENCE_TABLES
+from bulk_load import bulk_insert, write_tables
+from db import read_sql
+
+pytest.importorskip('pyarrow')
+pytest.importorskip('duckdb')
+
+from columnar import connect_parquet, query_parquet, write_parquet
+
+
+
+DTYPE = {'product_id': sa.types.BIGINT(), 'nutrient_key': sa.types.SMALLINT(), 'nutrient_value': sa.types.FLOAT()}
+
+
+#Chunks are written as one partitioned dataset, read back through DuckDB with
+#the EDW's :name parameters
+def test_write_parquet_and_query(tmp_path):
+    chunks = [pd.DataFrame({'product_id': [1, 2, 3], 'nutrient_key': [1, 1, 2], 'nutrient_value': [0.5, None, 2.]}),
+              pd.DataFrame({'product_id': [4], 'nutrient_key': [2], 'nutrient_value': [3.]})]
+    write_parquet(iter(chunks), str(tmp_path), 'product_nutrients', DTYPE, buckets=2)
+    assert sorted(os.listdir(tmp_path / 'product_nutrients')) == ['bucket=0', 'bucket=1']
+
+    conn = connect_parquet(str(tmp_path), {'product_nutrients': DTYPE, 'products': app.PRODUCT_TABLES['products']})
+    try:
+        df = query_parquet(conn, 'select * from worldfood.product_nutrients where nutrient_key = :key order by product_id',
+                           {'key': 2})
+        assert df.values.tolist() == [[3, 2, 2.], [4, 2, 3.]]
+        #Tables without files are empty
+        assert len(query_parquet(conn, 'select * from worldfood.products')) == 0
+    finally:
+        conn.close()
+
+
+#The aggregates computed with DuckDB on the exported files match the EDW SQL
+def test_parquet_aggregates_match_sql(engine, tmp_path):
+    for page in range(1, 11):
+        write_tables(app.prepare_tables(engine, app.flatten_page(benchmark.make_synthetic_page(page, count=240))),
+                     engine, app.PRODUCT_TABLES, app.REPLACE_KEYS)
+    allergens = sorted(app.ALLERGEN_DICTIONARY.keys(engine))[::2]
+    reference_dtype = REFERENCE_TABLES['allergens_reference']['dtype']
+    bulk_insert(pd.DataFrame({'allergen_id': allergens, 'allergen_name': allergens}, columns=list(reference_dtype)),
+                'allergens_reference', engine, dtype=reference_dtype, if_exists='replace')
+
+    data_processing.export_parquet(engine, str(tmp_path), buckets=4)
+    parquet_aggs = data_processing.compute_aggs_parquet(str(tmp_path))
+
+    params = {'high_threshold': data_processing.HIGH_THRESHOLD, 'low_threshold': data_processing.LOW_THRESHOLD}
+    for table, (dtype, query_path) in data_processing.AGGREGATES.items():
+        columns = list(dtype)
+        expected = read_sql(sa.text(open(query_path).read()), engine, params=params if table == 'nutrients_agg' else None)
+        expected = expected[columns].sort_values(columns, na_position='first').reset_index(drop=True)
+        actual = parquet_aggs[table][columns].sort_values(columns, na_position='first').reset_index(drop=True)
+        assert len(actual) > 0
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
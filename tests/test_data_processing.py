@@ -0,0 +1,56 @@
+#Import packages
+import functools
+
+import pandas as pd
+import sqlalchemy as sa
+
+import api_product_processing as app
+import benchmark
+import data_processing
+import db
+
+
+
+#Function to get the names of the indexes of product_nutrients
+def nutrient_indexes(engine):
+    return {index['name'] for index in sa.inspect(engine).get_indexes('product_nutrients', schema='worldfood')}
+
+
+#Nothing to index before the first crawl, then the index is created once
+def test_create_nutrient_key_index(engine):
+    data_processing.create_nutrient_key_index(engine)
+    assert not sa.inspect(engine).has_table('product_nutrients', schema='worldfood')
+
+    app.process_page(benchmark.make_synthetic_page(1), engine)
+    data_processing.create_nutrient_key_index(engine)
+    data_processing.create_nutrient_key_index(engine)
+    assert 'product_nutrients_nutrient_key_idx' in nutrient_indexes(engine)
+
+
+#The NumPy aggregate, read in many small chunks, matches the SQL one
+def test_compute_nutrients_agg_matches_sql(engine, monkeypatch):
+    for page in range(1, 6):
+        app.process_page(benchmark.make_synthetic_page(page), engine)
+    monkeypatch.setattr(data_processing, 'read_sql_chunks', functools.partial(db.read_sql_chunks, chunksize=7))
+
+    columns = list(data_processing.NUTRIENTS_AGG_DTYPE)
+    actual = data_processing.compute_nutrients_agg(engine)
+    expected = db.read_sql(sa.text(open('SQL/nutrients_agg.sql').read()), engine,
+                           params={'high_threshold': data_processing.HIGH_THRESHOLD,
+                                   'low_threshold': data_processing.LOW_THRESHOLD})
+    assert len(actual) > 0
+    pd.testing.assert_frame_equal(actual.sort_values('product_id').reset_index(drop=True),
+                                  expected[columns].sort_values('product_id').reset_index(drop=True), check_dtype=False)
+
+
+#Products loaded twice before writes replaced rows by key count once
+def test_aggregate_shares_count_duplicate_products_once(engine):
+    app.process_page(benchmark.make_synthetic_page(1), engine)
+    with engine.begin() as conn:
+        products = conn.execute(sa.text('select count(*) from worldfood.products')).scalar()
+        conn.execute(sa.text('insert into worldfood.products select * from worldfood.products'))
+        conn.execute(sa.text('create table worldfood.allergens_reference (allergen_id VARCHAR(255), allergen_name VARCHAR(255))'))
+
+    for query_path in ('SQL/allergens_agg.sql', 'SQL/ingredients_agg.sql'):
+        df = db.read_sql(sa.text(open(query_path).read()), engine)
+        assert (df['pct_products'] - df['num_products']/products).abs().max() < 1e-9
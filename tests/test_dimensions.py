@@ -0,0 +1,38 @@
+#Import packages
+import pandas as pd
+import sqlalchemy as sa
+
+from dimensions import TagDictionary
+
+
+
+def test_encode_maps_tags_to_stable_keys(engine):
+    dictionary = TagDictionary('brands_dim', 'brand_id', 'brand_key')
+    keys = dictionary.encode(engine, pd.Series(['brand-b', 'brand-a', None, 'brand-b']))
+    assert keys.isnull().tolist() == [False, False, True, False]
+    assert keys[0] == keys[3] != keys[1]
+
+    #Known tags keep their keys as new ones are interned
+    more_keys = dictionary.encode(engine, pd.Series(['brand-c', 'brand-a', 'brand-b']))
+    assert more_keys.tolist()[1:] == [keys[1], keys[0]]
+    assert more_keys[0] not in (keys[0], keys[1])
+
+
+#Keys are read back from the dimension table by a new process (empty cache)
+def test_intern_reuses_keys_in_the_dimension_table(engine):
+    TagDictionary('brands_dim', 'brand_id', 'brand_key').intern(engine, ['brand-a', 'brand-b'])
+    dictionary = TagDictionary('brands_dim', 'brand_id', 'brand_key')
+    keys = dictionary.encode(engine, pd.Series(['brand-b', 'brand-c', 'brand-a']))
+
+    with engine.connect() as conn:
+        stored = dict(conn.execute(sa.text('select brand_id, brand_key from worldfood.brands_dim')).fetchall())
+    assert len(stored) == 3
+    assert keys.tolist() == [stored['brand-b'], stored['brand-c'], stored['brand-a']]
+
+
+def test_intern_stores_attributes(engine):
+    dictionary = TagDictionary('nutrients_dim', 'nutrient_name', 'nutrient_key', key_type='SMALLINT',
+                               attributes={'nutrient_id': lambda name: name.split('_')[0]})
+    dictionary.intern(engine, ['fat_100g', 'fat_serving'])
+    df = pd.read_sql('select nutrient_name, nutrient_id from worldfood.nutrients_dim order by nutrient_name', engine)
+    assert df.values.tolist() == [['fat_100g', 'fat'], ['fat_serving', 'fat']]
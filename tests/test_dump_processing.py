@@ -0,0 +1,40 @@
+#Import packages
+import json
+
+import pandas as pd
+
+import benchmark
+import dump_processing
+
+
+
+#Function to write a dump of a page of synthetic products, with a line that
+#cannot be decoded after the first product
+def write_dump(path):
+    lines = [json.dumps(product) for product in benchmark.make_synthetic_page(1)['products']]
+    lines.insert(1, '{"code": "truncated')
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return str(path)
+
+
+#Reloading a dump replaces its decode errors instead of adding to them
+def test_decode_errors_are_replaced_on_reload(engine, tmp_path):
+    path = write_dump(tmp_path / 'products.jsonl')
+    for _ in range(2):
+        dump_processing.process_dump(engine, path, chunk_size=10)
+
+    dead_letters = pd.read_sql('select * from worldfood.dead_letters', engine)
+    assert dead_letters[['stage', 'source']].values.tolist() == [['decode', dump_processing.get_dump_source(path)]]
+    assert dead_letters['error'].iloc[0].startswith('ValueError: line 2:')
+    assert len(pd.read_sql('select product_id from worldfood.products', engine)) == \
+        sum(product['lang'] == 'en' for product in benchmark.make_synthetic_page(1)['products'])
+
+
+def test_decode_errors_of_other_dumps_are_kept(engine, tmp_path):
+    first = write_dump(tmp_path / 'first.jsonl')
+    second = write_dump(tmp_path / 'second.jsonl')
+    for path in (first, second, first):
+        dump_processing.process_dump(engine, path, chunk_size=10)
+
+    sources = pd.read_sql('select source from worldfood.dead_letters', engine)['source']
+    assert sorted(sources) == sorted(dump_processing.get_dump_source(path) for path in (first, second))
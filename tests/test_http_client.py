@@ -0,0 +1,205 @@
+#Import packages
+import os
+import time
+
+import pytest
+import requests
+
+import http_client
+from api_product_processing import fetch_pages
+from metrics import METRICS
+from http_client import (AdaptiveLimit, CacheMissError, ResponseCache, backoff_delay, fetch_content, fetch_with_retry,
+                         get_session, retry_after)
+
+
+
+#Function to get the HTTP error a fetch raises for a response of `status`
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError('{} error'.format(status), response=response)
+
+
+#Fetch failing with the given errors, in order, then returning 'ok'
+class FlakyFetch:
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, url, session=None, rate_limiter=None, timeout=60):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    delays = [backoff_delay(attempt, backoff_factor=0.5, max_backoff=2.) for attempt in range(8) for _ in range(20)]
+    assert all(0 <= delay <= 2. for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_retry_after():
+    assert retry_after(http_error(429, {'Retry-After': '3'}).response) == 3.
+    assert retry_after(http_error(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}).response) == 0.
+    assert retry_after(http_error(429).response) == 0.
+    assert retry_after(None) == 0.
+
+
+def test_fetch_with_retry_retries_retryable_errors(no_backoff):
+    fetch = FlakyFetch(http_error(503), requests.exceptions.ConnectionError(), http_error(500))
+    assert fetch_with_retry('url', fetch=fetch) == 'ok'
+    assert fetch.calls == 4
+
+
+def test_fetch_with_retry_raises_after_retries(no_backoff):
+    fetch = FlakyFetch(*[http_error(502)]*5)
+    with pytest.raises(requests.exceptions.HTTPError) as error:
+        fetch_with_retry('url', fetch=fetch, retries=2)
+    assert fetch.calls == 3
+    assert error.value.attempts == 3
+
+
+def test_fetch_with_retry_does_not_retry_client_errors(no_backoff):
+    fetch = FlakyFetch(http_error(404))
+    with pytest.raises(requests.exceptions.HTTPError) as error:
+        fetch_with_retry('url', fetch=fetch)
+    assert fetch.calls == 1
+    assert error.value.attempts == 1
+
+
+#Each backoff counts one retry
+def test_fetch_with_retry_counts_retries(no_backoff):
+    METRICS.start_run('test')
+    try:
+        fetch = FlakyFetch(*[http_error(503)]*3)
+        assert fetch_with_retry('url', fetch=fetch) == 'ok'
+        assert METRICS.totals() == {('retries', 'backoff', None): 3}
+    finally:
+        METRICS.run_id = None
+
+
+#Retry-After is waited out when longer than the backoff
+def test_fetch_with_retry_waits_retry_after(monkeypatch, no_backoff):
+    sleeps = []
+    monkeypatch.setattr(http_client.time, 'sleep', sleeps.append)
+    fetch = FlakyFetch(http_error(429, {'Retry-After': '2'}))
+    assert fetch_with_retry('url', fetch=fetch) == 'ok'
+    assert sleeps == [2.]
+
+
+#Errors carrying their status without a response (as aiohttp's) are throttled too
+class StatusError(Exception):
+    def __init__(self, status):
+        super().__init__('{} error'.format(status))
+        self.status = status
+
+
+def test_fetch_with_retry_throttles_on_status_without_response(no_backoff):
+    limit = AdaptiveLimit(8)
+    fetch = FlakyFetch(StatusError(429))
+    with pytest.raises(StatusError) as error:
+        fetch_with_retry('url', limit=limit, fetch=fetch)
+    assert error.value.attempts == 1
+    assert limit.throttled == 1
+
+
+def test_fetch_with_retry_throttles_limit(no_backoff):
+    limit = AdaptiveLimit(8)
+    fetch = FlakyFetch(http_error(429), http_error(503))
+    assert fetch_with_retry('url', limit=limit, fetch=fetch) == 'ok'
+    assert limit.in_flight == 0
+    assert limit.throttled == 2
+    assert limit.limit < 8
+
+
+def test_adaptive_limit_halves_once_per_epoch():
+    limit = AdaptiveLimit(8)
+    decreases = [limit.acquire() for _ in range(4)]
+    for decrease in decreases:
+        limit.release(decrease, throttled=True)
+    #Requests started before the first cut do not cut it again
+    assert limit.limit == 4.
+    assert limit.decreases == 1
+
+    limit.release(limit.acquire(), throttled=True)
+    assert limit.limit == 2.
+
+    for _ in range(10):
+        limit.release(limit.acquire(), throttled=True)
+    assert limit.limit == limit.min_limit == 1
+
+
+def test_adaptive_limit_increases_additively():
+    limit = AdaptiveLimit(8)
+    limit.limit = 2.
+    limit.release(limit.acquire())
+    limit.release(limit.acquire())
+    assert limit.limit == pytest.approx(2.5 + 1/2.5)
+
+    for _ in range(100):
+        limit.release(limit.acquire())
+    assert limit.limit == limit.max_limit
+
+
+def test_adaptive_limit_pauses_after_retry_after():
+    limit = AdaptiveLimit(4)
+    limit.release(limit.acquire(), throttled=True, pause=0.2)
+    start = time.monotonic()
+    limit.release(limit.acquire())
+    assert time.monotonic() - start >= 0.15
+
+
+def test_fetch_pages_recovers_from_throttling(fault_stub, no_backoff):
+    server, base_url = fault_stub
+    server.capacity = 2
+    server.latency = 0.05
+    pages = [page for page, _ in fetch_pages(range(1, 11), concurrency=8, base_url=base_url, retries=10)]
+    assert pages == list(range(1, 11))
+    assert server.faults.get('429', 0) > 0
+
+
+def test_response_cache_expires_after_ttl(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+    cache.put('http://host/a', 200, {'ETag': '"1"'}, b'body')
+    header, body = cache.get('http://host/a')
+    assert (header['status'], header['headers'], body) == (200, {'ETag': '"1"'}, b'body')
+
+    now = time.time()
+    monkeypatch.setattr(http_client.time, 'time', lambda: now + 61)
+    assert cache.get('http://host/a') is None
+    #Replays serve expired responses
+    assert ResponseCache(str(tmp_path), ttl=60, replay=True).get('http://host/a')[1] == b'body'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+#Entries are evicted least recently used first, a hit counting as a use
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=2500)
+    for age, url in [(30, 'http://host/a'), (20, 'http://host/b')]:
+        cache.put(url, 200, {}, os.urandom(1000))
+        os.utime(cache._path(url), (time.time() - age,)*2)
+    assert cache.get('http://host/a') is not None
+
+    cache.put('http://host/c', 200, {}, os.urandom(1000))
+    assert cache.get('http://host/b') is None
+    assert cache.get('http://host/a') is not None
+    assert cache.get('http://host/c') is not None
+
+
+#In replay mode, cached pages are served without the network, and misses fail
+#without being retried
+def test_response_cache_replay(tmp_path, fault_stub):
+    server, base_url = fault_stub
+    url = '{}/.json?page=1'.format(base_url)
+    content = fetch_content(url, get_session(cache=ResponseCache(str(tmp_path))))
+
+    server.configure(dead_pages=(1, 2))
+    session = get_session(cache=ResponseCache(str(tmp_path), replay=True))
+    assert fetch_content(url, session) == content
+    with pytest.raises(CacheMissError) as error:
+        fetch_with_retry('{}/.json?page=2'.format(base_url), session)
+    assert error.value.attempts == 1
+    assert server.faults == {}
@@ -0,0 +1,32 @@
+#Import packages
+import io
+import json
+
+import pytest
+
+import json_stream
+
+
+DOCUMENT = json.dumps({'count': 3, 'products': [-2.5e-3, 0.1, 12, 1E+5, -0, 'text', True, None,
+                                                 {'code': '0012', 'nutriments': {'fat_100g': 3.25, 'energy': 1e3}},
+                                                 [1.5, [], {}], 'naïve ☕']}).replace(', ', ',\n ')
+
+
+#Every chunk boundary, including just after a number's '.', 'e' or sign,
+#decodes the same elements as json.loads
+@pytest.mark.parametrize('chunk_size', range(1, 17))
+def test_iter_items_stdlib_matches_json_loads(chunk_size):
+    expected = json.loads(DOCUMENT)['products']
+    for stream in [io.BytesIO(DOCUMENT.encode('utf-8')), io.StringIO(DOCUMENT)]:
+        assert list(json_stream._iter_items_stdlib(stream, 'products', chunk_size)) == expected
+
+
+def test_iter_items_stdlib_number_at_chunk_boundary():
+    items = json_stream._iter_items_stdlib(io.BytesIO(b'{"products":[-2.5e-3, 0.1]}'), 'products', 3)
+    assert list(items) == [-2.5e-3, 0.1]
+
+
+@pytest.mark.parametrize('document', [b'{"products": [1, 2', b'{"products": [1.]}', b'{"products": [1 2]}'])
+def test_iter_items_stdlib_rejects_invalid_documents(document):
+    with pytest.raises(ValueError):
+        list(json_stream._iter_items_stdlib(io.BytesIO(document), 'products', 4))
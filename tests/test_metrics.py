@@ -0,0 +1,49 @@
+#Import packages
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+import api_product_processing as app
+from metrics import METRICS
+
+
+
+#Metrics recorded during a test, stopped afterwards
+@pytest.fixture
+def metrics():
+    yield METRICS
+    METRICS.stop_saver()
+    METRICS.run_id = None
+
+
+#Function to get the pages logged with errors
+def error_pages(engine):
+    return pd.read_sql('select page from worldfood.logging where error_processing', engine)['page'].tolist()
+
+
+#Saves of metrics rows do not run inside (or wait on) the writes of the crawl
+def test_buffered_crawl_saves_metrics(engine, fault_stub, metrics):
+    server, base_url = fault_stub
+    metrics.start_run('test', engine, save_every=5, save_interval=0.01)
+    app.process_pages(engine, range(1, 11), concurrency=4, base_url=base_url, batch_pages=3)
+    metrics.stop_saver()
+    metrics.save()
+
+    assert error_pages(engine) == []
+    stages = pd.read_sql(sa.text('select stage from worldfood.metrics where run_id = :run_id'), engine,
+                         params={'run_id': metrics.run_id})['stage']
+    assert {'fetch', 'flatten', 'write'} <= set(stages)
+    assert metrics.summary()['fetch']['count'] == 10
+
+
+#Rows that cannot be saved are kept, and do not fail the crawl
+def test_metrics_save_errors_do_not_fail_pages(engine, fault_stub, metrics, tmp_path):
+    server, base_url = fault_stub
+    metrics_engine = sa.create_engine('sqlite:///' + str(tmp_path / 'missing' / 'metrics.db'))
+    metrics.start_run('test', metrics_engine, save_every=5, save_interval=0.01)
+    app.process_pages(engine, range(1, 6), base_url=base_url, batch_pages=2)
+    metrics.stop_saver()
+    metrics.save()
+
+    assert error_pages(engine) == []
+    assert len(metrics._pending) > 0
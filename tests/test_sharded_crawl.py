@@ -0,0 +1,96 @@
+#Import packages
+import uuid
+
+import pytest
+import sqlalchemy as sa
+
+import sharded_crawl
+from sharded_crawl import claim_lease, create_leases, get_crawl_status, has_open_leases, update_lease
+
+
+
+@pytest.fixture
+def crawl_id(pg_engine):
+    crawl_id = create_leases(pg_engine, 25, lease_pages=10, crawl_id=uuid.uuid4().hex)
+    yield crawl_id
+    with pg_engine.begin() as conn:
+        conn.execute(sa.text('delete from worldfood.crawl_leases where crawl_id = :crawl_id'), {'crawl_id': crawl_id})
+
+
+#Function to get the status of each lease of a crawl
+def lease_statuses(engine, crawl_id):
+    with engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(sa.text('select lease_id, status, worker, attempts from worldfood.crawl_leases '
+                                                           'where crawl_id = :crawl_id order by lease_id'),
+                                                   {'crawl_id': crawl_id})]
+
+
+def test_leases_need_postgresql(engine):
+    with pytest.raises(ValueError):
+        create_leases(engine, 10)
+
+
+def test_create_leases_splits_pages(pg_engine, crawl_id):
+    with pg_engine.connect() as conn:
+        leases = conn.execute(sa.text('select first_page, last_page from worldfood.crawl_leases '
+                                      'where crawl_id = :crawl_id order by lease_id'), {'crawl_id': crawl_id}).fetchall()
+    assert [tuple(lease) for lease in leases] == [(1, 10), (11, 20), (21, 25)]
+
+
+def test_claim_lease_skips_claimed_leases(pg_engine, crawl_id):
+    assert tuple(claim_lease(pg_engine, crawl_id, 'a')) == (0, 1, 10, 1)
+    assert tuple(claim_lease(pg_engine, crawl_id, 'b')) == (1, 11, 20, 1)
+    assert tuple(claim_lease(pg_engine, crawl_id, 'a')) == (2, 21, 25, 1)
+    assert claim_lease(pg_engine, crawl_id, 'c') is None
+
+    assert update_lease(pg_engine, crawl_id, 0, 'a', status='done')
+    assert update_lease(pg_engine, crawl_id, 1, 'b', status='done')
+    assert has_open_leases(pg_engine, crawl_id)
+    assert update_lease(pg_engine, crawl_id, 2, 'a', status='done')
+    assert not has_open_leases(pg_engine, crawl_id)
+
+
+#A lease without a heartbeat for lease_timeout seconds is reclaimed, and its
+#first worker finds it lost
+def test_expired_lease_is_reclaimed(pg_engine, crawl_id):
+    claim_lease(pg_engine, crawl_id, 'a')
+    assert claim_lease(pg_engine, crawl_id, 'b', lease_timeout=300)[0] == 1
+    assert tuple(claim_lease(pg_engine, crawl_id, 'c', lease_timeout=0)) == (0, 1, 10, 2)
+
+    assert not update_lease(pg_engine, crawl_id, 0, 'a')
+    assert update_lease(pg_engine, crawl_id, 0, 'c')
+    assert lease_statuses(pg_engine, crawl_id)[0] == (0, 'claimed', 'c', 2)
+
+
+#A lease released back to pending is claimed again, and a lease out of
+#attempts fails instead
+def test_lease_fails_after_max_attempts(pg_engine, crawl_id):
+    for attempt in range(2):
+        lease = claim_lease(pg_engine, crawl_id, 'a', max_attempts=2)
+        assert tuple(lease) == (0, 1, 10, attempt + 1)
+        assert update_lease(pg_engine, crawl_id, 0, 'a', status='pending', error='failed')
+
+    assert claim_lease(pg_engine, crawl_id, 'a', max_attempts=2)[0] == 1
+    assert claim_lease(pg_engine, crawl_id, 'b', lease_timeout=0, max_attempts=1)[0] == 2
+    assert claim_lease(pg_engine, crawl_id, 'c', lease_timeout=0, max_attempts=1) is None
+    assert [status for _, status, _, _ in lease_statuses(pg_engine, crawl_id)] == ['pending', 'failed', 'failed']
+    assert not has_open_leases(pg_engine, crawl_id, max_attempts=1)
+
+
+def test_run_worker_processes_leases(pg_engine, crawl_id, monkeypatch):
+    processed = []
+    monkeypatch.setattr(sharded_crawl, 'process_pages', lambda engine, pages, *args, **kwargs: processed.extend(pages))
+    assert sharded_crawl.run_worker(pg_engine, crawl_id, worker='a', poll_interval=0) == 3
+    assert processed == list(range(1, 26))
+    assert get_crawl_status(pg_engine, crawl_id)['leases'].values.tolist() == [['done', 3, 25]]
+
+
+#A lease whose pages fail is handed back for another attempt, then failed
+def test_run_worker_releases_failed_leases(pg_engine, crawl_id, monkeypatch):
+    def process_pages(engine, pages, *args, **kwargs):
+        pages = list(pages)
+        if pages[0] == 11:
+            raise RuntimeError('crawl failed')
+    monkeypatch.setattr(sharded_crawl, 'process_pages', process_pages)
+    assert sharded_crawl.run_worker(pg_engine, crawl_id, worker='a', max_attempts=2, poll_interval=0) == 2
+    assert lease_statuses(pg_engine, crawl_id) == [(0, 'done', 'a', 1), (1, 'failed', 'a', 2), (2, 'done', 'a', 1)]